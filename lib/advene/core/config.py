@@ -254,14 +254,35 @@ class Config(object):
             'display-scroller': False,
             'display-caption': False,
             'record-actions': False,
+            # Number of recorded events kept in memory
+            'event-history-size': 10000,
+            # Also append the recorded events to a log file in the
+            # traces directory
+            'event-history-log': False,
             # Imagecache save on exit: 'never', 'ask' or 'always'
             'imagecache-save-on-exit': 'ask',
+            # Maximum size (in bytes) of the in-memory snapshots of a
+            # package. Older snapshots are spilled to disk.
+            'imagecache-memory-limit': 64 * 1024 * 1024,
+            # Size (in bytes) of the cache of snapshots read from disk
+            'imagecache-hot-cache-size': 4 * 1024 * 1024,
+            # Imagecache storage: 'directory' (one PNG file per
+            # snapshot) or 'pack' (a single file per imagecache)
+            'imagecache-storage': 'directory',
             'quicksearch-ignore-case': True,
             # quicksearch sources. If [], it is all package's annotations.
             # Else it is a list of TALES expression applied to the current package
             'quicksearch-sources': [],
             # Display advanced options
             'expert-mode': False,
+            # Number of processes rendering the pages of a website
+            # export. 1 renders them in the application process. The
+            # processes are forked, so that it is ignored on win32.
+            'website-export-workers': 1,
+            # Store the application/x-advene-values contents (sound
+            # enveloppes...) as packed float32 values. Packages saved
+            # with this option cannot be read by older versions.
+            'packed-values': False,
             # Package auto-save : 'never', 'ask' or 'always'
             'package-auto-save': 'never',
             # auto-save interval in ms. Every 5 minutes by default.
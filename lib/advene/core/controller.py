@@ -40,7 +40,6 @@ import StringIO
 import gobject
 import shlex
 import itertools
-import operator
 
 import advene.core.config as config
 
@@ -60,6 +59,7 @@ from advene.model.zippackage import ZipPackage
 from advene.model.schema import Schema, AnnotationType, RelationType
 from advene.model.resources import Resources, ResourceData
 from advene.model.annotation import Annotation, Relation
+import advene.model.content
 from advene.model.fragment import MillisecondFragment
 from advene.model.view import View
 from advene.model.query import Query
@@ -80,8 +80,26 @@ if config.data.webserver['mode']:
     from advene.core.webcherry import AdveneWebServer
 
 import threading
+from multiprocessing.pool import ThreadPool
 gobject.threads_init()
 
+def trim_title(s, max_size=None):
+    """Trim a title to max_size characters.
+    """
+    if max_size is not None and len(s) > max_size:
+        return s[:max_size]+'\u2026'
+    else:
+        return s
+
+def cleanup_title(s, max_size=None):
+    """Keep the first line of a title, trimmed to max_size characters.
+    """
+    i=s.find('\n')
+    if i > 0:
+        return trim_title(s[:i], max_size)
+    else:
+        return trim_title(s, max_size)
+
 class GlobalPackage(object):
     """Wrapper to access all packages loaded data.
     """
@@ -141,6 +159,8 @@ class AdveneController(object):
     @type future_begins: list
     @ivar future_ends: the annotations that should be desactivated next (sorted)
     @type future_ends: list
+    @ivar annotation_window_size: the number of items fetched in future_begins/future_ends
+    @type annotation_window_size: int
 
     @ivar last_position: a cache to check whether an update is necessary
     @type last_position: int
@@ -180,6 +200,12 @@ class AdveneController(object):
         self.aliases = {}
         self.current_alias = None
 
+        # ((exporters filename, mtime), sorted export filters)
+        self._export_filters = None
+
+        # Titles of annotations and relations (see get_titles)
+        self._title_cache = helper.TitleCache()
+
         # Unknown arguments (neither a package nor a video file)
         self.unknown_args = []
 
@@ -194,6 +220,8 @@ class AdveneController(object):
         self.active_annotations = []
         self.future_begins = None
         self.future_ends = None
+        # Size of the future_begins/future_ends windows
+        self.annotation_window_size = 100
         self.last_position = -1
 
         # List of (time, action) tuples, sorted along time
@@ -525,9 +553,11 @@ class AdveneController(object):
                        for an in self.restricted_annotations
                        if an.fragment.begin > a.fragment.end ]
                 else:
-                    l=[an
-                       for an in self.future_begins
-                       if an[0].type == t ]
+                    l=[]
+                    for an in self.package.getTimeIndex().iter_begins(a.fragment.end, strict=True):
+                        if an[0].type == t:
+                            l.append(an)
+                            break
                 if l and l[0][1] > a.fragment.end:
                     self.queue_action(self.update_status, 'set', l[0][1])
                 else:
@@ -784,6 +814,9 @@ class AdveneController(object):
 
         self.event_handler.internal_rule (event="PackageLoad",
                                           method=self.manage_package_load)
+        for e in ('ViewEditEnd', 'ViewDelete'):
+            self.event_handler.internal_rule (event=e,
+                                              method=self.invalidate_view_template)
 
         media=None
         # Arguments handling
@@ -948,6 +981,7 @@ class AdveneController(object):
             elif event_name.endswith('Create'):
                 # We created an element. Make sure its id is registered in the _idgenerator
                 p._idgenerator.add(el.id)
+            self._title_cache.invalidate(event_name, el)
 
         if 'immediate' in kw:
             self.event_handler.notify(event_name, *param, **kw)
@@ -1111,53 +1145,14 @@ class AdveneController(object):
     def get_title(self, element, representation=None, max_size=None):
         """Return the title for the given element.
         """
-        def trim_size(s):
-            if max_size is not None and len(s) > max_size:
-                return s[:max_size]+'\u2026'
-            else:
-                return s
-
-        def cleanup(s):
-            i=s.find('\n')
-            if i > 0:
-                return trim_size(s[:i])
-            else:
-                return trim_size(s)
-
         if element is None:
             return _("None")
         if isinstance(element, unicode) or isinstance(element, str):
-            return trim_size(element)
+            return trim_title(element, max_size)
         if isinstance(element, Annotation) or isinstance(element, Relation):
-            if representation is not None and representation != "":
-                c=self.build_context(here=element)
-                try:
-                    r=c.evaluateValue(representation)
-                except AdveneTalesException:
-                    r=element.content.data
-                if not r:
-                    r=element.id
-                return cleanup(r)
-
-            expr=element.type.getMetaData(config.data.namespace, "representation")
-            if expr is None or expr == '' or re.match('^\s+', expr):
-                r=element.content.data
-                if element.content.mimetype == 'image/svg+xml':
-                    return "SVG graphics"
-                elif not element.content.isTextual():
-                    return "Data"
-                if not r:
-                    r=element.id
-                return cleanup(r)
-            else:
-                c=self.build_context(here=element)
-                try:
-                    r=c.evaluateValue(expr)
-                except AdveneTalesException:
-                    r=element.content.data
-                if not r:
-                    r=element.id
-                return cleanup(r)
+            return self.get_titles( (element, ), representation, max_size)[0]
+        def cleanup(s):
+            return cleanup_title(s, max_size)
         if isinstance(element, RelationType):
             if config.data.os == 'win32':
                 arrow=u'->'
@@ -1170,6 +1165,54 @@ class AdveneController(object):
             return unicode(element.id)
         return cleanup(unicode(element))
 
+    def get_titles(self, elements, representation=None, max_size=None):
+        """Return the titles of the given elements.
+
+        The titles of annotations and relations are cached until the
+        element or its type is modified. The representation
+        expressions are evaluated in a single context.
+        """
+        res=[]
+        context=None
+        for element in elements:
+            if not (isinstance(element, Annotation) or isinstance(element, Relation)):
+                res.append(self.get_title(element, representation, max_size))
+                continue
+            titles=self._title_cache.titles(element)
+            key=(representation, max_size)
+            r=titles.get(key)
+            if r is not None:
+                res.append(r)
+                continue
+
+            expr=representation
+            if expr is None or expr == "":
+                expr=element.type.getMetaData(config.data.namespace, "representation")
+                if expr is None or expr == '' or re.match('^\s+', expr):
+                    expr=None
+            if expr is None and element.content.mimetype == 'image/svg+xml':
+                r="SVG graphics"
+            elif expr is None and not element.content.isTextual():
+                r="Data"
+            else:
+                if expr is None:
+                    r=element.content.data
+                else:
+                    if context is None:
+                        context=self.build_context(here=element)
+                    else:
+                        context.addGlobal(u'here', element)
+                    try:
+                        r=context.evaluateValue(expr)
+                    except AdveneTalesException:
+                        r=element.content.data
+                if not r:
+                    r=element.id
+                r=cleanup_title(r, max_size)
+            titles[key]=r
+            res.append(r)
+        return res
+
     def get_default_media (self, package=None):
         """Return the current media for the given package.
         """
@@ -1283,6 +1326,7 @@ class AdveneController(object):
             uri=self.player.dvd_uri(title, chapter)
         self.set_media(uri)
         # Reset the imagecache
+        self.package.imagecache.close()
         self.package.imagecache=ImageCache()
         if uri is not None and uri != "":
             id_ = helper.mediafile2id (uri)
@@ -1507,7 +1551,8 @@ class AdveneController(object):
         elif ( mtd == mts and mtd == 'application/x-advene-structured' ):
             # Compare fields and merge identical fields
             sdata=s.content.parsed()
-            ddata=d.content.parsed()
+            # Copy the parsed data, which is shared
+            ddata=dict(d.content.parsed())
             for k, v in sdata.iteritems():
                 if k in ddata:
                     # Merge fields
@@ -1610,17 +1655,46 @@ class AdveneController(object):
                     color=self.get_element_color(container)
         return color
 
-    def load_package (self, uri=None, alias=None, activate=True):
+    def prefetch_package(self, uri):
+        """Read the file of a package, without parsing it.
+
+        .azp packages are expanded, and the data of the other local
+        files is read. It does not modify any shared state, so that it
+        can be called from worker threads (see load_package).
+
+        @param uri: the URI of the package
+        @type uri: string
+        @return: the source of the package (see Package), or None
+        """
+        try:
+            if uri.lower().endswith('.azp') or uri.endswith('/'):
+                return ZipPackage(uri)
+            elif os.path.exists(uri):
+                f=open(uri, 'rb')
+                source=StringIO.StringIO(f.read())
+                f.close()
+                return source
+        except Exception:
+            # The error will be reported when loading the package
+            pass
+        return None
+
+    def load_package (self, uri=None, alias=None, activate=True, source=None):
         """Load a package.
 
         This method is esp. used as a callback for webserver. If called
         with no argument, or an empty string, it will create a new
         empty package.
 
+        The files of the packages of a session (.apl) are read in
+        worker threads (see prefetch_package). The packages are then
+        parsed and registered in order.
+
         @param uri: the URI of the package
         @type uri: string
         @param alias: the name of the package (ignored in the GUI, always "advene")
         @type alias: string
+        @param source: the source of the package, if it was prefetched
         """
         if uri is None or uri == "":
             try:
@@ -1643,15 +1717,29 @@ class AdveneController(object):
             root=tree.getroot()
             if root.tag != tag('package-list'):
                 raise Exception('Invalid XML element for session: ' + root.tag)
+            nodes=[ node for node in root if node.tag == tag('package') ]
+            # Reading and expanding the files does not hold the
+            # interpreter lock. Parsing does, and resolves imports
+            # through a shared cache: it is done in this thread.
+            sources=[]
+            if nodes:
+                pool=ThreadPool(min(len(nodes), 4))
+                try:
+                    sources=pool.map(self.prefetch_package, [ node.attrib['uri'] for node in nodes ])
+                finally:
+                    pool.close()
             default_alias=None
-            for node in root:
-                if node.tag == tag('package'):
-                    u=node.attrib['uri']
-                    a=node.attrib['alias']
-                    d=node.attrib.has_key('default')
-                    self.load_package(u, a, activate=False)
-                    if d:
-                        default_alias=a
+            for node, source in zip(nodes, sources):
+                u=node.attrib['uri']
+                a=node.attrib['alias']
+                d=node.attrib.has_key('default')
+                t=time.time()
+                self.load_package(u, a, activate=False, source=source)
+                self.log(_("Loaded package %(uri)s in %(duration).2f seconds") % {
+                        'uri': u,
+                        'duration': time.time() - t })
+                if d:
+                    default_alias=a
                 if not default_alias:
                     # If no default package was specified, use the last one
                     default_alias=a
@@ -1660,7 +1748,10 @@ class AdveneController(object):
             return
         else:
             t=time.time()
-            p = Package(uri=uri)
+            if source is None:
+                p = Package(uri=uri)
+            else:
+                p = Package(uri=uri, source=source)
             dur=time.time()-t
             self.log("Loaded package in %f seconds" % dur)
             # Check if the imported package was found. Else it will
@@ -1687,6 +1778,8 @@ class AdveneController(object):
 
         self.package.imagecache=ImageCache()
         self.package._idgenerator = advene.core.idgenerator.Generator(self.package)
+        if config.data.preferences['packed-values']:
+            helper.pack_values(self.package)
         self.package._modified = False
 
         # State dictionary
@@ -1783,6 +1876,10 @@ class AdveneController(object):
         p = self.packages[alias]
         del (self.aliases[p])
         del (self.packages[alias])
+        if hasattr(p, 'imagecache'):
+            p.imagecache.close()
+        self._title_cache.discard_package(p)
+        advene.model.content.parsed_cache.discard_package(p)
         if self.package == p:
             l=[ a for a in self.packages.keys() if a != 'advene' ]
             # There should be at least 1 key
@@ -1804,6 +1901,8 @@ class AdveneController(object):
             self.current_alias = None
             return
         self.packages['advene']=self.package
+        # The representations may use the current package
+        self._title_cache.clear()
 
         # Reset the cached duration
         duration = self.package.getMetaData (config.data.namespace, "duration")
@@ -1898,6 +1997,8 @@ class AdveneController(object):
                 if pl and pl[0]:
                     self.set_default_media(pl[0])
 
+        # Convert the values to the configured storage
+        helper.pack_values(p, config.data.preferences['packed-values'])
         p.save(name=name)
         p._modified = False
 
@@ -1909,6 +2010,16 @@ class AdveneController(object):
             # FIXME: we keep here the old and the new package.
             # Maybe we could autoclose the old package
 
+    def invalidate_view_template (self, context, parameters):
+        """Event Handler executed after the modification of a view.
+
+        Discard the compiled templates of the view.
+        """
+        view=context.evaluateValue('view')
+        if view is not None:
+            advene.model.tal.context.template_cache.invalidate(view.getUri(absolute=True))
+        return True
+
     def manage_package_load (self, context, parameters):
         """Event Handler executed after loading a package.
 
@@ -2111,6 +2222,11 @@ class AdveneController(object):
             # Cleanup the ZipPackage directories
             ZipPackage.cleanup()
 
+            # Remove the spilled snapshots
+            for package in self.packages.itervalues():
+                if hasattr(package, 'imagecache'):
+                    package.imagecache.close()
+
             # Terminate the web server
             try:
                 self.server.stop()
@@ -2120,6 +2236,7 @@ class AdveneController(object):
             for tr in self.tracers:
                 tr.equeue.put(tr.exit_code)
                 tr.join()
+            self.event_handler.close_event_log()
             # Terminate the VLC server
             try:
                 #print "Exiting vlc player"
@@ -2276,13 +2393,19 @@ class AdveneController(object):
     def generate_sorted_lists (self, position):
         """Return two sorted lists and a list of active annotations valid for a given position.
 
-        (i.e. all annotations beginning or ending after the
+        (i.e. the annotations beginning or ending after the
         position). The lists are sorted according to the begin and end
         position respectively.
 
         The elements of the begin/end lists are (annotation, begin,
         end). The elements of active_annotations are annotations.
 
+        The begin/end lists only hold the next
+        annotation_window_size items (extended to all the items
+        sharing the last begin/end time), obtained from the package
+        temporal index. The update method refills them when they are
+        exhausted.
+
         The update_display method only has to check the first element
         of each list. If there is a match, it should trigger the
         events and pop the element.
@@ -2300,19 +2423,10 @@ class AdveneController(object):
         # AnnotatioBegin gets correctly notified.
         position -= 20
 
-        future_begins = []
-        future_ends = []
-        active = []
-
-        for a in self.package.annotations:
-            if a.fragment.begin >= position:
-                future_begins.append( (a, a.fragment.begin, a.fragment.end) )
-                future_ends.append( (a, a.fragment.begin, a.fragment.end) )
-            elif a.fragment.end >= position:
-                future_ends.append( (a, a.fragment.begin, a.fragment.end) )
-                active.append(a)
-        future_begins.sort(key=operator.itemgetter(1))
-        future_ends.sort(key=operator.itemgetter(2))
+        index = self.package.getTimeIndex()
+        future_begins = index.begins_from(position, self.annotation_window_size)
+        future_ends = index.ends_from(position, self.annotation_window_size)
+        active = [ a for (a, b, e) in index.annotations_at(position) if b < position ]
 
         #print "Position: %s" % helper.format_time(position)
         #print "Begins: %s\nEnds: %s" % ([ a[0].id for a in future_begins[:4] ],
@@ -2389,6 +2503,9 @@ class AdveneController(object):
                                  annotation=a,
                                  immediate=True)
                     self.active_annotations.append(a)
+                if not self.future_begins:
+                    # Window exhausted. Fetch the next one.
+                    self.future_begins = self.package.getTimeIndex().begins_from(b + 1, self.annotation_window_size)
                 if self.future_begins:
                     a, b, e = self.future_begins[0]
                 else:
@@ -2406,6 +2523,9 @@ class AdveneController(object):
                 self.notify ("AnnotationEnd",
                              annotation=a,
                              immediate=True)
+                if not self.future_ends:
+                    # Window exhausted. Fetch the next one.
+                    self.future_ends = self.package.getTimeIndex().ends_from(e + 1, self.annotation_window_size)
                 if self.future_ends:
                     a, b, e = self.future_ends[0]
                 else:
@@ -2484,49 +2604,66 @@ class AdveneController(object):
         return v
 
     def get_export_filters(self):
-        exporter_package=Package(uri=config.data.advenefile('exporters.xml'))
-        return sorted( ( v
-                         for v in exporter_package.views
-                         if v.id != 'index' ), key=lambda v: v.title )
+        """Return the export filters, sorted by title.
+
+        The exporters package is read once, and read again only if
+        its file is modified.
+        """
+        fname=config.data.advenefile('exporters.xml')
+        key=(fname, os.path.getmtime(fname))
+        if self._export_filters is None or self._export_filters[0] != key:
+            exporter_package=Package(uri=fname)
+            self._export_filters=(key, sorted( ( v
+                                                 for v in exporter_package.views
+                                                 if v.id != 'index' ), key=lambda v: v.title ))
+        return list(self._export_filters[1])
 
     def apply_export_filter(self, element, filter, filename):
         """Apply the given export filename to the element and output the result to filename.
         """
-        ctx=self.build_context(here=element)
-        try:
-            stream=open(filename, 'wb')
-        except Exception, e:
-            self.log(_("Cannot export to %(filename)s: %(e)s") % locals())
-            return True
+        return self.apply_export_filter_batch(filter, [ (element, filename) ])
+
+    def apply_export_filter_batch(self, filter, items):
+        """Apply the given export filter to many elements.
+
+        The filter template is compiled once for all the elements.
 
-        kw = {}
-        if filter.content.mimetype is None or filter.content.mimetype.startswith('text/'):
-            compiler = simpleTAL.HTMLTemplateCompiler ()
-            compiler.parseTemplate (filter.content.stream, 'utf-8')
-            if filter.content.mimetype == 'text/plain':
+        @param filter: the export filter (see get_export_filters)
+        @type filter: View
+        @param items: an iterable of (element, filename) pairs. It can
+                      be a generator loading the packages one at a time.
+        """
+        mimetype=filter.content.mimetype
+        template=None
+        for element, filename in items:
+            ctx=self.build_context(here=element)
+            if template is None:
+                template, kw = ctx.compile(filter.content.stream, mimetype,
+                                           uri=filter.getUri(absolute=True))
+            try:
+                stream=open(filename, 'wb')
+            except Exception, e:
+                self.log(_("Cannot export to %(filename)s: %(e)s") % locals())
+                continue
+
+            if mimetype == 'text/plain':
                 # Convert HTML entities to their values
-                output = StringIO.StringIO()
+                output = helper.EntityUnescapeWriter(stream)
             else:
                 output = stream
             try:
-                compiler.getTemplate ().expand (context=ctx, outputFile=output, outputEncoding='utf-8')
-            except simpleTALES.ContextContentException, e:
-                self.log(_("Error when exporting: %s") % unicode(e))
-            if filter.content.mimetype == 'text/plain':
-                stream.write(output.getvalue().replace('&lt;', '<').replace('&gt;', '>').replace('&amp;', '&'))
-        else:
-            compiler = simpleTAL.XMLTemplateCompiler ()
-            compiler.parseTemplate (filter.content.stream)
-            try:
-                compiler.getTemplate ().expand (context=ctx, outputFile=stream, outputEncoding='utf-8', suppressXMLDeclaration=True)
+                template.expand (context=ctx, outputFile=output, outputEncoding='utf-8', **kw)
             except simpleTALES.ContextContentException, e:
                 self.log(_("Error when exporting: %s") % unicode(e))
-        stream.close()
-        self.log(_("Data exported to %s") % filename)
+            output.flush()
+            stream.close()
+            self.log(_("Data exported to %s") % filename)
         return True
 
-    def website_export(self, destination='/tmp/n', views=None, max_depth=3, progress_callback=None, video_url=None):
-        exporter=WebsiteExporter(self, destination, views, max_depth, progress_callback, video_url)
+    def website_export(self, destination='/tmp/n', views=None, max_depth=3, progress_callback=None, video_url=None, workers=None, incremental=True):
+        if workers is None:
+            workers=config.data.preferences['website-export-workers']
+        exporter=WebsiteExporter(self, destination, views, max_depth, progress_callback, video_url, workers, incremental)
         # FIXME
         exporter.website_export()
         return True
@@ -47,10 +47,13 @@ class Generator:
         }
 
     def __init__(self, package=None):
-        self.last_used={}
-        self.existing=[]
-        for k in self.prefix.keys():
-            self.last_used[k]=0
+        # Set of known ids
+        self.existing=set()
+        # prefix -> last used index
+        self.last_used=dict( (p, 0) for p in self.prefix.itervalues() )
+        # title id root -> last index returned by new_from_title
+        self.last_title={}
+        self.re_id=re.compile("^(" + "|".join(self.prefix.itervalues()) + ")([0-9]+)")
         if package is not None:
             self.init(package)
 
@@ -62,60 +65,78 @@ class Generator:
     def add(self, id_):
         """Add a new known id.
         """
-        self.existing.append(id_)
+        self.existing.add(id_)
+
+    def add_many(self, ids):
+        """Add new known ids.
+        """
+        self.existing.update(ids)
 
     def remove(self, id_):
         """Remove an id from the existing set.
         """
-        try:
-            self.existing.remove(id_)
-        except ValueError:
-            pass
+        self.existing.discard(id_)
 
     def init(self, package):
         """Initialize the indexes for the given package."""
-        prefixes=self.prefix.values()
-        re_id = re.compile("^(" + "|".join(prefixes) + ")([0-9]+)")
-        last_id={}
-        for k in prefixes:
-            last_id[k]=0
-
         # FIXME: find all package ids
         for l in (package.annotations, package.relations,
                   package.schemas,
                   package.annotationTypes, package.relationTypes,
                   package.views, package.queries):
-            for i in l.ids():
-                self.existing.append(i)
-                m=re_id.match(i)
+            ids=l.ids()
+            self.add_many(ids)
+            for i in ids:
+                m=self.re_id.match(i)
                 if m:
                     n=long(m.group(2))
                     k=m.group(1)
-                    if last_id[k] < n:
-                        last_id[k] = n
-        # last_id contains the last index used for each prefix
-        self.last_used = dict(last_id)
+                    if self.last_used[k] < n:
+                        self.last_used[k] = n
 
     def get_id(self, elementtype):
         """Return a not-yet used id.
         """
         prefix=self.prefix[elementtype]
         index=self.last_used[prefix] + 1
-        self.last_used[prefix]=index
         id_ = prefix + str(index)
-        # Do not append yet.
-        #self.existing.append(id_)
+        while id_ in self.existing:
+            index += 1
+            id_ = prefix + str(index)
+        self.last_used[prefix]=index
+        # Do not add yet.
         return id_
 
+    def get_ids(self, elementtype, count):
+        """Reserve count not-yet used ids, for batch creation.
+
+        The ids are added to the known ids.
+        """
+        prefix=self.prefix[elementtype]
+        existing=self.existing
+        index=self.last_used[prefix]
+        res=[]
+        while len(res) < count:
+            index += 1
+            id_ = prefix + str(index)
+            if id_ not in existing:
+                res.append(id_)
+        self.last_used[prefix]=index
+        existing.update(res)
+        return res
+
     def new_from_title(self, title):
         """Generate a new (title, identifier) from a given title.
         """
         root=helper.title2id(title)
-        index=1
+        # Start from the last returned index instead of 1, so that
+        # successive calls do not scan all the used indexes
+        index=self.last_title.get(root, 1)
         i="%s%d" % (root, index)
         while i in self.existing:
             index += 1
             i="%s%d" % (root, index)
+        self.last_title[root]=index
         if index != 1:
             title="%s%d" % (title, index)
         return title, i
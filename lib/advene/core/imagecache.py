@@ -21,13 +21,84 @@ Imagecache module for advene
 """
 
 import advene.core.config as config
-import operator
 
+from bisect import bisect_left, insort
+from collections import OrderedDict
+import mmap
 import os
 import re
+import shutil
+import struct
+import tempfile
+import threading
+
+class HotCache(object):
+    """LRU cache of the data of recently read CachedStrings.
+
+    @ivar size: the maximum size of the cached data, in bytes
+    @type size: integer
+    @ivar resident: the size of the cached data, in bytes
+    @type resident: integer
+    """
+    def __init__(self, size):
+        self.size=size
+        self.resident=0
+        self.hits=0
+        self.misses=0
+        self._data=OrderedDict()
+        # CachedStrings are read from the GUI and the webserver threads
+        self._lock=threading.Lock()
+
+    def get(self, filename):
+        """Return the cached data for filename, or None.
+        """
+        self._lock.acquire()
+        try:
+            data=self._data.pop(filename, None)
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._data[filename]=data
+            return data
+        finally:
+            self._lock.release()
+
+    def put(self, filename, data):
+        """Cache the data of filename.
+        """
+        if len(data) > self.size:
+            return
+        self._lock.acquire()
+        try:
+            old=self._data.pop(filename, None)
+            if old is not None:
+                self.resident -= len(old)
+            self._data[filename]=data
+            self.resident += len(data)
+            while self.resident > self.size:
+                f, d = self._data.popitem(last=False)
+                self.resident -= len(d)
+        finally:
+            self._lock.release()
+
+    def discard(self, filename):
+        """Discard the cached data of filename, which has been modified.
+        """
+        self._lock.acquire()
+        try:
+            old=self._data.pop(filename, None)
+            if old is not None:
+                self.resident -= len(old)
+        finally:
+            self._lock.release()
+
+hot_cache=HotCache(config.data.preferences['imagecache-hot-cache-size'])
 
 class CachedString:
     """String cached in a file.
+
+    Recently read data is kept in hot_cache.
     """
     def __init__(self, filename):
         self._filename=filename
@@ -39,17 +110,192 @@ class CachedString:
             self.timestamp=-1
 
     def __str__(self):
+        data=hot_cache.get(self._filename)
+        if data is not None:
+            return data
         try:
             f=open(self._filename, 'rb')
             data=f.read()
             f.close()
-            return data
         except (IOError, OSError):
             return ''
+        hot_cache.put(self._filename, data)
+        return data
 
     def __repr__(self):
         return "Cached content from " + self._filename
 
+class SnapshotPack(object):
+    """Append-only file of snapshots.
+
+    The file begins with the MAGIC string, followed by records made of a
+    header (timestamp, length) and the PNG data. A snapshot is updated by
+    appending a new record, which supersedes the previous ones for the
+    same timestamp. The file is read through mmap.
+
+    The space of superseded records is reclaimed by compact.
+
+    @ivar filename: the file name
+    @type filename: string
+    @ivar index: the location of the snapshots: timestamp -> (offset, length)
+    @type index: dict
+    @ivar dead: the size of the superseded records, in bytes
+    @type dead: integer
+    """
+    MAGIC='ADVSNAP1'
+    HEADER=struct.Struct('<qI')
+    # Proportion of superseded records beyond which needs_compaction is True
+    COMPACTION_RATIO=.25
+
+    def __init__(self, filename):
+        self.filename=filename
+        self.index={}
+        self.dead=0
+        self._lock=threading.Lock()
+        self._file=open(filename, 'a+b')
+        self._file.seek(0, 2)
+        if self._file.tell() == 0:
+            self._file.write(self.MAGIC)
+            self._file.flush()
+        self._map=None
+        self._remap()
+        if self._map[:len(self.MAGIC)] != self.MAGIC:
+            self.close()
+            raise Exception("%s is not a snapshot pack" % filename)
+        self._scan()
+
+    def _remap(self):
+        if self._map is not None:
+            self._map.close()
+        self._map=mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _scan(self):
+        """Build the index from the record headers.
+        """
+        m=self._map
+        size=len(m)
+        header=self.HEADER
+        offset=len(self.MAGIC)
+        index=self.index
+        while offset + header.size <= size:
+            ts, length = header.unpack_from(m, offset)
+            offset += header.size
+            if offset + length > size:
+                # Truncated record (interrupted write): ignore it
+                break
+            if ts in index:
+                self.dead += header.size + index[ts][1]
+            index[ts]=(offset, length)
+            offset += length
+
+    def __len__(self):
+        return len(self.index)
+
+    def read(self, timestamp):
+        """Return the data of the snapshot for timestamp.
+        """
+        self._lock.acquire()
+        try:
+            offset, length = self.index[timestamp]
+            if offset + length > len(self._map):
+                self._remap()
+            return self._map[offset:offset + length]
+        finally:
+            self._lock.release()
+
+    def get(self, timestamp):
+        """Return a PackedString for timestamp.
+        """
+        return PackedString(self, timestamp)
+
+    def append(self, timestamp, data):
+        """Append a snapshot, and return the corresponding PackedString.
+        """
+        data=str(data)
+        self._lock.acquire()
+        try:
+            f=self._file
+            f.seek(0, 2)
+            f.write(self.HEADER.pack(timestamp, len(data)))
+            offset=f.tell()
+            f.write(data)
+            f.flush()
+            if timestamp in self.index:
+                self.dead += self.HEADER.size + self.index[timestamp][1]
+            self.index[timestamp]=(offset, len(data))
+        finally:
+            self._lock.release()
+        return PackedString(self, timestamp)
+
+    def needs_compaction(self):
+        """Return True if superseded records use too much space.
+        """
+        return self.dead > self.COMPACTION_RATIO * os.fstat(self._file.fileno()).st_size
+
+    def compact(self):
+        """Rewrite the file with the current snapshots only.
+
+        The file is written next to the original one, and then renamed,
+        so that an interruption does not lose the snapshots.
+        """
+        self._lock.acquire()
+        try:
+            # Map the records appended since the last remap
+            self._remap()
+            tmp=self.filename + '.tmp'
+            f=open(tmp, 'wb')
+            index={}
+            try:
+                f.write(self.MAGIC)
+                for ts in sorted(self.index):
+                    offset, length = self.index[ts]
+                    f.write(self.HEADER.pack(ts, length))
+                    index[ts]=(f.tell(), length)
+                    f.write(self._map[offset:offset + length])
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                f.close()
+            self._map.close()
+            self._map=None
+            self._file.close()
+            if config.data.os == 'win32':
+                # os.rename does not replace existing files on win32
+                os.unlink(self.filename)
+            os.rename(tmp, self.filename)
+            self.index=index
+            self.dead=0
+            self._file=open(self.filename, 'a+b')
+            self._remap()
+        finally:
+            self._lock.release()
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map=None
+        self._file.close()
+
+class PackedString(object):
+    """String stored in a SnapshotPack.
+
+    It is located through the pack index, so that it remains valid
+    when the pack is compacted.
+    """
+    def __init__(self, pack, timestamp):
+        self._pack=pack
+        self.contenttype='image/png'
+        self.timestamp=timestamp
+
+    def __str__(self):
+        return self._pack.read(self.timestamp)
+
+    def __len__(self):
+        return self._pack.index[self.timestamp][1]
+
+    def __repr__(self):
+        return "Packed content from %s" % self._pack.filename
+
 class TypedString(str):
     """String with a mimetype and a timestamp attribute.
     """
@@ -59,6 +305,47 @@ class TypedString(str):
         s.timestamp=-1
         return s
 
+def pack_filename(name):
+    """Return the name of the SnapshotPack file of the imagecache name.
+    """
+    return os.path.join(config.data.path['imagecache'], name + '.pack')
+
+def migrate(name, remove=False):
+    """Copy the snapshots of the imagecache directory name into its pack.
+
+    If remove is True, the PNG files (and the directory, if it is then
+    empty) are removed.
+
+    @return: the number of copied snapshots
+    """
+    d=os.path.join(config.data.path['imagecache'], name)
+    if not os.path.isdir(d):
+        return 0
+    pack=SnapshotPack(pack_filename(name))
+    count=0
+    try:
+        for n in sorted(os.listdir(d)):
+            base, ext = os.path.splitext(n)
+            if ext.lower() != '.png':
+                continue
+            try:
+                ts=long(base.lstrip('0') or '0')
+            except ValueError:
+                continue
+            f=open(os.path.join(d, n), 'rb')
+            data=f.read()
+            f.close()
+            if ts not in pack.index:
+                pack.append(ts, data)
+                count += 1
+            if remove:
+                os.unlink(os.path.join(d, n))
+    finally:
+        pack.close()
+    if remove and not os.listdir(d):
+        os.rmdir(d)
+    return count
+
 class ImageCache(dict):
     """ImageCache class.
 
@@ -75,6 +362,20 @@ class ImageCache(dict):
     @type name: string
     @ivar autosync: if True, directly store snapshots on disk
     @type autosync: boolean
+    @ivar _valid: the positions of valid snapshots
+    @type _valid: set
+    @ivar _valid_keys: the positions of valid snapshots, sorted
+    @type _valid_keys: list
+    @ivar memory_limit: the maximum size of in-memory snapshots, in bytes.
+    Least recently used snapshots are spilled to disk beyond it.
+    @type memory_limit: integer
+    @ivar resident: the size of in-memory snapshots, in bytes
+    @type resident: integer
+    @ivar spills: the number of snapshots spilled to disk
+    @type spills: integer
+    @ivar storage: the storage used by save, autosync and spills: 'directory'
+    (one PNG file per snapshot) or 'pack' (a single SnapshotPack file)
+    @type storage: string
     """
     # The content of the not_yet_available_file file. We could use
     # CachedString but as it is frequently used, let us keep it in memory.
@@ -98,6 +399,20 @@ class ImageCache(dict):
         # not yet been updated.
         dict.__init__ (self)
 
+        # The status of snapshots is tracked in _valid and _valid_keys,
+        # so that lookups never have to compare image data.
+        self._valid=set()
+        self._valid_keys=[]
+
+        # In-memory snapshots, in LRU order: key -> size
+        self._resident=OrderedDict()
+        self.resident=0
+        self.spills=0
+        self.memory_limit=config.data.preferences['imagecache-memory-limit']
+        self._spill_dir=None
+        self.storage=config.data.preferences['imagecache-storage']
+        self._pack=None
+
         self._modified=False
 
         self.name=None
@@ -120,6 +435,165 @@ class ImageCache(dict):
         if not dict.has_key (self, key):
             dict.__setitem__(self, key, self.not_yet_available_image)
 
+    def _set_valid (self, key, value):
+        """Store a valid snapshot.
+        """
+        self._release(key)
+        dict.__setitem__(self, key, value)
+        if key not in self._valid:
+            self._valid.add(key)
+            insort(self._valid_keys, key)
+        if isinstance(value, TypedString):
+            self._resident[key]=len(value)
+            self.resident += len(value)
+            if self.resident > self.memory_limit:
+                self._spill()
+
+    def _add_snapshots (self, items):
+        """Store valid snapshots given as (key, value) couples.
+
+        This is equivalent to calling _set_valid for each item, but sorts
+        the keys only once.
+        """
+        for key, value in items:
+            self._release(key)
+            dict.__setitem__(self, key, value)
+            self._valid.add(key)
+        self._valid_keys=sorted(self._valid)
+
+    def _set_missing (self, key):
+        """Mark a snapshot as not yet available.
+        """
+        self._release(key)
+        dict.__setitem__(self, key, self.not_yet_available_image)
+        if key in self._valid:
+            self._valid.remove(key)
+            del self._valid_keys[bisect_left(self._valid_keys, key)]
+
+    def _release (self, key):
+        """Forget the in-memory snapshot for key, if any.
+        """
+        size=self._resident.pop(key, None)
+        if size is not None:
+            self.resident -= size
+
+    def _touch (self, key):
+        """Mark the snapshot for key as recently used.
+        """
+        size=self._resident.pop(key, None)
+        if size is not None:
+            self._resident[key]=size
+
+    def _spill (self):
+        """Write least recently used snapshots to disk.
+
+        Snapshots are written into a private temporary directory, and
+        replaced by CachedStrings, until the memory limit is respected.
+        The persistent storage of the imagecache is only written by
+        save (and autosync), so that the imagecache-save-on-exit
+        preference is respected. The directory is removed by close,
+        clear and reset.
+        """
+        if self._spill_dir is None:
+            self._spill_dir=tempfile.mkdtemp(prefix='advene-spill')
+        d=self._spill_dir
+        while self.resident > self.memory_limit and self._resident:
+            key, size = self._resident.popitem(last=False)
+            self.resident -= size
+            value=self._write_file(d, key, dict.__getitem__(self, key))
+            dict.__setitem__(self, key, value)
+            self.spills += 1
+
+    def _remove_spill_dir (self):
+        """Remove the directory of spilled snapshots.
+
+        The spilled snapshots must not be referenced anymore.
+        """
+        if self._spill_dir is not None:
+            shutil.rmtree(self._spill_dir, ignore_errors=True)
+            self._spill_dir=None
+
+    def _write_file (self, d, key, data):
+        """Write a snapshot into the directory d.
+
+        @return: the corresponding CachedString
+        """
+        filename=os.path.join(d, "%010d.png" % key)
+        f = open(filename, 'wb')
+        f.write (data)
+        f.close ()
+        hot_cache.discard(filename)
+        value=CachedString(filename)
+        value.contenttype='image/png'
+        return value
+
+    def _store (self, key, data):
+        """Store a snapshot in the storage of the (named) imagecache.
+
+        @return: the corresponding CachedString or PackedString
+        """
+        if self.storage == 'pack':
+            return self._get_pack(self.name).append(key, data)
+        else:
+            return self._write_file(self._get_directory(self.name), key, data)
+
+    def _get_directory (self, name):
+        """Return the directory of the imagecache name, creating it if needed.
+        """
+        directory=config.data.path['imagecache']
+        if not os.path.isdir (directory):
+            if os.path.exists (directory):
+                # File exists, but is not a directory.
+                raise Exception("Fatal error: %s should be a directory" % directory)
+            else:
+                os.mkdir (directory)
+
+        d = os.path.join (directory, name)
+
+        if not os.path.isdir (d):
+            if os.path.exists (d):
+                # File exists, but is not a directory.
+                raise Exception("Fatal error: %s should be a directory" % d)
+            else:
+                os.mkdir (d)
+        return d
+
+    def _get_pack (self, name):
+        """Return the SnapshotPack of the imagecache name, creating it if needed.
+        """
+        filename=pack_filename(name)
+        if self._pack is None or self._pack.filename != filename:
+            if not os.path.isdir(config.data.path['imagecache']):
+                os.mkdir (config.data.path['imagecache'])
+            self._pack=SnapshotPack(filename)
+        return self._pack
+
+    def __delitem__ (self, key):
+        self._release(key)
+        dict.__delitem__(self, key)
+        if key in self._valid:
+            self._valid.remove(key)
+            del self._valid_keys[bisect_left(self._valid_keys, key)]
+
+    def clear (self):
+        dict.clear(self)
+        self._valid.clear()
+        self._valid_keys=[]
+        self._resident.clear()
+        self.resident=0
+        self._remove_spill_dir()
+
+    def close (self):
+        """Release the disk resources of the imagecache.
+
+        Unsaved spilled snapshots are lost, and snapshots from the pack
+        cannot be read anymore.
+        """
+        self._remove_spill_dir()
+        if self._pack is not None:
+            self._pack.close()
+            self._pack=None
+
     def has_key (self, key):
         if key is None:
             return True
@@ -143,6 +617,7 @@ class ImageCache(dict):
         if key is None:
             return self.not_yet_available_image
         key = self.approximate(key)
+        self._touch(key)
         return dict.__getitem__(self, key)
 
     def get(self, key, epsilon=None):
@@ -158,6 +633,7 @@ class ImageCache(dict):
         if key is None:
             return self.not_yet_available_image
         key = self.approximate(key, epsilon)
+        self._touch(key)
         return dict.__getitem__(self, key)
 
     def __setitem__ (self, key, value):
@@ -173,20 +649,12 @@ class ImageCache(dict):
         if value != self.not_yet_available_image:
             self._modified=True
             if self.autosync and self.name is not None:
-                d=os.path.join(config.data.path['imagecache'], self.name)
-                if not os.path.isdir(d):
-                    os.mkdir (d)
-                filename=os.path.join(d, "%010d.png" % key)
-                f = open(filename, 'wb')
-                f.write (value)
-                f.close ()
-                value=CachedString(filename)
-                value.contenttype='image/png'
+                value=self._store(long(key), value)
             elif isinstance(value, basestring):
                 value=TypedString(value)
                 value.timestamp=key
                 value.contenttype='image/png'
-            return dict.__setitem__(self, key, value)
+            return self._set_valid(long(key), value)
         else:
             return self.not_yet_available_image
 
@@ -199,23 +667,24 @@ class ImageCache(dict):
         if key is None:
             return None
         key=long(key)
-        if dict.has_key(self, key) and dict.__getitem__(self, key) != self.not_yet_available_image:
+        if key in self._valid:
             return key
 
         if epsilon is None:
             epsilon=self.epsilon
-        valids = [ (pos, abs(pos-key))
-                   for pos in self.keys()
-                   if abs(pos - key) <= epsilon
-                   and dict.__getitem__(self, pos) != self.not_yet_available_image ]
-        valids.sort(key=operator.itemgetter(1))
-
-        if valids:
-            key = valids[0][0]
-#            print "Approximate key: %d (%d)" % valids[0]
-#            if len(valids) > 1:
-#                print "Imagecache: more than 1 valid snapshot for %d: %s" % (key,
-#                                                                              valids)
+        # Nearest valid snapshots are the neighbours of the insertion
+        # point in the sorted list of valid keys
+        keys=self._valid_keys
+        i=bisect_left(keys, key)
+        best=None
+        if i > 0 and key - keys[i - 1] <= epsilon:
+            best=keys[i - 1]
+        if i < len(keys) and keys[i] - key <= epsilon:
+            if best is None or keys[i] - key < key - best:
+                best=keys[i]
+
+        if best is not None:
+            key = best
         else:
             self.init_value (key)
 
@@ -232,8 +701,8 @@ class ImageCache(dict):
         if epsilon is None:
             epsilon=self.epsilon
         key = self.approximate(key, epsilon)
-        if dict.__getitem__(self, key) != self.not_yet_available_image:
-            dict.__setitem__(self, key, self.not_yet_available_image)
+        if key in self._valid:
+            self._set_missing(key)
         return key
 
     def missing_snapshots (self):
@@ -242,17 +711,15 @@ class ImageCache(dict):
         @return: a list of keys
         """
         return [ pos
-                 for pos in self.keys()
-                 if dict.__getitem__(self, pos) == self.not_yet_available_image ]
+                 for pos in self.iterkeys()
+                 if pos not in self._valid ]
 
     def valid_snapshots (self):
-        """Return the list of positions of valid snapshots.
+        """Return the sorted list of positions of valid snapshots.
 
         @return: a list of keys
         """
-        return [ pos
-                 for pos in self.keys()
-                 if dict.__getitem__(self, pos) != self.not_yet_available_image ]
+        return list(self._valid_keys)
 
     def is_initialized (self, key, epsilon=None):
         """Return True if the given key is initialized.
@@ -262,49 +729,48 @@ class ImageCache(dict):
         """
         if key is None:
             return False
-        key = self.approximate(key, epsilon)
-        if dict.__getitem__(self, key) == self.not_yet_available_image:
-            return False
-        else:
-            return True
+        return self.approximate(key, epsilon) in self._valid
 
     def save (self, name):
         """Save the content of the cache under a specified name (id).
 
-        The method creates a directory in some other directory
+        Depending on the storage attribute, the method creates a
+        directory or a SnapshotPack file in some other directory
         (config.data.path['imagecache']) and saves the content.
 
         @param name: the name
         @type name: string
-        @return: the created directory
+        @return: the created directory or file
         @rtype: string
         """
-        directory=config.data.path['imagecache']
-        if not os.path.isdir (directory):
-            if os.path.exists (directory):
-                # File exists, but is not a directory.
-                raise Exception("Fatal error: %s should be a directory" % directory)
-            else:
-                os.mkdir (directory)
-
-        d = os.path.join (directory, name)
-
-        if not os.path.isdir (d):
-            if os.path.exists (d):
-                # File exists, but is not a directory.
-                raise Exception("Fatal error: %s should be a directory" % d)
-            else:
-                os.mkdir (d)
-
-        for k in self.iterkeys():
+        if self.storage == 'pack':
+            pack=self._get_pack(name)
+            for k in self._valid_keys:
+                i=dict.__getitem__(self, k)
+                if isinstance(i, PackedString) and i._pack is pack:
+                    continue
+                dict.__setitem__(self, k, pack.append(k, i))
+                self._release(k)
+            if pack.needs_compaction():
+                pack.compact()
+            self._modified=False
+            return pack.filename
+
+        d=self._get_directory(name)
+        for k in self._valid_keys:
             i=dict.__getitem__(self, k)
-            if i == self.not_yet_available_image:
-                continue
+            filename=os.path.join (d, "%010d.png" % k)
             if isinstance(i, CachedString):
-                continue
-            f = open(os.path.join (d, "%010d.png" % k), 'wb')
+                if i._filename == filename:
+                    continue
+                # Spilled or loaded from another directory
+                i=str(i)
+            elif isinstance(i, PackedString):
+                i=str(i)
+            f = open(filename, 'wb')
             f.write (i)
             f.close ()
+            hot_cache.discard(filename)
 
         self._modified=False
         return d
@@ -316,14 +782,13 @@ class ImageCache(dict):
         @type name: string
         """
         d = os.path.join (config.data.path['imagecache'], name)
+        filename = pack_filename(name)
 
-        if not os.path.isdir (d):
-            # The cache directory does not exist
-            return
-        else:
+        items=[]
+        if os.path.isdir (d):
             self.name=name
-            for name in os.listdir (d):
-                (n, ext) = os.path.splitext(name)
+            for fname in os.listdir (d):
+                (n, ext) = os.path.splitext(fname)
                 # We must do some checks, in case there are non-well
                 # formatted filenames in the directory
                 if ext.lower() == '.png':
@@ -333,11 +798,17 @@ class ImageCache(dict):
                             n=0
                         i=long(n)
                     except ValueError:
-                        print "Invalid filename in imagecache: " + name
+                        print "Invalid filename in imagecache: " + fname
                         continue
-                    s=CachedString(os.path.join (d, name))
+                    s=CachedString(os.path.join (d, fname))
                     s.contenttype='image/png'
-                    dict.__setitem__(self, i, s)
+                    items.append( (i, s) )
+        if os.path.exists (filename):
+            # Snapshots from the pack supersede the ones from the directory
+            self.name=name
+            pack=self._get_pack(name)
+            items.extend( (i, pack.get(i)) for i in pack.index )
+        self._add_snapshots(items)
         self._modified=False
 
     def reset(self):
@@ -345,6 +816,11 @@ class ImageCache(dict):
         """
         for pos in self.keys():
             dict.__setitem__(self, pos, self.not_yet_available_image)
+        self._valid.clear()
+        self._valid_keys=[]
+        self._resident.clear()
+        self.resident=0
+        self._remove_spill_dir()
 
     def ids (self):
         """Return the list of currents ids.
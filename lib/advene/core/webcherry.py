@@ -56,6 +56,8 @@ from advene.model.view import View
 from advene.model.resources import Resources
 
 from advene.model.exception import AdveneException
+from advene.model.tal.context import template_cache
+from advene.core.imagecache import hot_cache
 
 import simpletal.simpleTAL
 import simpletal.simpleTALES as simpleTALES
@@ -912,6 +914,7 @@ class Admin(Common):
       - C{/admin/status} : display current status
       - C{/admin/display} : display or set the default webserver display mode
       - C{/admin/methods} : list the available global methods
+      - C{/admin/clear_template_cache} : clear the compiled template cache
       - C{/admin/halt} : halt the webserver
 
     Accessing the C{/admin} folder itself displays the summary
@@ -960,6 +963,9 @@ class Admin(Common):
         <p><a href="/admin/list">List available files</a></p>
         <p><a href="/packages">List loaded packages</a> (%(packagelist)s)</p>
         <p>Display mode : %(displaymode)s</p>
+        <p>Template cache : %(cachesize)d templates, %(cachehits)d hits, %(cachemisses)d misses (<a href="/admin/clear_template_cache">clear</a>)</p>
+        <p>Snapshot cache : %(hotsize)d kB read from disk, %(hothits)d hits, %(hotmisses)d misses</p>
+        <ul>%(imagecaches)s</ul>
         <hr>
         <p>Load a package :
         <form action="/admin/load" method="GET">
@@ -970,10 +976,31 @@ class Admin(Common):
         </body></html>
         """) % { 'packagelist': " | ".join( ['<a href="/packages/%s">%s</a>' % (alias, alias)
                                              for alias in self.controller.packages.keys() ] ),
-                 'displaymode': mode_sw })
+                 'displaymode': mode_sw,
+                 'cachesize': len(template_cache),
+                 'cachehits': template_cache.hits,
+                 'cachemisses': template_cache.misses,
+                 'hotsize': hot_cache.resident / 1024,
+                 'hothits': hot_cache.hits,
+                 'hotmisses': hot_cache.misses,
+                 'imagecaches': "".join( [ _("<li>%(alias)s: %(count)d snapshots, %(resident)d kB in memory, %(spills)d spilled to disk</li>") % {
+                        'alias': alias,
+                        'count': len(p.imagecache.valid_snapshots()),
+                        'resident': p.imagecache.resident / 1024,
+                        'spills': p.imagecache.spills }
+                                           for (alias, p) in self.controller.packages.iteritems()
+                                           if hasattr(p, 'imagecache') ] ) })
         return "".join(res)
     index.exposed=True
 
+    def clear_template_cache(self):
+        """Clear the compiled template cache.
+        """
+        template_cache.clear()
+        ref=cherrypy.request.headers.get('Referer', "/admin")
+        return self.send_redirect(ref)
+    clear_template_cache.exposed=True
+
     def list(self):
         """Display available Advene files.
 
@@ -3110,7 +3110,8 @@ class AdveneGUI(object):
                     if n.startswith('file://'):
                         n = n[7:]
                     n = n + '.backup' + e
-                    p.save(name=n)
+                    # Only append the modifications to the backup file
+                    p.save(name=n, append=True)
             return True
 
         if self.gui.win.get_title().endswith('(*)') ^ c.package._modified:
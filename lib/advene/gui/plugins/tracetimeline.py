@@ -455,7 +455,10 @@ class TraceTimeline(AdhocView):
             if not fname:
                 return True
             # FIXME: import_trace should return the trace reference,
-            self.tracer.import_trace(fname)
+            if fname.endswith('.log'):
+                self.tracer.import_event_log(fname)
+            else:
+                self.tracer.import_trace(fname)
             # Refresh combo box
             self.receive(self.tracer.traces[-1])
             self.trace_selector.set_active(len(self.tracer.traces) - 1)
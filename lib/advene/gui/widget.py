@@ -450,14 +450,15 @@ class AnnotationWidget(GenericColorButtonWidget):
             # The annotation contains a list of space-separated values
             # that should be treated as percentage (between 0.0 and
             # 100.0) of the height (FIXME: define a scale somewhere)
-            l=[ (1 - v / 100.0) for v in self.annotation.content.parsed() ]
-            s=len(l)
+            values=self.annotation.content.parsed()
+            s=len(values)
             if not s:
                 return
             if width < s:
                 # There are more samples than available pixels. Downsample the data
-                l=l[::(s/width)+1]
-                s=len(l)
+                values=values[::(s/width)+1]
+                s=len(values)
+            l=[ (1 - v / 100.0) for v in values ]
             w=1.0 * width / s
             c = 0
             context.set_source_rgba(0, 0, 0, .5)
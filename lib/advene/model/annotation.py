@@ -18,6 +18,8 @@
 #
 import time
 
+from xml.dom import Node
+
 import util.uri
 
 from util.auto_properties import auto_properties
@@ -32,6 +34,7 @@ from advene.model.constants import adveneNS
 
 from exception import AdveneException
 from fragment import fragmentFactory, unknownFragment
+from fragment import MillisecondFragment, ByteCountFragment
 
 from advene.model.util.defaultdict import DefaultDict
 
@@ -47,6 +50,36 @@ class Annotation(modeled.Importable, content.WithContent,
     def getLocalName(): return "annotation"
     getLocalName = staticmethod(getLocalName)
 
+    def _get_index_fields(element):
+        """Return the (type, begin, end, timed) fields of an annotation element.
+
+        They are read from the element as getType and getFragment do, so
+        that the package indexes can be built without creating the
+        annotations (see bundle.LazyXmlBundle). type is the stored form
+        of the type URI. begin and end are None if the fragment is not a
+        numeric one, timed is True for millisecond fragments.
+        """
+        children = [ n for n in element.childNodes
+                     if n.nodeType == Node.ELEMENT_NODE ]
+        # The fragment element follows the meta element, if any
+        for (i, n) in enumerate(children):
+            if n.namespaceURI == adveneNS and n.localName == "meta":
+                children = children[i + 1:]
+                break
+        begin = end = None
+        timed = False
+        if children:
+            f = children[0]
+            name = (f.namespaceURI, f.localName)
+            for cls in (MillisecondFragment, ByteCountFragment):
+                if name == (cls.getNamespaceUri(), cls.getLocalName()):
+                    begin = long(f.getAttributeNS(None, 'begin'))
+                    end = long(f.getAttributeNS(None, 'end'))
+                    timed = cls is MillisecondFragment
+                    break
+        return (element.getAttributeNS(None, "type"), begin, end, timed)
+    _get_index_fields = staticmethod(_get_index_fields)
+
     def __init__(self,                 # mode 1 & 2
                  parent,               # mode 1 & 2
                  element = None,       # mode 1, required
@@ -164,6 +197,7 @@ class Annotation(modeled.Importable, content.WithContent,
             type_uri = type.getUri (absolute=False, context=op)
             self._getModel().setAttributeNS(None, "type", type_uri)
             self._cached_type=type
+            op._annotation_changed(self)
         else:
             raise AdveneException("%s is not imported" % type.getUri ())
 
@@ -190,6 +224,8 @@ class Annotation(modeled.Importable, content.WithContent,
                             "(you probably want to clone it before)")
         old = self.__getFragmentElement()
         fragment._bound(old)
+        self.__fragment = None
+        self.getOwnerPackage()._annotation_changed(self)
 
     def delFragment(self):
         """Delete the fragment associated to this annotation"""
@@ -452,6 +488,7 @@ class Relation(modeled.Importable, content.WithContent,
         elif type in op.getRelationTypes():
             type_uri = type.getUri (absolute=False, context=op)
             self._getModel().setAttributeNS(None, "type", type_uri)
+            op._relation_changed(self)
         else:
             raise AdveneException("type %s is not imported" % type.getUri())
 
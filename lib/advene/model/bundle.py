@@ -58,6 +58,9 @@ Permitted dict operations are
 Note also that iter(b) iterates over its values (as for lists). Iterating over keys required the _iterkeys_ method.
 """
 
+import weakref
+from itertools import izip
+
 import advene.model.util.uri
 
 import advene.model.modeled as modeled
@@ -227,8 +230,12 @@ class SumBundle (AbstractBundle):
 
     def __iadd__ (self, bundle):
         assert isinstance (bundle, AbstractBundle)
-        self._list += bundle._list
-        self._dict.update (bundle._dict)
+        if isinstance (bundle, LazyXmlBundle):
+            self._list.extend (bundle)
+            self._dict.update (bundle.iteritems ())
+        else:
+            self._list += bundle._list
+            self._dict.update (bundle._dict)
         return self
 
 
@@ -465,8 +472,68 @@ class StandardXmlBundle(AbstractXmlBundle):
         FIXME
         """
         self.__cls = cls
+        self._indexes = []
         AbstractXmlBundle.__init__ (self, parent, element)
 
+    def _register_index (self, index):
+        """
+        Register an index to be kept in sync with the bundle content.
+
+        The index must implement the add(item) and remove(item) methods,
+        which are invoked whenever an item is inserted into or deleted from
+        the bundle.
+        """
+        self._indexes.append (index)
+
+    def __delitem__ (self, index):
+        item = self[index]
+        super (StandardXmlBundle, self).__delitem__ (index)
+        for i in self._indexes:
+            i.remove (item)
+
+    def insert (self, index, item):
+        super (StandardXmlBundle, self).insert (index, item)
+        for i in self._indexes:
+            i.add (item)
+
+    def _extend_elements (self, elements):
+        """
+        Append the items of the given DOM elements, in one pass.
+
+        The elements must not belong to the DOM yet. Return the list of the
+        item URIs.
+        """
+        base_uri = self._getParent ().getUri (absolute=True)
+        push = advene.model.util.uri.push
+        uris = [ push (base_uri, e.getAttributeNS (None, 'id'))
+                 for e in elements ]
+        if len (set (uris)) != len (uris):
+            raise AdveneException, _('duplicate ids in added items')
+        for uri in uris:
+            if uri in self._dict:
+                raise AdveneException, _('uri %s already in bundle') % uri
+
+        # Same position as successive appends (see insert)
+        elt_list = self._getModel ().childNodes
+        if self._list:
+            i = elt_list.index (self._get_element (self._list[-1])) + 1
+        else:
+            i = 0
+        elt_list[i:i] = elements
+
+        parent = self._getParent ()
+        items = [ self._make_item (parent, element=e) for e in elements ]
+        self._list.extend (items)
+        self._dict.update (izip (uris, items))
+
+        for index in self._indexes:
+            if hasattr (index, 'add_many'):
+                index.add_many (items)
+            else:
+                for item in items:
+                    index.add (item)
+        return uris
+
     def _get_namespace_uri (self):
         return self.__cls.getNamespaceUri ()
 
@@ -492,6 +559,344 @@ class StandardXmlBundle(AbstractXmlBundle):
 
 
 
+class LazyXmlBundle (StandardXmlBundle):
+    """
+    This extension of StandardXmlBundle creates its items on lookup.
+
+    The elements are indexed by their id attribute (_list holds the ids, and
+    _dict maps them to the elements). An item is created the first time it
+    is looked up, and only weakly cached afterwards, so that unused items
+    are reclaimed, and created again from their element when needed. Items
+    holding state which is not stored in their element (e.g. GUI state)
+    must be pinned (see pin).
+
+    The elements can also be provided by a store (see
+    advene.model.store.AnnotationStore): _dict then maps the ids of the
+    elements which were not created yet to their record in the store. The
+    created elements are appended to the tree, and the elements are
+    serialized in the order of the bundle (see _iter_sources).
+
+    The item class must have a _get_index_fields staticmethod (see
+    Annotation), so that the registered indexes can be built without
+    creating the items (see _iter_index_fields).
+    """
+
+    # Number of elements created at once by the store when iterating
+    chunk_size = 1000
+
+    def __init__ (self, parent, element, cls, store=None):
+        self.__cls = cls
+        self._store = store
+        self.__prefix = parent.getUri (absolute=True) + '#'
+        # id -> item
+        self.__items = weakref.WeakValueDictionary ()
+        self.__pinned = {}
+        # stored type URI -> absolute type URI
+        self.__type_uris = {}
+        StandardXmlBundle.__init__ (self, parent, element, cls)
+
+    def _update (self):
+        del self._list[:]
+        self._dict.clear ()
+
+        if self._store is not None:
+            ids = self._store.ids
+            self._list.extend (ids)
+            self._dict.update (izip (ids, xrange (len (ids))))
+            assert len (self._dict) == len (ids), "duplicate ids in the store"
+
+        ns = self._get_namespace_uri ()
+        ln = self._get_local_name ()
+        list_append = self._list.append
+        dict_append = self._dict.__setitem__
+
+        for e in self._getModelChildren ():
+            if e.namespaceURI != ns \
+            or e.localName !=ln:
+                continue
+            key = e.getAttributeNS (None, 'id')
+            assert key not in self._dict, "item %s already in bundle" % key
+            list_append (key)
+            dict_append (key, e)
+
+    def __key (self, uri):
+        """
+        Return the id of the item with the given URI, or None.
+        """
+        if isinstance (uri, basestring) and uri.startswith (self.__prefix):
+            key = uri[len (self.__prefix):]
+            if key in self._dict:
+                return key
+        return None
+
+    def _get_key_element (self, key):
+        """
+        Return the element of the given id, creating it if necessary.
+        """
+        element = self._dict[key]
+        if isinstance (element, int):
+            element = self._store.element (element, self._getModel ())
+            self._dict[key] = element
+        return element
+
+    def __create_elements (self, keys):
+        """
+        Create the elements of the given ids, in one pass.
+        """
+        records = [ (k, self._dict[k]) for k in keys
+                    if isinstance (self._dict[k], int) ]
+        if records:
+            elements = self._store.elements ([ r for (k, r) in records ],
+                                             self._getModel ())
+            for ((k, r), e) in izip (records, elements):
+                self._dict[k] = e
+
+    def _get_by_key (self, key):
+        """
+        Return the item of the given id, creating it if necessary.
+        """
+        item = self.__items.get (key)
+        if item is None:
+            item = self._make_item (self._getParent (),
+                                    element=self._get_key_element (key))
+            self.__items[key] = item
+        return item
+
+    def pin (self, item):
+        """
+        Keep a strong reference to the item, so that it is not reclaimed.
+        """
+        assert item in self, _('%s not in bundle') % item
+        self.__pinned[item.getId ()] = item
+
+    def unpin (self, item):
+        """
+        Release an item kept by pin.
+        """
+        if self.__pinned.get (item.getId ()) is item:
+            del self.__pinned[item.getId ()]
+
+    #
+    # index support
+    #
+
+    def __type_uri (self, type_):
+        try:
+            return self.__type_uris[type_]
+        except KeyError:
+            uri = advene.model.util.uri.urljoin (self.__prefix, type_)
+            self.__type_uris[type_] = uri
+            return uri
+
+    def _iter_index_fields (self, keys=None):
+        """
+        Iterate over the (id, type URI, begin, end, timed) fields of the
+        items with the given ids (default: all the items).
+
+        The fields are read from the elements, or from the store, without
+        creating the items.
+        """
+        if keys is None:
+            keys = self._list
+        get_fields = self.__cls._get_index_fields
+        type_uri = self.__type_uri
+        store = self._store
+        for key in keys:
+            element = self._dict[key]
+            fields = None
+            if isinstance (element, int):
+                fields = store.fields (element)
+                if fields is None:
+                    element = self._get_key_element (key)
+            if fields is None:
+                fields = get_fields (element)
+            t, b, e, timed = fields
+            yield (key, type_uri (t), b, e, timed)
+
+    def _item_fields (self, item):
+        """
+        Return the (id, type URI, begin, end, timed) fields of an item.
+        """
+        t, b, e, timed = self.__cls._get_index_fields (item._getModel ())
+        return (item.getId (), self.__type_uri (t), b, e, timed)
+
+    #
+    # read-only methods
+    #
+
+    def __contains__ (self, v):
+        if isinstance (v, basestring):
+            return self.__key (v) is not None
+        return self.__items.get (v.getId ()) is v
+
+    def __getitem__ (self, index):
+        if isinstance (index, int):
+            return self._get_by_key (self._list[index])
+        key = self.__key (index)
+        if key is None:
+            raise KeyError (index)
+        return self._get_by_key (key)
+
+    def index (self, element):
+        if element not in self:
+            raise ValueError, _('%s not in bundle') % element
+        return self._list.index (element.getId ())
+
+    def __getslice__ (self, begin, end):
+        keys = self._list[begin:end]
+        self.__create_elements (keys)
+        return ListBundle ([ self._get_by_key (k) for k in keys ])
+
+    def __iter__ (self):
+        keys = self._list
+        for i in xrange (0, len (keys), self.chunk_size):
+            chunk = keys[i:i + self.chunk_size]
+            self.__create_elements (chunk)
+            for k in chunk:
+                yield self._get_by_key (k)
+
+    def get (self, id_, default=None):
+        key = self.__key (id_)
+        if key is None:
+            return default
+        return self._get_by_key (key)
+
+    def has_key (self, key):
+        return self.__key (key) is not None
+
+    def items (self):
+        return list (self.iteritems ())
+
+    def iteritems (self):
+        return izip (self.iterkeys (), self)
+
+    def iterkeys (self):
+        prefix = self.__prefix
+        return ( prefix + k for k in self._list )
+
+    def itervalues (self):
+        return iter (self)
+
+    def ids (self):
+        return list (self._list)
+
+    def keys (self):
+        return list (self.iterkeys ())
+
+    uris = keys
+
+    def values (self):
+        return list (self)
+
+    def get_by_id (self, id_):
+        if id_ in self._dict:
+            return self._get_by_key (id_)
+        return None
+
+    def _iter_sources (self):
+        """
+        Iterate over the elements, in the order of the bundle.
+
+        The elements of the store which were not created yet are given by
+        their source, as unicode.
+        """
+        store = self._store
+        for key in self._list:
+            element = self._dict[key]
+            if isinstance (element, int):
+                yield store.text (element)
+            else:
+                yield element
+
+    #
+    # write methods
+    #
+
+    def __delitem__ (self, index):
+        if isinstance (index, int):
+            key = self._list[index]
+        else:
+            key = self.__key (index)
+            if key is None:
+                raise KeyError (index)
+        item = self._get_by_key (key)
+        self._list.remove (key)
+        element = self._dict.pop (key)
+        del self.__items[key]
+        self.__pinned.pop (key, None)
+        self._getModel ().removeChild (element)
+        for i in self._indexes:
+            i.remove (item)
+
+    def remove (self, item):
+        if item in self:
+            del self[self.__prefix + item.getId ()]
+            return
+        raise ValueError, _('%s not in bundle') % item
+
+    def __element_position (self, index):
+        """
+        Return the position in the tree of the element inserted at index.
+        """
+        elt_list = self._getModel ().childNodes
+        length = len (self._list)
+        if index < 0:
+            index += length
+        if length == 0:
+            return 0
+        elif index != length:
+            ref, offset = self._dict[self._list[index]], 0
+        else:
+            ref, offset = self._dict[self._list[-1]], 1
+        # As in AbstractXmlBundle.insert, but the elements of the store
+        # are not in the tree, or not at their position in the bundle
+        # (they are serialized in the order of the bundle)
+        for i, e in enumerate (elt_list):
+            if e is ref:
+                return i + offset
+        return len (elt_list)
+
+    def insert (self, index, item):
+        assert self._assert_add_item (item)
+
+        length = len (self)
+        if not (-length <= index <= length):
+            raise IndexError, (index, self._list)
+
+        key = item.getId ()
+        element = item._getModel ()
+        self._getModel ().childNodes.insert (self.__element_position (index),
+                                             element)
+        self._list.insert (index, key)
+        self._dict[key] = element
+        self.__items[key] = item
+        for i in self._indexes:
+            i.add (item)
+
+    def _extend_elements (self, elements):
+        keys = [ e.getAttributeNS (None, 'id') for e in elements ]
+        if len (set (keys)) != len (keys):
+            raise AdveneException, _('duplicate ids in added items')
+        for key in keys:
+            if key in self._dict:
+                raise AdveneException, _('uri %s already in bundle') % (self.__prefix + key)
+
+        i = self.__element_position (len (self._list))
+        self._getModel ().childNodes[i:i] = elements
+        self._list.extend (keys)
+        self._dict.update (izip (keys, elements))
+
+        for index in self._indexes:
+            index._add_fields (self._iter_index_fields (keys))
+        prefix = self.__prefix
+        return [ prefix + k for k in keys ]
+
+    def _assert_add_item (self, item):
+        assert item.getId () not in self._dict, \
+               "id %s already in bundle" % item.getId ()
+        return super (LazyXmlBundle, self)._assert_add_item (item)
+
+
 class ImportBundle (StandardXmlBundle):
     """
     This extension of StandardXmlBundle is able to manage imported item as well
@@ -589,6 +994,9 @@ class InverseDictBundle (StandardXmlBundle):
     i.e. a dict whose values are URIs and whose keys are given by the function
     inverse_key provided to the constructor. If None is provided, items
     themselves are used as keys.
+
+    The _revision attribute is incremented on every modification, so that
+    values computed from the inverse dictionnary can be cached.
     """
 
     def __init__ (self, parent, element, cls, inverse_key=None):
@@ -601,22 +1009,26 @@ class InverseDictBundle (StandardXmlBundle):
                 return x
             inverse_key = identity
         self.__inverse_key = inverse_key
+        self._revision = 0
         StandardXmlBundle.__init__ (self, parent, element, cls)
 
     def __delitem__ (self, index):
         item = self[index]
         super (InverseDictBundle, self).__delitem__ (index)
         del self.__inverse_dict[self.__inverse_key (item)]
+        self._revision += 1
 
     def insert (self, index, item):
         super (InverseDictBundle, self).insert (index, item)
         self.__inverse_dict[self.__inverse_key (item)] = item.getUri (
                                                                   absolute=True)
+        self._revision += 1
 
     def _make_item (self, parent=None, element=None):
         item = super (InverseDictBundle, self)._make_item (parent=parent, element=element)
         self.__inverse_dict[self.__inverse_key (item)] = item.getUri (
                                                                   absolute=True)
+        self._revision += 1
         return item
 
     def getInverseDict (self):
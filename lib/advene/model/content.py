@@ -16,8 +16,14 @@
 # along with Advene; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 #
+from array import array
+import base64
 from cStringIO import StringIO
+from collections import OrderedDict
+import sys
+import threading
 import urllib
+import weakref
 try:
     # In python2.6 stdlib
     import json
@@ -91,6 +97,171 @@ class StructuredContent(dict,object):
                           for (k, v) in self.iteritems()
                           if not k.startswith('_') )
 
+class ParsedCache(object):
+    """LRU cache of parsed contents (see Content.parsed).
+
+    Entries are stored for a content with the revision and the
+    mimetype of the content at parsing time, so that a modified
+    content never hits a stale value. Contents are weakly referenced,
+    so that the entries of unloaded packages are discarded. The size
+    of the cache is the total size of the source data of the entries.
+    """
+    def __init__(self, max_size=32 * 1024 * 1024):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # id(content) -> (weakref to content, revision, mimetype, value, size)
+        self._entries = OrderedDict()
+        # (id, weakref) of the collected contents. The weakref
+        # callbacks may be called at any time (possibly with the lock
+        # held), so the entries are removed by _purge.
+        self._collected = []
+        # The webserver accesses contents from multiple threads
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def hit_rate(self):
+        """Return the ratio of hits among the lookups.
+        """
+        total = self.hits + self.misses
+        if not total:
+            return 0.0
+        return float(self.hits) / total
+
+    def _purge(self):
+        """Remove the entries of the collected contents. The lock must be held.
+        """
+        while self._collected:
+            key, ref = self._collected.pop()
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] is ref:
+                del self._entries[key]
+                self.size -= entry[4]
+
+    def _remove(self, key):
+        """Remove an entry. The lock must be held.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[4]
+        return entry
+
+    def get(self, content, mimetype):
+        """Return a (found, value) tuple for the current revision of content.
+        """
+        self._lock.acquire()
+        try:
+            self._purge()
+            key = id(content)
+            entry = self._remove(key)
+            if (entry is None
+                or entry[0]() is not content
+                or entry[1] != content._revision
+                or entry[2] != mimetype):
+                self.misses += 1
+                return False, None
+            self.hits += 1
+            # Move it to the most recently used position
+            self._entries[key] = entry
+            self.size += entry[4]
+            return True, entry[3]
+        finally:
+            self._lock.release()
+
+    def put(self, content, mimetype, value, size):
+        """Store a parsed value, discarding the least recently used ones.
+        """
+        if size > self.max_size:
+            return
+        key = id(content)
+        collected = self._collected
+        def callback(ref):
+            collected.append( (key, ref) )
+        self._lock.acquire()
+        try:
+            self._purge()
+            self._remove(key)
+            self._entries[key] = (weakref.ref(content, callback), content._revision, mimetype, value, size)
+            self.size += size
+            while self.size > self.max_size:
+                self.size -= self._entries.popitem(last=False)[1][4]
+        finally:
+            self._lock.release()
+
+    def discard_package(self, package):
+        """Discard the entries of the contents of package.
+        """
+        self._lock.acquire()
+        try:
+            self._purge()
+            for key, entry in self._entries.items():
+                content = entry[0]()
+                if content is None or content.getOwnerPackage() is package:
+                    self._remove(key)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """Discard all entries and reset the counters.
+        """
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            del self._collected[:]
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
+        finally:
+            self._lock.release()
+
+parsed_cache = ParsedCache()
+
+# Encoding of the packed application/x-advene-values contents: the
+# data is the base64 representation of the values, as little-endian
+# float32 numbers.
+VALUES_ENCODING = 'x-advene-float32'
+
+def values_to_text(values):
+    """Return the legacy text form of x-advene-values data.
+    """
+    return u" ".join("%.7g" % v for v in values)
+
+def text_to_values(data):
+    """Convert the legacy text form of x-advene-values data to floats.
+    """
+    def convert(v):
+        try:
+            r=float(v)
+        except ValueError:
+            r=0
+        return r
+    return [ convert(v) for v in data.split() ]
+
+def pack_values(values):
+    """Return the packed form of a list of values.
+    """
+    a = array('f', values)
+    if sys.byteorder != 'little':
+        a.byteswap()
+    return base64.b64encode(a.tostring())
+
+def unpack_values(data):
+    """Return the array of float values stored in packed data.
+    """
+    a = array('f')
+    a.fromstring(base64.b64decode(data))
+    if sys.byteorder != 'little':
+        a.byteswap()
+    return a
+
+def is_textual(mt):
+    """Check if data of the given mimetype is textual.
+    """
+    return (mt.startswith('text') or 'x-advene' in mt or 'xml' in mt or 'javascript' in mt)
+
 class Content(modeled.Modeled,
               viewable.Viewable.withClass('content', 'getMimetype')):
     """
@@ -102,6 +273,9 @@ class Content(modeled.Modeled,
 
     __metaclass__ = auto_properties
 
+    # Incremented on each modification (see parsed)
+    _revision = 0
+
     def __init__(self, parent, element):
         modeled.Modeled.__init__(self, element, parent)
 
@@ -113,26 +287,41 @@ class Content(modeled.Modeled,
     def isTextual(self):
         """Check if the data is textual, according to mimetype
         """
-        mt = self.mimetype
-        return (mt.startswith('text') or 'x-advene' in mt or 'xml' in mt or 'javascript' in mt)
+        return is_textual(self.mimetype)
 
-    def getData(self):
-        """Return the data associated to the Content"""
+    def isPacked(self):
+        """Check if the data is stored as packed values (see setValues).
+        """
+        return self._getModel().getAttributeNS(None, 'encoding') == VALUES_ENCODING
+
+    def _getText(self):
+        """Return the stored (encoded) data."""
         data = StringIO()
         advene.model.util.dom.printElementText(self._getModel(), data)
+        return data.getvalue()
+
+    def getData(self):
+        """Return the data associated to the Content"""
+        data = self._getText()
         if self._getModel().hasAttributeNS(None, 'encoding'):
             encoding = self._getModel().getAttributeNS(None, 'encoding')
         else:
             encoding = 'utf-8'
-        d=data.getvalue().decode(encoding)
+        if encoding == VALUES_ENCODING:
+            # Return the legacy text form
+            return values_to_text(unpack_values(data))
+        d=data.decode(encoding)
         return d
 
     def setData(self, data):
         """Set the content's data"""
+        self._revision += 1
         # TODO: parse XML if any
         for n in self._getModel().childNodes:
             if n.nodeType in (TEXT_NODE, ELEMENT_NODE):
                 self._getModel().removeChild(n)
+        if not data and self.isPacked():
+            self._getModel().removeAttributeNS(None, 'encoding')
         if data:
             self.delUri()
             if not self.isTextual():
@@ -147,6 +336,31 @@ class Content(modeled.Modeled,
         """Delete the content's data"""
         self.setData(None)
 
+    def getValues(self):
+        """Return the values of an application/x-advene-values content.
+
+        Packed contents are decoded in an array of float32 (which
+        supports the buffer interface, for instance for
+        numpy.frombuffer), shared with Content.parsed.
+        """
+        if self.isPacked():
+            return self.parsed()
+        return array('f', self.parsed())
+
+    def setValues(self, values, packed=True):
+        """Set the values of an application/x-advene-values content.
+
+        If packed is True, they are stored as float32 values (see
+        VALUES_ENCODING) instead of the legacy text form.
+        """
+        if not packed:
+            self.setData(values_to_text(values))
+            return
+        self.setData(None)
+        self.delUri()
+        self._getModel().setAttributeNS(None, 'encoding', VALUES_ENCODING)
+        self._getModel().appendChild(self._getDocument().createTextNode(pack_values(values)))
+
     def getModel(self):
         data = self.getData()
         # FIXME: We should ensure that we can parse it as XML
@@ -177,6 +391,7 @@ class Content(modeled.Modeled,
 
     def setUri(self, uri):
         """Set the content's URI"""
+        self._revision += 1
         if uri is not None:
             self.delData()
             self._getModel().setAttributeNS(xlinkNS, 'xlink:href', uri)
@@ -212,6 +427,7 @@ class Content(modeled.Modeled,
 
     def setMimetype(self, value):
         """Set the content's mime-type"""
+        self._revision += 1
         if value is None and self._getModel().hasAttributeNS(None, 'mime-type'):
             self._getModel().removeAttributeNS(None, 'mime-type')
         else:
@@ -256,47 +472,77 @@ class Content(modeled.Modeled,
         It returns a Node object whose attributes are the different
         attributes and children of the node.
 
+        The parsed data is cached (see ParsedCache) and shared by
+        the callers, so it must not be modified.
+
         @return: a data structure
         """
-        # FIXME: the right way to implement this would be to subclass the Content
-        # into SimpleStructuredContent, XMLContent...
-        # but this would require changes all over the place. Use this for the moment.
-        if self.mimetype is None or self.mimetype == 'text/plain':
-            # If nothing is specified, assume text/plain and return the content data
+        mimetype = self.mimetype
+        if mimetype not in _parsers:
+            # If nothing is specified, assume text/plain and return
+            # the content data. It is also the last fallback.
             return self.data
 
-        if (self.mimetype in ( 'application/x-advene-structured',
-                               'text/x-advene-structured',
-                               'application/x-advene-zone' ) ):
-            return StructuredContent(self.data)
-        elif self.mimetype == 'application/json':
-            if json is not None:
-                return json.loads(self.data)
+        if self._getModel().hasAttributeNS(xlinkNS, 'href'):
+            # The data is stored in a resource, which may be modified
+            # without notice: do not cache it.
+            return _parsers[mimetype](self)
+
+        found, value = parsed_cache.get(self, mimetype)
+        if not found:
+            if self.isPacked():
+                # The parser decodes the stored data
+                value = _parsers[mimetype](self)
+                size = len(value) * 4    # float32 values
             else:
-                return {'data': self.data}
-        elif self.mimetype == 'application/x-advene-values':
-            def convert(v):
-                try:
-                    r=float(v)
-                except ValueError:
-                    r=0
-                return r
-            return [ convert(v) for v in self.data.split() ]
-        #FIXME: we parse x-advene-ruleset as xml for the moment
-        elif self.mimetype in ('text/xml',
-                               'application/x-advene-ruleset',
-                               'application/x-advene-simplequery'):
-            import advene.util.handyxml
-            h=advene.util.handyxml.xml(self.stream)
-            # FIXME: use a cache of DOM trees in order to avoid to
-            # repeatdly parse the same data in the case of repetitive
-            # access to the same element.
-            # FIXME: use ElementTree.iterparse
-
-            return h
-
-        # Last fallback:
-        return self.data
+                data = self.data
+                value = _parsers[mimetype](self, data)
+                size = len(data)
+            parsed_cache.put(self, mimetype, value, size)
+        return value
+
+# FIXME: the right way to implement this would be to subclass the Content
+# into SimpleStructuredContent, XMLContent...
+# but this would require changes all over the place. Use this for the moment.
+
+def _parse_structured(content, data=None):
+    if data is None:
+        data = content.data
+    return StructuredContent(data)
+
+def _parse_json(content, data=None):
+    if data is None:
+        data = content.data
+    if json is not None:
+        return json.loads(data)
+    else:
+        return {'data': data}
+
+def _parse_values(content, data=None):
+    if content.isPacked():
+        return unpack_values(content._getText())
+    if data is None:
+        data = content.data
+    return text_to_values(data)
+
+def _parse_xml(content, data=None):
+    import advene.util.handyxml
+    # FIXME: use ElementTree.iterparse
+    return advene.util.handyxml.xml(content.stream)
+
+# mimetype -> parser of Content.parsed, called with the content and its
+# data (None if it is stored in a resource or packed)
+_parsers = {
+    'application/x-advene-structured': _parse_structured,
+    'text/x-advene-structured': _parse_structured,
+    'application/x-advene-zone': _parse_structured,
+    'application/json': _parse_json,
+    'application/x-advene-values': _parse_values,
+    #FIXME: we parse x-advene-ruleset as xml for the moment
+    'text/xml': _parse_xml,
+    'application/x-advene-ruleset': _parse_xml,
+    'application/x-advene-simplequery': _parse_xml,
+    }
 
 class WithContent(object):
     """An implementation for the 'content' property and related properties.
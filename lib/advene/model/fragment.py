@@ -79,6 +79,11 @@ class AbstractNbeFragment (AbstractFragment, modeled.Modeled):
 
        Implements operators '==' and 'in' (for other ByteCountFragments and
        numbers).
+
+       The begin and end values are parsed from the model element on
+       first access, and then cached. Setting them updates both the
+       cache and the model element, so the DOM attributes must not be
+       modified directly.
     """
 
     __metaclass__ = auto_properties
@@ -97,6 +102,8 @@ class AbstractNbeFragment (AbstractFragment, modeled.Modeled):
             element = _PseudoElement()
             assert begin is not None, "begin is required"
         modeled.Modeled.__init__(self, element, parent)
+        self.__begin = None
+        self.__end = None
 
         if begin is not None:
             assert end is not None or duration is not None, \
@@ -122,16 +129,22 @@ class AbstractNbeFragment (AbstractFragment, modeled.Modeled):
         return "Begin-End (%d,%d)" % (self.getBegin(), self.getEnd())
 
     def getBegin(self):
-        return long(self._getModel().getAttributeNS(None, 'begin'))
+        if self.__begin is None:
+            self.__begin = long(self._getModel().getAttributeNS(None, 'begin'))
+        return self.__begin
 
     def setBegin(self, value):
-        return self._getModel().setAttributeNS(None, 'begin', unicode(long(value)))
+        self.__begin = long(value)
+        return self._getModel().setAttributeNS(None, 'begin', unicode(self.__begin))
 
     def getEnd(self):
-        return long(self._getModel().getAttributeNS(None, 'end'))
+        if self.__end is None:
+            self.__end = long(self._getModel().getAttributeNS(None, 'end'))
+        return self.__end
 
     def setEnd(self, value):
-        return self._getModel().setAttributeNS(None, 'end', unicode(long(value)))
+        self.__end = long(value)
+        return self._getModel().setAttributeNS(None, 'end', unicode(self.__end))
 
     def getDuration(self):
         return self.getEnd() - self.getBegin()
@@ -237,6 +250,23 @@ class MillisecondFragment(AbstractNbeFragment):
         # Format: HH:MM:SS.mmm
         return "%s.%03d" % (time.strftime("%H:%M:%S", time.gmtime(s)), ms)
 
+    def setBegin(self, value):
+        r = AbstractNbeFragment.setBegin(self, value)
+        self.__update_indexes()
+        return r
+
+    def setEnd(self, value):
+        r = AbstractNbeFragment.setEnd(self, value)
+        self.__update_indexes()
+        return r
+
+    def __update_indexes(self):
+        """Propagate the modification to the package indexes.
+        """
+        annotation = self._getParent()
+        if annotation is not None:
+            annotation.getOwnerPackage()._annotation_changed(annotation)
+
     def __str__(self):
         """Return a string representation of the Millisecond fragment"""
         return "Milliseconds (%s,%s)" % (self.format_time(self.getBegin()),
@@ -23,6 +23,8 @@ import os
 import sys
 import urllib
 import re
+import time
+import gc
 
 import xml.sax
 import xml.dom
@@ -34,15 +36,20 @@ from util.auto_properties import auto_properties
 import advene.core.config as config
 import _impl
 import advene.model.annotation as annotation
+import advene.model.content as content
 import advene.model.modeled as modeled
 import advene.model.query as query
 import advene.model.schema as schema
 import advene.model.view as view
 import advene.model.viewable as viewable
+from advene.model.timeindex import TimeIndex
+from advene.model.typeindex import TypeIndex, AnnotationTypeIndex
 from advene.model.zippackage import ZipPackage
+from advene.model.store import StreamingReader
+from advene.model.util.dom import writexml
 from advene.util.expat import PyExpat
 
-from advene.model.bundle import StandardXmlBundle, ImportBundle, InverseDictBundle, SumBundle
+from advene.model.bundle import StandardXmlBundle, LazyXmlBundle, ImportBundle, InverseDictBundle, SumBundle
 from advene.model.constants import adveneNS, xmlNS, xmlnsNS, xlinkNS, dcNS
 from advene.model.exception import AdveneException
 
@@ -67,11 +74,19 @@ class Package(modeled.Modeled, viewable.Viewable.withClass('package'),
 
     __metaclass__ = auto_properties
 
-    def __init__(self, uri, source=_get_from_uri, importer=None):
+    def __init__(self, uri, source=_get_from_uri, importer=None, loader=None):
         """Calling the constructor with just a URI tries to read the package
            from this URI. This can be overidden by providing explicitly the
-           source parameter (a URL or a stream).
+           source parameter (a URL, a stream, or a ZipPackage already
+           expanded from the URI).
            Providing None for the source parameter creates a new Package.
+
+           The loader parameter selects the loading engine:
+             - 'dom' (default) parses the whole document into a DOM tree
+             - 'streaming' scans the document with expat, and keeps the
+               annotations unparsed in a compact store. Their DOM elements
+               are built when they are looked up (see advene.model.store).
+           Imported packages use the same loader as their importer.
         """
         self.meta_cache={}
         if isinstance(uri, unicode):
@@ -82,6 +97,18 @@ class Package(modeled.Modeled, viewable.Viewable.withClass('package'),
             uri=urllib.pathname2url(uri)
         self.__uri = uri
         self.__importer = importer
+        if loader is None:
+            if importer is not None:
+                loader = importer.__loader
+            else:
+                loader = 'dom'
+        if loader == 'dom':
+            reader = PyExpat.Reader()
+        elif loader == 'streaming':
+            reader = StreamingReader()
+        else:
+            raise AdveneException("Unknown package loader: %s" % loader)
+        self.__loader = loader
         # Possible container
         self.__zip = None
         abs_uri = self.getUri (absolute=True)
@@ -95,8 +122,11 @@ class Package(modeled.Modeled, viewable.Viewable.withClass('package'),
         element = None
         if source is None:
             element = self._make_model()
+        elif isinstance(source, ZipPackage):
+            self.__zip = source
+            f=urllib.pathname2url(self.__zip.getContentsFile())
+            element = reader.fromUri("file://" + f).documentElement
         else:
-            reader = PyExpat.Reader()
             if source is _get_from_uri:
                 # Determine the package format (plain XML or AZP)
                 # FIXME: should be done by content rather than extension
@@ -127,6 +157,9 @@ class Package(modeled.Modeled, viewable.Viewable.withClass('package'),
                 else:
                     element = reader.fromUri(source_uri).documentElement
 
+        # Annotations left out of the DOM tree by the streaming loader
+        self.__store = getattr(reader, 'store', None)
+
         modeled.Modeled.__init__(self, element, None)
 
         self.__imports = None
@@ -135,6 +168,10 @@ class Package(modeled.Modeled, viewable.Viewable.withClass('package'),
         self.__relations = None
         self.__schemas = None
         self.__views = None
+        self.__time_index = None
+        self.__annotation_type_index = None
+        self.__relation_type_index = None
+        self.__namespaces = None
 
     def close(self):
         if self.__zip:
@@ -223,13 +260,158 @@ class Package(modeled.Modeled, viewable.Viewable.withClass('package'),
             self.__imports = InverseDictBundle (self, e, Import, Import.getAlias)
         return self.__imports
 
+    def _get_namespaces(self):
+        """Return the namespace dict used to resolve QNames in this package.
+
+        Keys are import aliases (and '' for the package itself), values
+        are URIs. The dict is cached until the imports are modified, so
+        it must not be modified by the caller.
+        """
+        imports = self.getImports()
+        if (self.__namespaces is None
+            or self.__namespaces[0] != imports._revision):
+            ns_dict = imports.getInverseDict()
+            ns_dict[''] = self.getUri(absolute=True)
+            self.__namespaces = (imports._revision, ns_dict)
+        return self.__namespaces[1]
+
     def getAnnotations(self):
-        """Return a collection of this package's annotations"""
+        """Return a collection of this package's annotations
+
+        The annotations are created on lookup (see LazyXmlBundle).
+        """
         if self.__annotations is None:
             e = self._getChild((adveneNS, "annotations"))
-            self.__annotations = StandardXmlBundle(self, e, annotation.Annotation)
+            self.__annotations = LazyXmlBundle(self, e, annotation.Annotation,
+                                               store=self.__store)
         return self.__annotations
 
+    def getTimeIndex(self):
+        """Return the temporal index of this package's annotations"""
+        if self.__time_index is None:
+            annotations = self.getAnnotations()
+            self.__time_index = TimeIndex(annotations)
+            annotations._register_index(self.__time_index)
+        return self.__time_index
+
+    def _get_annotation_type_index(self):
+        """Return the index of this package's annotations by type"""
+        if self.__annotation_type_index is None:
+            annotations = self.getAnnotations()
+            self.__annotation_type_index = AnnotationTypeIndex(annotations)
+            annotations._register_index(self.__annotation_type_index)
+        return self.__annotation_type_index
+
+    def _get_relation_type_index(self):
+        """Return the index of this package's relations by type"""
+        if self.__relation_type_index is None:
+            relations = self.getRelations()
+            self.__relation_type_index = TypeIndex(relations)
+            relations._register_index(self.__relation_type_index)
+        return self.__relation_type_index
+
+    def _annotation_changed(self, annotation):
+        """Update the indexes after an annotation type or fragment modification"""
+        if self.__time_index is not None:
+            self.__time_index.update(annotation)
+        if self.__annotation_type_index is not None:
+            self.__annotation_type_index.update(annotation)
+
+    def _relation_changed(self, relation):
+        """Update the indexes after a relation type modification"""
+        if self.__relation_type_index is not None:
+            self.__relation_type_index.update(relation)
+
+    def createAnnotations(self, records):
+        """Create annotations and append them to the package, in one pass.
+
+        records is an iterable of dictionaries with the following keys:
+          - type: the annotation type (mandatory)
+          - begin, end: the fragment bounds, in ms (mandatory)
+          - ident, author, date: optional
+          - data: the content data (optional)
+
+        The result is the same as creating each annotation with
+        createAnnotation and appending it to self.annotations, but the
+        DOM elements are built directly, and the annotations bundle and
+        indexes are updated once.
+
+        @return: the list of the URIs of the created annotations
+        """
+        doc = self._getDocument()
+        annotation_types = self.getAnnotationTypes()
+        # type -> (type uri, content mimetype)
+        types = {}
+        elements = []
+        # The cyclic garbage collector is triggered by the allocation
+        # of the DOM nodes and items, and scans all the objects each
+        # time: suspend it while building and adding the elements.
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for r in records:
+                elements.append(self.__build_annotation(doc, r, types, annotation_types))
+            return self.getAnnotations()._extend_elements(elements)
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    def __build_annotation(self, doc, r, types, annotation_types):
+        """Build the DOM element of an annotation record (see createAnnotations)"""
+        t = r['type']
+        try:
+            type_uri, mimetype = types[t]
+        except KeyError:
+            if not t in annotation_types:
+                raise AdveneException("%s is not imported" % t.getUri ())
+            type_uri = t.getUri(absolute=False, context=self)
+            mimetype = t.getMimetype()
+            types[t] = (type_uri, mimetype)
+
+        e = doc.createElementNS(adveneNS, "annotation")
+        ident = r.get('ident')
+        if ident is None:
+            # Same scheme as Annotation.__init__
+            ident = u"a" + unicode(id(e)) + unicode(time.clock()).replace('.','')
+        e.setAttributeNS(None, "id", unicode(ident))
+        e.setAttributeNS(None, "type", type_uri)
+        author = r.get('author')
+        if author is not None:
+            e.setAttributeNS(dcNS, "dc:creator", author)
+        date = r.get('date')
+        if date is not None:
+            e.setAttributeNS(dcNS, "dc:date", unicode(date))
+
+        f = doc.createElementNS(adveneNS, "millisecond-fragment")
+        f.setAttributeNS(None, "begin", unicode(long(r['begin'])))
+        f.setAttributeNS(None, "end", unicode(long(r['end'])))
+        e.appendChild(f)
+
+        if 'data' in r:
+            c = doc.createElementNS(adveneNS, "content")
+            data = r['data']
+            if data:
+                if content.is_textual(mimetype):
+                    encoding = 'utf-8'
+                else:
+                    encoding = 'base64'
+                c.setAttributeNS(None, "encoding", encoding)
+                c.appendChild(doc.createTextNode(data.encode(encoding)))
+            e.appendChild(c)
+        return e
+
+    def annotations_at(self, t):
+        """Return the annotations active at time t, sorted by begin time"""
+        return [ a for (a, b, e) in self.getTimeIndex().annotations_at(t) ]
+
+    def annotations_between(self, begin, end):
+        """Return the annotations overlapping [begin, end], sorted by begin time"""
+        return [ a for (a, b, e) in self.getTimeIndex().annotations_between(begin, end) ]
+
+    def next_begins_after(self, t, n=1):
+        """Return the n first annotations beginning strictly after t"""
+        return [ a for (a, b, e) in self.getTimeIndex().next_begins_after(t, n) ]
+
     def getRelations(self):
         """Return a collection of this package's relations"""
         if self.__relations is None:
@@ -314,11 +496,34 @@ class Package(modeled.Modeled, viewable.Viewable.withClass('package'),
         return out
 
     def serialize(self, stream=sys.stdout):
-        """Serialize the Package on the specified stream"""
-        stream.write(self._getModel().toxml(encoding='utf8'))
+        """Serialize the Package on the specified stream
 
-    def save(self, name=None):
-        """Save the Package in the specified file"""
+        The XML is written as it is generated, it is never built as
+        a whole in memory.
+        """
+        children = None
+        if self.__store is not None:
+            # The annotations of the store are written from their
+            # source, unless their element was built.
+            e = self._getChild((adveneNS, "annotations"))
+            children = { e: self.__annotations_children(e) }
+        writexml(self._getModel(), stream, encoding='utf8', children=children)
+
+    def __annotations_children(self, element):
+        """Iterate over the nodes to serialize in the annotations element"""
+        for n in self.getAnnotations()._iter_sources():
+            yield n
+        for n in element.childNodes:
+            if not (n.nodeType == n.ELEMENT_NODE and n.namespaceURI == adveneNS
+                    and n.localName == "annotation"):
+                yield n
+
+    def save(self, name=None, append=False):
+        """Save the Package in the specified file
+
+        For .azp files, append=True appends the modified data to the
+        file, when it was the last saved file (see ZipPackage.save).
+        """
         if name is None:
             name=self.__uri
         if name.startswith('file:///'):
@@ -342,12 +547,13 @@ class Package(modeled.Modeled, viewable.Viewable.withClass('package'),
             stream = open (self.__zip.getContentsFile(), "w")
             self.serialize(stream)
             stream.close ()
+            self.__zip.set_modified('content.xml')
 
             # Generate the statistics
             self.__zip.update_statistics(self)
 
-            # Save the whole .azp
-            self.__zip.save(name)
+            # Save the .azp
+            self.__zip.save(name, append=append)
         else:
             # Assuming plain XML format
             stream = open (name, "w")
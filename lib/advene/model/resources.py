@@ -69,6 +69,7 @@ class ResourceData(viewable.Viewable.withClass('data', 'getMimetype')):
         f=open(self.file_, 'wb')
         f.write(data)
         f.close()
+        self.package.set_modified('resources/' + self.resourcepath)
 
     def getMimetype(self):
         if self._mimetype is None:
@@ -193,6 +194,11 @@ class Resources:
             f=open(fname, 'wb')
             f.write(item)
             f.close()
+            if self.resourcepath == '':
+                p=key
+            else:
+                p='/'.join( (self.resourcepath, key) )
+            self.package.set_modified('resources/' + p)
 
 
     def __delitem__(self, key):
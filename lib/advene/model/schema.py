@@ -191,10 +191,8 @@ class AnnotationType(AbstractType,
     getLocalName = staticmethod(getLocalName)
 
     def getAnnotations (self):
-        # FIXME: return an iterator instead of a full fledged list
-        return sorted((a for a in self.getRootPackage ().getAnnotations ()
-                       if a.getType() == self),
-                      key=lambda a: a.fragment.begin)
+        """Return the annotations of this type, sorted by begin time"""
+        return self.getRootPackage ()._get_annotation_type_index ().get (self)
 
 class RelationType(AbstractType,
                    viewable.Viewable.withClass('relation-type')):
@@ -246,9 +244,8 @@ class RelationType(AbstractType,
     getLocalName = staticmethod(getLocalName)
 
     def getRelations (self):
-        # FIXME: return an iterator instead of a full fledged list
-        return [ a for a in self.getRootPackage ().getRelations ()
-                   if a.getType() == self ]
+        """Return the relations of this type"""
+        return self.getRootPackage ()._get_relation_type_index ().get (self)
 
     def getHackedMemberTypes (self):
         """
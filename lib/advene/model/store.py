@@ -0,0 +1,307 @@
+#
+# Advene: Annotate Digital Videos, Exchange on the NEt
+# Copyright (C) 2008-2012 Olivier Aubert <olivier.aubert@liris.cnrs.fr>
+#
+# Advene is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Advene is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Advene; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+"""Streaming package reader, keeping the annotations unparsed.
+
+The StreamingReader scans a package with expat. Each annotation is stored
+in an AnnotationStore as a compact (id, type, begin, end, offset) record,
+which is enough to build the package indexes, and is left out of the DOM
+tree. Its DOM element is only built from its source when the annotation
+is looked up (see bundle.LazyXmlBundle).
+"""
+
+import re
+from array import array
+from itertools import izip
+from urllib2 import urlopen
+
+from xml.dom import XMLNS_NAMESPACE
+from xml.dom.minidom import parseString
+from xml.dom.expatbuilder import FragmentBuilderNS
+from xml.parsers import expat
+from xml.sax.saxutils import quoteattr
+
+from advene.model.constants import adveneNS
+from advene.model.fragment import MillisecondFragment, ByteCountFragment
+
+# Kinds of annotation fragments
+_UNKNOWN = -1       # not read, the element must be built
+_NONE = 0           # not a numeric fragment
+_MILLISECOND = 1
+_BYTECOUNT = 2
+
+# Element names, as reported by expat with a ' ' namespace separator
+_PACKAGE = adveneNS + " package"
+_ANNOTATIONS = adveneNS + " annotations"
+_ANNOTATION = adveneNS + " annotation"
+_META = adveneNS + " meta"
+_KINDS = {
+    MillisecondFragment.getNamespaceUri() + " " + MillisecondFragment.getLocalName(): _MILLISECOND,
+    ByteCountFragment.getNamespaceUri() + " " + ByteCountFragment.getLocalName(): _BYTECOUNT,
+    }
+
+_qname = re.compile(r'[^\s/>]+')
+
+class AnnotationStore(object):
+    """Compact store of unparsed annotation elements.
+
+    The annotations are designated by their record number. data is the
+    (encoded) source of the package, the source of each annotation is
+    located by its offset and length in data.
+    """
+    def __init__(self, data, encoding='utf-8'):
+        self.data = data
+        self.encoding = encoding
+        self.ids = []
+        # Distinct values of the type attribute
+        self.types = []
+        self.__type_codes = {}
+        self.type_codes = array('i')
+        self.begins = array('l')
+        self.ends = array('l')
+        self.kinds = array('b')
+        self.offsets = array('l')
+        self.lengths = array('l')
+
+    def __len__(self):
+        return len(self.ids)
+
+    def append(self, ident, type_, begin, end, kind, offset, length):
+        """Append the record of an annotation.
+        """
+        try:
+            code = self.__type_codes[type_]
+        except KeyError:
+            code = len(self.types)
+            self.types.append(type_)
+            self.__type_codes[type_] = code
+        self.ids.append(ident)
+        self.type_codes.append(code)
+        self.begins.append(begin)
+        self.ends.append(end)
+        self.kinds.append(kind)
+        self.offsets.append(offset)
+        self.lengths.append(length)
+
+    def fields(self, i):
+        """Return the (type, begin, end, timed) fields of record i.
+
+        See Annotation._get_index_fields. None is returned if the fragment
+        could not be read while scanning.
+        """
+        kind = self.kinds[i]
+        if kind == _UNKNOWN:
+            return None
+        type_ = self.types[self.type_codes[i]]
+        if kind == _NONE:
+            return (type_, None, None, False)
+        return (type_, self.begins[i], self.ends[i], kind == _MILLISECOND)
+
+    def source(self, i):
+        """Return the (encoded) source of record i.
+        """
+        offset = self.offsets[i]
+        return self.data[offset:offset + self.lengths[i]]
+
+    def text(self, i):
+        """Return the source of record i, as unicode.
+        """
+        return self.source(i).decode(self.encoding)
+
+    def element(self, i, context):
+        """Build the DOM element of record i (see elements).
+        """
+        return self.elements([ i ], context)[0]
+
+    def elements(self, records, context):
+        """Build the DOM elements of the given records, in one pass.
+
+        They are appended to context (the annotations element).
+        """
+        header = '<?xml version="1.0" encoding="%s"?>' % self.encoding
+        fragment = _FragmentBuilder(context).parseString(
+            header + "".join(self.source(i) for i in records))
+        # Move the nodes without going through fragment.removeChild,
+        # which is linear
+        nodes = fragment.childNodes[:]
+        del fragment.childNodes[:]
+        for n in nodes:
+            n.parentNode = None
+            context.appendChild(n)
+        return nodes
+
+class _FragmentBuilder(FragmentBuilderNS):
+    """Fragment builder declaring the namespaces in scope at the context node.
+
+    minidom keeps the namespace declarations as xmlns attributes, which
+    FragmentBuilderNS does not look for.
+    """
+    def _getNSattrs(self):
+        decls = {}
+        node = self.context
+        while node is not None and node.nodeType == node.ELEMENT_NODE:
+            for a in node.attributes.values():
+                if a.namespaceURI == XMLNS_NAMESPACE and not a.name in decls:
+                    decls[a.name] = a.value
+            node = node.parentNode
+        return " ".join("%s=%s" % (name, quoteattr(value))
+                        for (name, value) in sorted(decls.iteritems()))
+
+class _Scanner(object):
+    """Scan the source of a package, storing its annotations.
+
+    Only the annotations with an id, which are not empty elements, are
+    stored.
+    """
+    def __init__(self, data):
+        self.data = data
+        self.store = AnnotationStore(data)
+        self.depth = 0
+        self.in_package = False
+        self.in_annotations = False
+        # Current annotation: (id, type, offset), and its fragment
+        # child, as (name, attributes)
+        self.record = None
+        self.fragment = None
+        self.meta = False
+        self.after_meta = False
+
+    def scan(self):
+        p = expat.ParserCreate(namespace_separator=' ')
+        p.XmlDeclHandler = self.xml_decl
+        p.StartElementHandler = self.start_element
+        p.EndElementHandler = self.end_element
+        self.parser = p
+        p.Parse(self.data, True)
+        self.parser = None
+        return self.store
+
+    def xml_decl(self, version, encoding, standalone):
+        if encoding:
+            self.store.encoding = encoding
+
+    def start_element(self, name, attributes):
+        depth = self.depth
+        self.depth += 1
+        if depth == 3:
+            if self.record is not None:
+                self.child(name, attributes)
+        elif depth == 2:
+            if (self.in_annotations and name == _ANNOTATION
+                and 'id' in attributes):
+                self.record = (attributes['id'], attributes.get('type', u''),
+                               self.parser.CurrentByteIndex)
+                self.fragment = None
+                self.meta = self.after_meta = False
+        elif depth == 1:
+            self.in_annotations = self.in_package and name == _ANNOTATIONS
+        else:
+            self.in_package = name == _PACKAGE
+
+    def child(self, name, attributes):
+        # As in Annotation._get_index_fields: the fragment is the first
+        # child, or the child following the meta element.
+        if self.after_meta:
+            self.fragment = (name, attributes)
+            self.after_meta = False
+        elif name == _META and not self.meta:
+            self.fragment = None
+            self.meta = self.after_meta = True
+        elif not self.meta and self.fragment is None:
+            self.fragment = (name, attributes)
+
+    def end_element(self, name):
+        self.depth -= 1
+        if self.depth == 2 and self.record is not None:
+            self.end_record()
+            self.record = None
+
+    def end_record(self):
+        ident, type_, offset = self.record
+        data = self.data
+        index = self.parser.CurrentByteIndex
+        # For an empty element, the index is after the start tag
+        # rather than at the end tag. It is kept in the DOM tree.
+        qname = _qname.match(data, offset + 1).group()
+        if (not data.startswith('</' + qname, index)
+            or not data[index + len(qname) + 2] in '> \t\r\n'):
+            return
+        length = data.index('>', index) + 1 - offset
+
+        kind = _NONE
+        begin = end = 0
+        if self.fragment is not None:
+            name, attributes = self.fragment
+            kind = _KINDS.get(name, _NONE)
+            if kind != _NONE:
+                try:
+                    begin = long(attributes['begin'])
+                    end = long(attributes['end'])
+                except (KeyError, ValueError):
+                    kind = _UNKNOWN
+                    begin = end = 0
+        self.store.append(ident, type_, begin, end, kind, offset, length)
+
+    def remaining(self):
+        """Iterate over the parts of the source which are not stored.
+
+        The whitespace between consecutive annotations is dropped.
+        """
+        data = self.data
+        store = self.store
+        position = 0
+        for (offset, length) in izip(store.offsets, store.lengths):
+            gap = data[position:offset]
+            if position == 0 or gap.strip():
+                yield gap
+            position = offset + length
+        yield data[position:]
+
+class StreamingReader(object):
+    """Package reader keeping the annotations unparsed.
+
+    It has the same interface as advene.util.expat.PyExpat.Reader. The
+    store attribute holds the AnnotationStore of the annotations which
+    were left out of the returned DOM tree, or None.
+    """
+    def __init__(self):
+        self.store = None
+
+    def fromUri(self, uri):
+        f = urlopen(uri)
+        try:
+            return self.fromString(f.read())
+        finally:
+            f.close()
+
+    def fromStream(self, source):
+        return self.fromString(source.read())
+
+    def fromString(self, s):
+        self.store = None
+        if (isinstance(s, unicode)
+            or s[:2] in ('\xff\xfe', '\xfe\xff') or '\x00' in s[:4]):
+            # The annotations are located by their byte offsets, in
+            # an ASCII-compatible encoding
+            return parseString(s)
+        scanner = _Scanner(s)
+        store = scanner.scan()
+        if not len(store):
+            return parseString(s)
+        self.store = store
+        return parseString("".join(scanner.remaining()))
@@ -17,8 +17,15 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 #
 import sys
+import threading
 
 from cStringIO import StringIO
+from collections import OrderedDict
+from types import InstanceType
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
 
 from simpletal import simpleTAL
 from simpletal import simpleTALES
@@ -65,6 +72,199 @@ class NoCallVariable(simpleTALES.ContextVariable):
         def value (self, currentPath=None):
                 return self.ourValue
 
+class TemplateCache(object):
+    """LRU cache of compiled simpleTAL templates.
+
+    Templates are stored with a (uri, kind, digest) key, where uri is
+    the URI of the view (or None), kind is 'html' or 'xml' and digest
+    is the md5 digest of the template source. A modified view thus
+    never hits a stale template; the invalidate method is used to
+    release the templates of a modified view.
+    """
+    def __init__(self, size=64):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._templates = OrderedDict()
+        # The webserver renders views from multiple threads
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._templates)
+
+    def get(self, key):
+        """Return the template stored for key, or None.
+        """
+        self._lock.acquire()
+        try:
+            template = self._templates.pop(key, None)
+            if template is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                # Move it to the most recently used position
+                self._templates[key] = template
+            return template
+        finally:
+            self._lock.release()
+
+    def put(self, key, template):
+        """Store a template, discarding the least recently used ones.
+        """
+        self._lock.acquire()
+        try:
+            self._templates.pop(key, None)
+            self._templates[key] = template
+            while len(self._templates) > self.size:
+                self._templates.popitem(last=False)
+        finally:
+            self._lock.release()
+
+    def invalidate(self, uri):
+        """Discard the templates of the view with the given URI.
+        """
+        self._lock.acquire()
+        try:
+            for key in [ k for k in self._templates if k[0] == uri ]:
+                del self._templates[key]
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """Discard all templates and reset the counters.
+        """
+        self._lock.acquire()
+        try:
+            self._templates.clear()
+            self.hits = 0
+            self.misses = 0
+        finally:
+            self._lock.release()
+
+template_cache = TemplateCache()
+
+# Dependency recording (see record_dependencies), per thread since the
+# webserver renders views from multiple threads
+_recorder = threading.local()
+# class -> kind of value (see _value_kind)
+_value_kinds = {}
+_ELEMENT, _XMLBUNDLE, _LIST, _VARIABLE, _OTHER = range(5)
+
+def record_dependencies(dependencies):
+    """Record the annotations and relations traversed by TALES paths.
+
+    The annotations and relations traversed in the current thread (as
+    path items, or items of a traversed list) are added to the
+    dependencies set, which may also receive other list items that
+    the caller should ignore. '*' is added if the whole annotations
+    bundle is traversed, and recording stops. Use None to stop
+    recording.
+
+    Simple queries are evaluated through TALES paths, so that their
+    dependencies are recorded. Note that python: expressions are not
+    recorded.
+    """
+    _recorder.dependencies = dependencies
+
+def _value_kind(val):
+    """Return the kind of a value, for dependency recording.
+    """
+    cls = type(val)
+    if cls is InstanceType:
+        # Old-style class instance, such as ContextVariable
+        cls = val.__class__
+    try:
+        return _value_kinds[cls]
+    except KeyError:
+        pass
+    # Imported here to avoid a circular import
+    from advene.model.annotation import Annotation, Relation
+    from advene.model.bundle import AbstractBundle, AbstractXmlBundle
+    if issubclass(cls, (Annotation, Relation)):
+        kind = _ELEMENT
+    elif issubclass(cls, AbstractXmlBundle):
+        kind = _XMLBUNDLE
+    elif issubclass(cls, (list, tuple, AbstractBundle)):
+        kind = _LIST
+    elif issubclass(cls, simpleTALES.ContextVariable):
+        kind = _VARIABLE
+    else:
+        kind = _OTHER
+    _value_kinds[cls] = kind
+    return kind
+
+def _record(dependencies, val, bundles=True):
+    """Record the dependencies on the value of a path item.
+
+    The annotations bundle is ignored if bundles is False, i.e. when
+    the value is only used to access one of its items.
+    """
+    if '*' in dependencies:
+        # Depends on everything
+        return
+    kind = _value_kind(val)
+    if kind == _VARIABLE:
+        val = val.rawValue()
+        kind = _value_kind(val)
+    if kind == _ELEMENT:
+        dependencies.add(val)
+    elif kind == _LIST:
+        # Other items are filtered out by the caller of
+        # record_dependencies, which is faster than checking each item
+        try:
+            dependencies.update(val)
+        except TypeError:
+            # Unhashable items
+            dependencies.update(e for e in val if _value_kind(e) == _ELEMENT)
+    elif kind == _XMLBUNDLE:
+        if bundles and val._getModel().localName == 'annotations':
+            dependencies.add('*')
+
+def _record_access(dependencies, obj, path, val):
+    """Record the dependencies on obj, whose path item is val.
+    """
+    # Accessing an item of a bundle by its id only depends on the item
+    item = _value_kind(val) == _ELEMENT and val.getId() == path
+    _record(dependencies, obj, not item)
+
+# Compiled path expressions: expr -> (pathList, steps)
+_compiled_paths = {}
+_COMPILED_PATHS_SIZE = 10000
+
+def compile_path(expr):
+    """Compile a TALES path expression.
+
+    Return a (pathList, steps) tuple, where pathList is the list of the
+    path items (as expected by simpleTALES.ContextVariable.value) and
+    steps is a tuple of (name, dereference) couples, dereference being
+    True for ?variable items. Compiled expressions are cached.
+    """
+    try:
+        return _compiled_paths[expr]
+    except KeyError:
+        pass
+    e = expr
+    # Check for and correct for trailing/leading quotes
+    if (e.startswith ('"') or e.startswith ("'")):
+        if (e.endswith ('"') or e.endswith ("'")):
+            e = e [1:-1]
+        else:
+            e = e [1:]
+    elif (e.endswith ('"') or e.endswith ("'")):
+        e = e [0:-1]
+    pathList = tuple(e.split ('/'))
+    steps = []
+    for p in pathList:
+        if p.startswith ('?'):
+            steps.append( (p[1:], True) )
+        else:
+            steps.append( (p, False) )
+    steps = tuple(steps)
+    if len(_compiled_paths) >= _COMPILED_PATHS_SIZE:
+        _compiled_paths.clear()
+    _compiled_paths[expr] = (pathList, steps)
+    return pathList, steps
+
 class _advene_context (simpleTALES.Context):
     """Advene specific implementation of TALES.
        It is based on simpletal.simpleTALES.Context,
@@ -99,9 +299,10 @@ class _advene_context (simpleTALES.Context):
 
         val = None
 
-        if self.methods.has_key(path):
+        method = self.methods.get(path)
+        if method is not None:
             #print "Evaluating %s on %s" % (path, obj)
-            val = self.methods[path](obj, self)
+            val = method(obj, self)
             # If the result is None, the method is not appliable
             # and we should try other access ways (attributes,...) on the
             # object
@@ -120,64 +321,39 @@ class _advene_context (simpleTALES.Context):
             if ref is None:
                 ref = obj
             pkg = ref.getOwnerPackage ()
-            ns_dict = pkg.getImports ().getInverseDict ()
-            ns_dict[''] = pkg.getUri (absolute=True)
-            val = obj.getQName (path, ns_dict, None)
+            val = obj.getQName (path, pkg._get_namespaces (), None)
 
         return val
 
     def traversePath (self, expr, canCall=1):
                 # canCall only applies to the *final* path destination, not points down the path.
-                # Check for and correct for trailing/leading quotes
-                if (expr.startswith ('"') or expr.startswith ("'")):
-                        if (expr.endswith ('"') or expr.endswith ("'")):
-                                expr = expr [1:-1]
-                        else:
-                                expr = expr [1:]
-                elif (expr.endswith ('"') or expr.endswith ("'")):
-                        expr = expr [0:-1]
-                pathList = expr.split ('/')
-
-                path = pathList[0]
-                if path.startswith ('?'):
-                        path = path[1:]
-                        if self.locals.has_key(path):
-                                path = self.locals[path]
-                                if (isinstance (path, simpleTALES.ContextVariable)): path = path.value()
-                                elif (callable (path)):path = apply (path, ())
-
-                        elif self.globals.has_key(path):
-                                path = self.globals[path]
-                                if (isinstance (path, simpleTALES.ContextVariable)): path = path.value()
-                                elif (callable (path)):path = apply (path, ())
-                                #self.log.debug ("Dereferenced to %s" % path)
-                if self.locals.has_key(path):
-                        val = self.locals[path]
-                elif self.globals.has_key(path):
-                        val = self.globals[path]
+                pathList, steps = compile_path (expr)
+                locals_ = self.locals
+                globals_ = self.globals
+
+                path, deref = steps[0]
+                if deref:
+                        path = self.dereference (path)
+                if locals_.has_key(path):
+                        val = locals_[path]
+                elif globals_.has_key(path):
+                        val = globals_[path]
                 else:
                         # If we can't find it then raise an exception
                         raise simpleTALES.PATHNOTFOUNDEXCEPTION
 
+                dependencies = getattr(_recorder, 'dependencies', None)
+
                 # Advene hook: store the resolved_stack
                 resolved_stack = [ (path, val) ]
                 self.pushLocals()
                 self.setLocal( '__resolved_stack', resolved_stack )
 
                 index = 1
-                for path in pathList[1:]:
+                for path, deref in steps[1:]:
                         #self.log.debug ("Looking for path element %s" % path)
-                        if path.startswith ('?'):
-                                path = path[1:]
-                                if self.locals.has_key(path):
-                                        path = self.locals[path]
-                                        if (isinstance (path, simpleTALES.ContextVariable)): path = path.value()
-                                        elif (callable (path)):path = apply (path, ())
-                                elif self.globals.has_key(path):
-                                        path = self.globals[path]
-                                        if (isinstance (path, simpleTALES.ContextVariable)): path = path.value()
-                                        elif (callable (path)):path = apply (path, ())
-                                #self.log.debug ("Dereferenced to %s" % path)
+                        if deref:
+                                path = self.dereference (path)
                         try:
                                 if (isinstance (val, simpleTALES.ContextVariable)): temp = val.value((index, pathList))
                                 elif (callable (val)):temp = apply (val, ())
@@ -205,6 +381,8 @@ class _advene_context (simpleTALES.Context):
 
                         # Advene hook: stack resolution
                         resolved_stack.insert(0, (path, val) )
+                        if dependencies is not None:
+                                _record_access(dependencies, temp, path, val)
 
                         index = index + 1
                 #self.log.debug ("Found value %s" % str (val))
@@ -225,8 +403,24 @@ class _advene_context (simpleTALES.Context):
                 else:
                         if (isinstance (val, simpleTALES.ContextVariable)): result = val.realValue
                         else: result = val
+                if dependencies is not None:
+                        _record(dependencies, result)
                 return result
 
+    def dereference (self, name):
+                """Return the value of the variable name, used as a path item.
+                """
+                if self.locals.has_key(name):
+                        path = self.locals[name]
+                elif self.globals.has_key(name):
+                        path = self.globals[name]
+                else:
+                        return name
+                if (isinstance (path, simpleTALES.ContextVariable)): path = path.value()
+                elif (callable (path)):path = apply (path, ())
+                #self.log.debug ("Dereferenced to %s" % path)
+                return path
+
 
 class AdveneContext(_advene_context):
 
@@ -271,30 +465,59 @@ class AdveneContext(_advene_context):
         else:
             raise AdveneTalesException("%s is not a valid method" % function)
 
-    def interpret (self, view_source, mimetype, stream=None):
+    def compile (self, view_source, mimetype, uri=None):
+        """
+        Return the compiled TAL template for the source view_source (a
+        string or a stream) with the mime-type mimetype, and the
+        additional keyword arguments of its expand method.
+
+        Compiled templates are kept in template_cache. The uri parameter
+        (the URI of the view, if any) allows to invalidate them when the
+        view is modified.
+        """
+        if isinstance (view_source, str) or isinstance (view_source, unicode):
+            data = unicode(view_source)
+            digest = md5(data.encode('utf-8')).digest()
+        else:
+            data = view_source.read()
+            digest = md5(data).digest()
+
+        kw = {}
+        if mimetype is None or mimetype.startswith('text/'):
+            kind = 'html'
+        else:
+            kind = 'xml'
+            kw["suppressXMLDeclaration"] = 1
+
+        key = (uri, kind, digest)
+        template = template_cache.get(key)
+        if template is None:
+            if kind == 'html':
+                compiler = simpleTAL.HTMLTemplateCompiler ()
+                compiler.log = self.log
+                compiler.parseTemplate (StringIO(data), 'utf-8')
+            else:
+                compiler = simpleTAL.XMLTemplateCompiler ()
+                compiler.log = self.log
+                compiler.parseTemplate (StringIO(data))
+            template = compiler.getTemplate ()
+            template_cache.put(key, template)
+        return template, kw
+
+    def interpret (self, view_source, mimetype, stream=None, uri=None):
         """
         Interpret the TAL template available through the stream view_source,
         with the mime-type mimetype, and print the result to the stream
         "stream". The stream is returned. If stream is not given or None, a
         StringIO will be created and returned.
+
+        See compile for the uri parameter.
         """
         if stream is None:
             stream = StringIO ()
 
-        if isinstance (view_source, str) or isinstance (view_source, unicode):
-            view_source = StringIO (unicode(view_source))
-
-        kw = {}
-        if mimetype is None or mimetype.startswith('text/'):
-            compiler = simpleTAL.HTMLTemplateCompiler ()
-            compiler.log = self.log
-            compiler.parseTemplate (view_source, 'utf-8')
-        else:
-            compiler = simpleTAL.XMLTemplateCompiler ()
-            compiler.log = self.log
-            compiler.parseTemplate (view_source)
-            kw["suppressXMLDeclaration"] = 1
-        compiler.getTemplate ().expand (context=self, outputFile=stream, outputEncoding='utf-8', **kw)
+        template, kw = self.compile (view_source, mimetype, uri)
+        template.expand (context=self, outputFile=stream, outputEncoding='utf-8', **kw)
 
         return stream
 
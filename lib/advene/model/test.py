@@ -18,12 +18,16 @@
 #
 import unittest
 
+import os
 import sys
+import time
+from cStringIO import StringIO
 sys.path.insert(0, ".")
 
 from advene.util.expat import PyExpat
 
 from modeled import Modeled
+from advene.model.fragment import MillisecondFragment
 
 class ModeledTestCase(unittest.TestCase):
 
@@ -192,8 +196,1412 @@ class ModeledTestCase(unittest.TestCase):
         self.assertEqual(e,None)
 
 
+class PackageTestCase(unittest.TestCase):
+    """Base class for tests on a package with 4 annotations.
+    """
+
+    def setUp(self):
+        from advene.model.package import Package
+        self.package = Package(uri="new_pkg", source=None)
+        schema = self.package.createSchema(ident="s")
+        self.package.schemas.append(schema)
+        self.type = schema.createAnnotationType(ident="at")
+        schema.annotationTypes.append(self.type)
+        for i, (b, e) in enumerate( ((0, 100), (50, 150), (200, 300), (250, 10000)) ):
+            self.create(i, b, e)
+
+    def create(self, i, begin, end):
+        a = self.package.createAnnotation(type=self.type, ident="a%d" % i,
+                                          fragment=MillisecondFragment(begin=begin, end=end))
+        self.package.annotations.append(a)
+        return a
+
+    def ids(self, l):
+        return [ a.id for a in l ]
+
+class TimeIndexTestCase(PackageTestCase):
+
+    def test_annotations_at(self):
+        self.assertEqual(self.ids(self.package.annotations_at(75)), [ "a0", "a1" ])
+        self.assertEqual(self.ids(self.package.annotations_at(5000)), [ "a3" ])
+        self.assertEqual(self.ids(self.package.annotations_at(20000)), [])
+
+    def test_annotations_between(self):
+        self.assertEqual(self.ids(self.package.annotations_between(120, 210)),
+                         [ "a1", "a2" ])
+
+    def test_next_begins_after(self):
+        self.assertEqual(self.ids(self.package.next_begins_after(50, 2)),
+                         [ "a2", "a3" ])
+
+    def test_fragment_update(self):
+        a = self.package.annotations[0]
+        a.fragment.begin = 400
+        a.fragment.end = 500
+        self.assertEqual(self.ids(self.package.annotations_at(75)), [ "a1" ])
+        self.assertEqual(self.ids(self.package.annotations_at(450)), [ "a3", "a0" ])
+
+    def test_bundle_update(self):
+        a = self.create(4, 60, 70)
+        self.assertEqual(self.ids(self.package.annotations_at(65)), [ "a0", "a1", "a4" ])
+        self.package.annotations.remove(a)
+        self.assertEqual(self.ids(self.package.annotations_at(65)), [ "a0", "a1" ])
+
+    def test_type_index(self):
+        schema = self.type.schema
+        other = schema.createAnnotationType(ident="other")
+        schema.annotationTypes.append(other)
+        a = self.package.annotations[2]
+        a.type = other
+        self.assertEqual(self.ids(self.type.annotations), [ "a0", "a1", "a3" ])
+        self.assertEqual(self.ids(other.annotations), [ "a2" ])
+        self.package.annotations[3].fragment.begin = 10
+        self.assertEqual(self.ids(self.type.annotations), [ "a0", "a3", "a1" ])
+
+    def test_long_annotation(self):
+        from advene.model.timeindex import TimeIndex
+        class Interval(object):
+            def __init__(self, begin, end):
+                self.fragment = MillisecondFragment(begin=begin, end=end)
+            def getFragment(self):
+                return self.fragment
+        short = [ Interval(i * 10, i * 10 + 100) for i in xrange(100000) ]
+        whole = Interval(0, 1000000)
+        def cost(index):
+            t = time.time()
+            for i in xrange(1000):
+                index.annotations_at(i * 997)
+                index.annotations_between(i * 997, i * 997 + 50)
+            return time.time() - t
+        index = TimeIndex(short)
+        reference = cost(index)
+        index.add(whole)
+        self.assertEqual([ a for (a, b, e) in index.annotations_at(5000) ],
+                         [ whole ] + short[490:501])
+        # The long annotation does not make the queries scan the
+        # whole index
+        self.assertTrue(cost(index) < 4 * reference + .05)
+        index.remove(whole)
+        self.assertEqual(len(index.annotations_at(5000)), 11)
+
+class CreateAnnotationsTestCase(PackageTestCase):
+
+    def test_create_annotations(self):
+        self.type.mimetype = "text/plain"
+        # Indexes are built before the creation
+        self.assertEqual(len(self.type.annotations), 4)
+        self.package.createAnnotations( { 'type': self.type,
+                                          'ident': "b%d" % i,
+                                          'begin': 60 + i,
+                                          'end': 70,
+                                          'author': "me",
+                                          'date': "2012",
+                                          'data': "data %d" % i }
+                                        for i in range(3) )
+        self.assertEqual(self.ids(self.package.annotations_at(65)),
+                         [ "a0", "a1", "b0", "b1", "b2" ])
+        self.assertEqual(self.ids(self.type.annotations),
+                         [ "a0", "a1", "b0", "b1", "b2", "a2", "a3" ])
+        b = self.package.annotations[-1]
+        self.assertEqual(self.ids(self.package.annotations[-3:]), [ "b0", "b1", "b2" ])
+        self.assertEqual((b.author, b.date, b.content.data), ("me", "2012", "data 2"))
+        # Same DOM as the annotations created one by one
+        a = self.create(5, 62, 70)
+        a.author = "me"
+        a.date = "2012"
+        a.content.data = "data 2"
+        a.id = "b2"
+        self.assertEqual(a._getModel().toxml(), b._getModel().toxml())
+
+    def test_duplicate_ids(self):
+        from advene.model.exception import AdveneException
+        for ids in ( ("b0", "b0"), ("b0", "a1") ):
+            self.assertRaises(AdveneException, self.package.createAnnotations,
+                              [ { 'type': self.type, 'ident': i, 'begin': 0, 'end': 1 }
+                                for i in ids ])
+            self.assertEqual(len(self.package.annotations), 4)
+
+class LazyBundleTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.package = make_package(100)
+
+    def ids(self, l):
+        return [ a.id for a in l ]
+
+    def alive(self):
+        """Return the ids of the existing Annotation instances.
+        """
+        import gc
+        from advene.model.annotation import Annotation
+        gc.collect()
+        return sorted(o.id for o in gc.get_objects() if isinstance(o, Annotation))
+
+    def test_indexes(self):
+        self.package.getTimeIndex()
+        at3 = self.package.get_element_by_id("at3")
+        self.package._get_annotation_type_index()
+        self.assertEqual(self.alive(), [])
+        self.assertEqual(self.ids(self.package.annotations_at(250)), [ "a0", "a1", "a2" ])
+        self.assertEqual(self.ids(at3.annotations), [ "a%d" % i for i in range(3, 100, 10) ])
+        self.assertEqual(self.alive(), [])
+
+    def test_lookup(self):
+        import gc
+        import weakref
+        annotations = self.package.annotations
+        a = annotations[3]
+        self.assertTrue(annotations[a.uri] is a)
+        self.assertTrue(annotations.get_by_id("a3") is a)
+        self.assertTrue(a in annotations)
+        self.assertEqual(annotations.index(a), 3)
+        a.fragment.begin = 5000
+        a.fragment.end = 6000
+        ref = weakref.ref(a)
+        del a
+        gc.collect()
+        self.assertTrue(ref() is None)
+        # Created again from its element
+        a = annotations[3]
+        self.assertEqual((a.id, a.fragment.begin), ("a3", 5000))
+        self.assertEqual(self.ids(self.package.annotations_at(5100)),
+                         [ "a%d" % i for i in range(36, 50) ] + [ "a3", "a50", "a51" ])
+        self.assertTrue(self.package.annotations_at(5100)[14] is a)
+
+    def test_pin(self):
+        import gc
+        annotations = self.package.annotations
+        a = annotations[3]
+        a.state = 1
+        annotations.pin(a)
+        del a
+        gc.collect()
+        self.assertEqual(annotations[3].state, 1)
+        annotations.unpin(annotations[3])
+        gc.collect()
+        self.assertFalse(hasattr(annotations[3], 'state'))
+
+    def test_delete(self):
+        annotations = self.package.annotations
+        self.package.getTimeIndex()
+        del annotations[0]
+        self.assertEqual(len(annotations), 99)
+        self.assertEqual(annotations.get_by_id("a0"), None)
+        self.assertEqual(self.ids(self.package.annotations_at(250)), [ "a1", "a2" ])
+
+class StreamingLoaderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.source = make_package_source(100)
+        self.package = self.load(self.source)
+
+    def load(self, source):
+        from advene.model.package import Package
+        return Package(uri="bench.xml", source=StringIO(source), loader='streaming')
+
+    def ids(self, l):
+        return [ a.id for a in l ]
+
+    def created(self):
+        """Return the ids of the annotation elements built from the store.
+        """
+        e = self.package._getModel().getElementsByTagName("annotations")[0]
+        return [ n.getAttribute("id") for n in e.childNodes
+                 if n.nodeType == n.ELEMENT_NODE and n.localName == "annotation" ]
+
+    def serialize(self, package):
+        out = StringIO()
+        package.serialize(out)
+        return out.getvalue()
+
+    def test_load(self):
+        dom = make_package(100)
+        self.assertEqual(self.package.annotations.ids(), dom.annotations.ids())
+        # The indexes are built from the store
+        self.package.getTimeIndex()
+        self.package._get_annotation_type_index()
+        self.assertEqual(self.created(), [])
+        self.assertEqual(self.ids(self.package.annotations_at(250)), [ "a0", "a1", "a2" ])
+        at3 = self.package.get_element_by_id("at3")
+        self.assertEqual(self.ids(at3.annotations), [ "a%d" % i for i in range(3, 100, 10) ])
+        self.assertEqual(self.created(), [ "a0", "a1", "a2" ] + [ "a%d" % i for i in range(3, 100, 10) ])
+
+    def test_lookup(self):
+        a = self.package.annotations[5]
+        self.assertEqual(self.created(), [ "a5" ])
+        self.assertEqual((a.id, a.fragment.begin, a.content.data, a.type.id),
+                         ("a5", 500, "Annotation 5", "at5"))
+        self.assertTrue(self.package.annotations.get_by_id("a5") is a)
+        self.assertEqual(a._getModel().toxml(),
+                         make_package(10).annotations[5]._getModel().toxml())
+        self.assertEqual(len(list(self.package.annotations)), 100)
+        self.assertEqual(len(self.created()), 100)
+
+    def test_serialize(self):
+        self.assertEqual(self.serialize(self.package), self.serialize(make_package(100)))
+        a = self.package.annotations[5]
+        a.content.data = "changed"
+        del self.package.annotations[0]
+        self.package.annotations.append(self.package.createAnnotation(
+                type=a.type, ident="new", fragment=a.fragment.clone()))
+        package = self.load(self.serialize(self.package))
+        self.assertEqual(self.package.annotations.ids(), package.annotations.ids())
+        self.assertEqual(package.annotations[4].content.data, "changed")
+        self.assertEqual(self.ids(package.annotations_at(550)),
+                         [ "a%d" % i for i in range(1, 6) ] + [ "new" ])
+
+    def test_namespaces(self):
+        source = self.source.replace('<annotations>', '''<annotations xmlns:x="urn:x">
+ <annotation id="e" type="#at0"/>
+ <annotation id="m" type="#at1" dc:creator="me"><meta><x:y>z</x:y></meta><millisecond-fragment begin="1" end="2"/></annotation>
+ <relation id="r" type="#rt"><members/></relation>
+ ''')
+        from advene.model.package import Package
+        dom = Package(uri="bench.xml", source=StringIO(source))
+        self.package = self.load(source)
+        # The empty annotation is kept in the tree
+        self.assertEqual(self.created(), [ "e" ])
+        self.assertEqual(self.package.annotations.ids()[:3], [ "m", "a0", "a1" ])
+        self.assertEqual(self.ids(self.package.annotations_at(1)), [ "a0", "m" ])
+        for i in ("e", "m"):
+            self.assertEqual(self.package.annotations.get_by_id(i)._getModel().toxml(),
+                             dom.annotations.get_by_id(i)._getModel().toxml())
+        self.assertEqual(self.package.annotations.get_by_id("m").author, "me")
+        self.assertEqual(self.ids(self.load(self.serialize(self.package)).relations), [ "r" ])
+
+    def test_unknown_loader(self):
+        from advene.model.package import Package
+        from advene.model.exception import AdveneException
+        self.assertRaises(AdveneException, Package, uri="bench.xml",
+                          source=StringIO(self.source), loader='sax')
+
+class TitleCacheTestCase(PackageTestCase):
+
+    def setUp(self):
+        PackageTestCase.setUp(self)
+        get_config()
+        from advene.util.helper import TitleCache
+        schema = self.type.schema
+        rt = schema.createRelationType(ident="rt")
+        schema.relationTypes.append(rt)
+        a = self.package.annotations
+        self.relation = self.package.createRelation(type=rt, ident="r", members=(a[0], a[1]))
+        self.package.relations.append(self.relation)
+        # The annotations are only weakly cached by the package (as the
+        # views, hold them so that their titles are kept)
+        self.annotations = list(self.package.annotations)
+        self.cache = TitleCache()
+        self.fill()
+
+    def fill(self):
+        for e in self.annotations + [ self.relation ]:
+            self.cache.titles(e)[ (None, None) ] = e.id
+
+    def cached(self):
+        return sorted(e.id for e in self.cache._titles.keys())
+
+    def test_titles(self):
+        a = self.package.annotations[2]
+        self.assertEqual(self.cache.titles(a), { (None, None): "a2" })
+        self.assertTrue(self.cache.titles(a) is self.cache.titles(a))
+
+    def test_invalidate(self):
+        c = self.cache
+        c.invalidate('AnnotationEditEnd', self.package.annotations[0])
+        self.assertEqual(self.cached(), [ "a1", "a2", "a3" ])
+        self.fill()
+        c.invalidate('RelationCreate', self.relation)
+        self.assertEqual(self.cached(), [ "a2", "a3" ])
+        self.fill()
+        self.annotations.append(self.create(4, 0, 10))
+        c.invalidate('AnnotationCreate', self.annotations[-1])
+        self.assertEqual(len(c), 5)
+        c.invalidate('AnnotationTypeEditEnd', self.type)
+        self.assertEqual(len(c), 0)
+
+    def test_unload(self):
+        import gc
+        c = self.cache
+        c.discard_package(self.package)
+        self.assertEqual(len(c), 0)
+        self.fill()
+        del self.package, self.relation, self.type, self.annotations
+        gc.collect()
+        self.assertEqual(len(c), 0)
+
+class RuleFilterTestCase(PackageTestCase):
+
+    def setUp(self):
+        PackageTestCase.setUp(self)
+        self.type.mimetype = "text/plain"
+        a = self.package.annotations
+        a[0].content.data = "some text"
+        a[1].content.data = "1.0"
+
+    def context(self, kw):
+        """Build the context of the rules, as ECAEngine.build_context.
+        """
+        from advene.model.tal.context import AdveneContext
+        context = AdveneContext(here=self.package)
+        globals_ = { 'annotation': None, 'relation': None, 'context': None, 'event': 'AnnotationEditEnd' }
+        globals_.update(kw)
+        for k, v in globals_.iteritems():
+            context.addGlobal(k, v)
+        return context
+
+    def check(self, condition, kw):
+        """Check that the filter of condition agrees with its match method.
+
+        @return: the result of the filter
+        """
+        f = condition.filter()
+        if f is None:
+            return None
+        r = f(kw)
+        if r is not None:
+            self.assertEqual(bool(r), bool(condition.match(self.context(kw))))
+        return r
+
+    def conditions(self):
+        from advene.rules.elements import Condition
+        return [ Condition('annotation/type/id', 'string:at', 'equals'),
+                 Condition(' annotation/id', ' string: a1 ', 'different'),
+                 Condition('annotation/content/data', 'string:text', 'contains'),
+                 Condition('annotation/content/data', 'string:1', 'equals') ]
+
+    def test_condition(self):
+        from advene.rules.elements import Condition
+        expected = { 'a0': [ True, True, True, False ],
+                     'a1': [ True, False, False, True ] }
+        for ident, results in expected.iteritems():
+            kw = { 'annotation': self.package.get_element_by_id(ident) }
+            self.assertEqual([ self.check(c, kw) for c in self.conditions() ], results)
+        # Unsupported conditions
+        kw = { 'annotation': self.package.annotations[0] }
+        for c in (Condition('annotation/fragment/begin', 'string:10', 'equals'),
+                  Condition('annotation/id', 'string:a$x', 'equals'),
+                  Condition('annotation/id', 'here/id', 'equals'),
+                  Condition('annotation/id', 'string:a0', 'greater')):
+            self.assertEqual(c.filter(), None)
+
+    def test_missing_parameters(self):
+        from advene.rules.elements import Condition
+        for kw in ({}, { 'annotation': None }, { 'relation': self.package.annotations[0] }):
+            for c in self.conditions():
+                self.assertEqual(self.check(c, kw), None)
+        c = Condition('relation/id', 'string:r', 'equals')
+        self.assertEqual(self.check(c, { 'annotation': self.package.annotations[0] }), None)
+
+    def test_condition_list(self):
+        from advene.rules.elements import Condition, ConditionList
+        supported = self.conditions()[0]
+        other = Condition('annotation/fragment/begin', 'string:50', 'equals')
+        expected = {
+            # and: a false condition is decisive, else match is needed
+            ('and', 'a0', 'at'): None,
+            ('and', 'a0', 'x'): False,
+            # or: a true condition is decisive, else match is needed
+            ('or', 'a1', 'at'): True,
+            ('or', 'a1', 'x'): None,
+            }
+        for (composition, ident, type_id), result in expected.iteritems():
+            supported.rhs = 'string:' + type_id
+            for l in ([ supported, other ], [ other, supported ]):
+                cl = ConditionList(l)
+                cl.composition = composition
+                kw = { 'annotation': self.package.get_element_by_id(ident) }
+                self.assertEqual(self.check(cl, kw), result)
+                # When the filter is undecided, match gives the result
+                if result is None:
+                    self.assertEqual(bool(cl.match(self.context(kw))),
+                                     bool(other.match(self.context(kw))))
+        # Lists of supported conditions are fully checked
+        cl = ConditionList(self.conditions()[:3])
+        kw = { 'annotation': self.package.annotations[0] }
+        self.assertEqual(self.check(cl, kw), True)
+        self.assertEqual(self.check(cl, {}), None)
+        self.assertEqual(ConditionList([ other ]).filter(), None)
+
+class IdGeneratorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        get_config()
+        from advene.core.idgenerator import Generator
+        from advene.model.package import Package
+        self.package = Package(uri="new_pkg", source=None)
+        schema = self.package.createSchema(ident="s")
+        self.package.schemas.append(schema)
+        self.type = schema.createAnnotationType(ident="at")
+        schema.annotationTypes.append(self.type)
+        for i in (1, 3):
+            a = self.package.createAnnotation(type=self.type, ident="a%d" % i,
+                                              fragment=MillisecondFragment(begin=i, end=i + 1))
+            self.package.annotations.append(a)
+        self.generator = Generator(self.package)
+
+    def test_get_id(self):
+        from advene.model.annotation import Annotation
+        g = self.generator
+        self.assertTrue(g.exists("a3"))
+        self.assertEqual(g.get_id(Annotation), "a4")
+        g.add("a5")
+        self.assertEqual(g.get_id(Annotation), "a6")
+        g.remove("a5")
+        self.assertFalse(g.exists("a5"))
+
+    def test_get_ids(self):
+        from advene.model.annotation import Annotation
+        g = self.generator
+        g.add("a6")
+        self.assertEqual(g.get_ids(Annotation, 3), [ "a4", "a5", "a7" ])
+        self.assertTrue(g.exists("a7"))
+        self.assertEqual(g.get_id(Annotation), "a8")
+
+    def test_new_from_title(self):
+        g = self.generator
+        self.assertEqual(g.new_from_title("view"), ("view", "view1"))
+        g.add("view1")
+        self.assertEqual(g.new_from_title("view"), ("view2", "view2"))
+
+class TemplateCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        import advene.model.tal.context as context
+        self.cache = context.TemplateCache(size=2)
+        self.saved, context.template_cache = context.template_cache, self.cache
+        self.context = context.AdveneContext(here=None)
+
+    def tearDown(self):
+        import advene.model.tal.context as context
+        context.template_cache = self.saved
+
+    def render(self, source, uri="view"):
+        return self.context.interpret(source, 'text/html', uri=uri).getvalue()
+
+    def test_hits(self):
+        source = '<p tal:content="string:foo">bar</p>'
+        self.assertEqual(self.render(source), '<p>foo</p>')
+        self.assertEqual(self.render(source), '<p>foo</p>')
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.assertEqual(self.render('<p>baz</p>'), '<p>baz</p>')
+        self.assertEqual(self.cache.misses, 2)
+
+    def test_lru(self):
+        for i in range(3):
+            self.render('<p>%d</p>' % i)
+        self.render('<p>0</p>')
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 4))
+        self.render('<p>2</p>')
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_invalidate(self):
+        self.render('<p>foo</p>', uri="view1")
+        self.render('<p>foo</p>', uri="view2")
+        self.cache.invalidate("view1")
+        self.assertEqual(len(self.cache), 1)
+
+    def test_compile(self):
+        source = '<p tal:content="string:foo">bar</p>'
+        template, kw = self.context.compile(StringIO(source), 'text/plain', uri="filter")
+        self.assertEqual(kw, {})
+        self.assertTrue(self.context.compile(source, 'text/plain', uri="filter")[0] is template)
+        self.assertEqual(self.render(source, uri="filter"), '<p>foo</p>')
+        self.assertEqual((self.cache.hits, self.cache.misses), (2, 1))
+
+class DependenciesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        from advene.model.package import Package
+        from advene.model.tal.context import AdveneContext
+        self.package = Package(uri="new_pkg", source=None)
+        schema = self.package.createSchema(ident="s")
+        self.package.schemas.append(schema)
+        self.type = schema.createAnnotationType(ident="at")
+        schema.annotationTypes.append(self.type)
+        for i in range(3):
+            a = self.package.createAnnotation(type=self.type, ident="a%d" % i,
+                                              fragment=MillisecondFragment(begin=i, end=i + 1))
+            self.package.annotations.append(a)
+        self.context = AdveneContext(here=self.package)
+
+    def record(self, expr):
+        from advene.model.annotation import Annotation
+        from advene.model.tal.context import record_dependencies
+        dependencies = set()
+        record_dependencies(dependencies)
+        try:
+            self.context.evaluateValue(expr)
+        finally:
+            record_dependencies(None)
+        if '*' in dependencies:
+            return set('*')
+        return set(d.id for d in dependencies if isinstance(d, Annotation))
+
+    def test_item(self):
+        self.assertEqual(self.record('here/annotations/a1/content/data'), set([ 'a1' ]))
+
+    def test_list(self):
+        self.assertEqual(self.record('here/annotationTypes/at/annotations/first'),
+                         set([ 'a0', 'a1', 'a2' ]))
+
+    def test_bundle(self):
+        self.assertEqual(self.record('here/annotations/first'), set([ '*' ]))
+
+class ParsedCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        import advene.model.content as content
+        from advene.model.package import Package
+        self.cache = content.ParsedCache(max_size=20)
+        self.saved, content.parsed_cache = content.parsed_cache, self.cache
+        package = Package(uri="new_pkg", source=None)
+        schema = package.createSchema(ident="s")
+        package.schemas.append(schema)
+        self.type = schema.createAnnotationType(ident="at")
+        self.type.mimetype = "application/x-advene-structured"
+        schema.annotationTypes.append(self.type)
+        self.annotations = []
+        for i in range(2):
+            a = package.createAnnotation(type=self.type, ident="a%d" % i,
+                                         fragment=MillisecondFragment(begin=i, end=i + 1))
+            a.content.data = "num=%d" % i
+            self.annotations.append(a)
+
+    def tearDown(self):
+        import advene.model.content as content
+        content.parsed_cache = self.saved
+
+    def test_hits(self):
+        c = self.annotations[0].content
+        self.assertEqual(c.parsed()['num'], '0')
+        self.assertTrue(c.parsed() is c.parsed())
+        self.assertEqual((self.cache.hits, self.cache.misses), (2, 1))
+
+    def test_invalidate(self):
+        c = self.annotations[0].content
+        c.parsed()
+        c.data = "num=2"
+        self.assertEqual(c.parsed()['num'], '2')
+        c.mimetype = "application/x-advene-values"
+        self.assertEqual(c.parsed(), [ 0 ])
+        self.type.mimetype = "text/plain"
+        c.mimetype = None
+        self.assertEqual(c.parsed(), "num=2")
+        self.assertEqual(self.cache.misses, 3)
+
+    def test_size(self):
+        for a in self.annotations:
+            a.content.data = "num=%s\nname=test" % a.id
+            a.content.parsed()
+        # Only one 16 characters content fits in the cache
+        self.assertEqual((len(self.cache), self.cache.size), (1, 16))
+
+    def test_discard_package(self):
+        for a in self.annotations:
+            a.content.parsed()
+        self.cache.discard_package(self.annotations[0].ownerPackage)
+        self.assertEqual((len(self.cache), self.cache.size), (0, 0))
+
+    def test_unload(self):
+        import gc
+        import weakref
+        for a in self.annotations:
+            a.content.parsed()
+        ref = weakref.ref(a.ownerPackage)
+        del a, self.annotations, self.type
+        gc.collect()
+        # The cache does not keep the package alive
+        self.assertEqual(ref(), None)
+        # Entries of collected contents are removed on the next access
+        self.assertEqual(self.cache.get(self, None), (False, None))
+        self.assertEqual((len(self.cache), self.cache.size), (0, 0))
+
+class ValuesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        from advene.model.package import Package
+        package = Package(uri="new_pkg", source=None)
+        schema = package.createSchema(ident="s")
+        package.schemas.append(schema)
+        at = schema.createAnnotationType(ident="at")
+        at.mimetype = "application/x-advene-values"
+        schema.annotationTypes.append(at)
+        a = package.createAnnotation(type=at, ident="a",
+                                     fragment=MillisecondFragment(begin=0, end=1))
+        self.content = a.content
+
+    def test_packed(self):
+        c = self.content
+        c.data = "1.5 2 x"
+        self.assertEqual(c.parsed(), [ 1.5, 2, 0 ])
+        c.setValues(c.getValues())
+        self.assertTrue(c.isPacked())
+        self.assertEqual(list(c.parsed()), [ 1.5, 2, 0 ])
+        self.assertEqual(c.data, "1.5 2 0")
+        self.assertTrue(c.getValues() is c.parsed())
+        # Legacy text form
+        c.setValues([ .25 ], packed=False)
+        self.assertFalse(c.isPacked())
+        self.assertEqual(c.data, "0.25")
+
+class EventHistoryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        import advene.core.config as config
+        from advene.rules.ecaengine import ECAEngine
+        from advene.model.package import Package
+        self.preferences = config.data.preferences
+        self.saved = dict(self.preferences)
+        self.preferences.update({ 'record-actions': True,
+                                  'event-history-size': 3,
+                                  'event-history-log': False })
+        self.engine = ECAEngine(None)
+        package = Package(uri="new_pkg", source=None)
+        schema = package.createSchema(ident="s")
+        self.type = schema.createAnnotationType(ident="at")
+
+    def tearDown(self):
+        self.preferences.clear()
+        self.preferences.update(self.saved)
+
+    def test_history(self):
+        e = self.engine
+        for i in xrange(5):
+            e.notify("AnnotationTypeEditEnd", annotationtype=self.type)
+        e.notify("PackageActivate", uri="file:///tmp/a.azp")
+        self.assertEqual(len(e.event_history), 3)
+        r = e.event_history[-2]
+        self.assertEqual((r.event_name, r.element_id, r.element_type),
+                         ("AnnotationTypeEditEnd", "at", "AnnotationType"))
+        self.assertEqual(e.event_history[-1].element_id, "file:///tmp/a.azp")
+
+    def test_log(self):
+        import tempfile
+        from advene.rules.ecaengine import EventRecord, read_event_log
+        records = [ EventRecord(time.time(), "PlayerSet", None, None, 1200),
+                    EventRecord(time.time(), "AnnotationCreate", u"a\xe91", "Annotation", None) ]
+        fd, fname = tempfile.mkstemp()
+        try:
+            os.write(fd, "".join(r.to_line() for r in records))
+            os.close(fd)
+            for a, b in zip(records, read_event_log(fname)):
+                self.assertEqual([ getattr(a, n) for n in EventRecord.__slots__ ],
+                                 [ getattr(b, n) for n in EventRecord.__slots__ ])
+        finally:
+            os.unlink(fname)
+
+class ImageCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        get_config()
+        from advene.core.imagecache import ImageCache
+        self.cache = ImageCache(epsilon=10)
+        for key in (100, 200, 300):
+            self.cache[key] = "png %d" % key
+
+    def test_approximate(self):
+        c = self.cache
+        # Bounds are within epsilon
+        self.assertEqual(c.approximate(90), 100)
+        self.assertEqual(c.approximate(110), 100)
+        self.assertEqual(c.approximate(310), 300)
+        # Equidistant valid keys: the lower one is used
+        self.assertEqual(c.get(250, epsilon=50), "png 200")
+        self.assertEqual(c.approximate(0), 0)
+        self.assertEqual(c.approximate(311), 311)
+        self.assertFalse(c.is_initialized(311))
+        self.assertTrue(c.is_initialized(299))
+        self.assertEqual(sorted(c.missing_snapshots()), [ 0, 311 ])
+        # A missing key does not hide a near valid one
+        self.assertEqual(c.approximate(305), 300)
+
+    def test_invalidate(self):
+        c = self.cache
+        self.assertEqual(c.invalidate(195), 200)
+        self.assertEqual(c.valid_snapshots(), [ 100, 300 ])
+        self.assertEqual(c[200], c.not_yet_available_image)
+        c[205] = "png 205"
+        # Invalid keys are ignored by the lookups
+        self.assertEqual(c.approximate(200), 205)
+        self.assertEqual(c.approximate(194), 194)
+        del c[205]
+        self.assertEqual(c.valid_snapshots(), [ 100, 300 ])
+
+    def test_hot_cache(self):
+        from advene.core.imagecache import HotCache
+        h = HotCache(10)
+        h.put('a', 'xxxx')
+        h.put('b', 'yyyy')
+        self.assertEqual(h.get('a'), 'xxxx')
+        # b is the least recently used
+        h.put('c', 'zzzz')
+        self.assertEqual((h.get('b'), h.get('c'), h.resident), (None, 'zzzz', 8))
+        # Too large to be cached
+        h.put('d', 'w' * 11)
+        self.assertEqual(h.get('d'), None)
+        h.discard('a')
+        self.assertEqual((h.get('a'), h.resident), (None, 4))
+        self.assertEqual((h.hits, h.misses), (2, 3))
+
+    def test_spill(self):
+        import tempfile
+        import shutil
+        import advene.core.config as config
+        from advene.core.imagecache import ImageCache, CachedString
+        saved, config.data.path['imagecache'] = config.data.path['imagecache'], tempfile.mkdtemp()
+        try:
+            c = ImageCache()
+            c.name = 'spill'
+            c.memory_limit = 250
+            for key in xrange(1000, 1010):
+                c[key] = "%100d" % key
+            self.assertTrue(c.resident <= c.memory_limit)
+            self.assertEqual((c.resident, c.spills), (200, 8))
+            # Least recently used snapshots are spilled
+            self.assertTrue(isinstance(dict.__getitem__(c, 1000), CachedString))
+            self.assertFalse(isinstance(dict.__getitem__(c, 1009), CachedString))
+            self.assertEqual(str(c[1000]), "%100d" % 1000)
+            # Spilled snapshots do not go to the imagecache storage
+            spill_dir = c._spill_dir
+            self.assertFalse(spill_dir.startswith(config.data.path['imagecache']))
+            self.assertEqual(os.listdir(config.data.path['imagecache']), [])
+            self.assertEqual(len(os.listdir(spill_dir)), 8)
+            # Only save writes them there
+            d = c.save('spill')
+            self.assertEqual(len(os.listdir(d)), 10)
+            c.reset()
+            self.assertFalse(os.path.exists(spill_dir))
+            c[1000] = "%100d" % 1000
+            c.memory_limit = 0
+            c[1001] = "%100d" % 1001
+            spill_dir = c._spill_dir
+            self.assertTrue(os.path.isdir(spill_dir))
+            c.close()
+            self.assertFalse(os.path.exists(spill_dir))
+        finally:
+            shutil.rmtree(config.data.path['imagecache'])
+            config.data.path['imagecache'] = saved
+
+class SnapshotPackTestCase(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        import advene.core.config as config
+        get_config()
+        self.config = config
+        self.saved = (config.data.path['imagecache'], config.data.preferences['imagecache-storage'])
+        config.data.path['imagecache'] = tempfile.mkdtemp()
+        config.data.preferences['imagecache-storage'] = 'pack'
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.config.data.path['imagecache'])
+        self.config.data.path['imagecache'], self.config.data.preferences['imagecache-storage'] = self.saved
+
+    def snapshots(self, c):
+        return dict( (k, str(c[k])) for k in c.valid_snapshots() )
+
+    def test_save_load(self):
+        from advene.core.imagecache import ImageCache, PackedString
+        c = ImageCache()
+        for key in (0, 1000, 2000):
+            c[key] = "png %d" % key
+        fname = c.save('media')
+        self.assertTrue(isinstance(dict.__getitem__(c, 1000), PackedString))
+        c.close()
+        c = ImageCache(name='media')
+        self.assertEqual(self.snapshots(c), { 0: "png 0", 1000: "png 1000", 2000: "png 2000" })
+        # Updated snapshots supersede the saved ones
+        c[1000] = "new 1000"
+        c.save('media')
+        c.close()
+        c = ImageCache(name='media')
+        self.assertEqual(str(c[1000]), "new 1000")
+        self.assertEqual(len(c.valid_snapshots()), 3)
+        c.close()
+
+    def test_compact(self):
+        from advene.core.imagecache import ImageCache, SnapshotPack
+        c = ImageCache()
+        for key in xrange(10):
+            c[key * 100] = "%100d" % key
+        fname = c.save('media')
+        size = os.path.getsize(fname)
+        pack = c._pack
+        c[0] = "%100d" % 0
+        c.save('media')
+        # Not enough superseded records
+        self.assertEqual((pack.dead, os.path.getsize(fname)), (112, size + 112))
+        for key in xrange(1, 5):
+            c[key * 100] = "%100s" % key
+        c.save('media')
+        # Compacted
+        self.assertEqual((pack.dead, os.path.getsize(fname)), (0, size))
+        self.assertEqual(str(c[100]), "%100s" % 1)
+        self.assertEqual(str(c[900]), "%100d" % 9)
+        c.close()
+        p = SnapshotPack(fname)
+        self.assertEqual((len(p), p.dead), (10, 0))
+        p.close()
+
+    def test_migrate(self):
+        from advene.core.imagecache import ImageCache, migrate
+        self.config.data.preferences['imagecache-storage'] = 'directory'
+        c = ImageCache()
+        for key in (0, 1000, 2000):
+            c[key] = "png %d" % key
+        d = c.save('media')
+        self.assertEqual(migrate('media', remove=True), 3)
+        self.assertFalse(os.path.exists(d))
+        # Nothing left to migrate
+        self.assertEqual(migrate('media'), 0)
+        c = ImageCache(name='media')
+        self.assertEqual(self.snapshots(c), { 0: "png 0", 1000: "png 1000", 2000: "png 2000" })
+        c.close()
+
+class SerializeTestCase(unittest.TestCase):
+
+    def test_toxml(self):
+        from advene.util.expat import PyExpat
+        from advene.model.util.dom import writexml
+        source = u"""<a xmlns="urn:test" y="&quot;2&quot;" x="1"><b/><!-- c --><c>\xe9t\xe9 &amp; &lt;d&gt;</c>text<![CDATA[<e>]]></a>"""
+        e = PyExpat.Reader().fromString(source.encode('utf-8')).documentElement
+        for node in (e, e.ownerDocument):
+            out = StringIO()
+            writexml(node, out, encoding='utf8')
+            self.assertEqual(out.getvalue(), node.toxml(encoding='utf8'))
+
+class ZipPackageTestCase(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        from advene.model.zippackage import ZipPackage
+        self.dir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.dir, 'test.azp')
+        self.z = ZipPackage()
+        self.z.new()
+        self.write('content.xml', '<package/>')
+        self.write(os.path.join('resources', 'image.png'), 'x' * 10000)
+
+    def tearDown(self):
+        import shutil
+        self.z.close()
+        shutil.rmtree(self.dir)
+
+    def write(self, name, data):
+        f = open(self.z.tempfile(name), 'wb')
+        f.write(data)
+        f.close()
+
+    def infos(self):
+        import zipfile
+        z = zipfile.ZipFile(self.fname)
+        self.assertEqual(z.testzip(), None)
+        res = dict( (i.filename, (i.header_offset, i.compress_type, z.read(i.filename)))
+                    for i in z.infolist() )
+        self.assertEqual(len(res), len(z.infolist()))
+        z.close()
+        return res
+
+    def test_save(self):
+        import zipfile
+        self.z.save(self.fname)
+        before = self.infos()
+        self.assertEqual(before['resources/image.png'][1], zipfile.ZIP_STORED)
+        self.assertEqual(before['content.xml'][1], zipfile.ZIP_DEFLATED)
+        self.write('content.xml', '<package id="1"/>')
+        self.z.save(self.fname)
+        after = self.infos()
+        self.assertEqual(after['content.xml'][2], '<package id="1"/>')
+        self.assertEqual(after['resources/image.png'][2], 'x' * 10000)
+
+    def test_append(self):
+        self.z.save(self.fname)
+        before = self.infos()
+        self.write('content.xml', '<package id="1"/>')
+        self.write(os.path.join('resources', 'new.txt'), 'new')
+        self.z.save(self.fname, append=True)
+        after = self.infos()
+        # Unmodified members are not moved
+        self.assertEqual(after['resources/image.png'], before['resources/image.png'])
+        self.assertTrue(after['content.xml'][0] > before['content.xml'][0])
+        self.assertEqual(after['content.xml'][2], '<package id="1"/>')
+        self.assertTrue('resources/new.txt' in after['META-INF/manifest.xml'][2])
+
+    def test_append_rewrite(self):
+        self.z.save(self.fname)
+        size = os.path.getsize(self.fname)
+        # Replacing the image leaves too much unused space
+        self.write(os.path.join('resources', 'image.png'), 'y' * 10000)
+        self.z.save(self.fname, append=True)
+        after = self.infos()
+        self.assertEqual(after['resources/image.png'][2], 'y' * 10000)
+        self.assertTrue(os.path.getsize(self.fname) < size + 5000)
+
+class ExportController(object):
+    """Minimal controller for the website exporter.
+    """
+    def __init__(self, package):
+        self.package = package
+
+    def log(self, *p):
+        pass
+
+    def build_context(self, here=None):
+        from advene.model.tal.context import AdveneContext
+        return AdveneContext(here=here or self.package,
+                             options={ u'package_url': u'/packages/advene' })
+
+    def get_urlbase(self):
+        return 'http://localhost:1234/'
+
+    def get_default_media(self):
+        return ''
+
+class WebsiteExportTestCase(unittest.TestCase):
+
+    urls = [ 'v', '/packages/advene/view/v', 'unknown', '/packages/advene/view/w' ]
+
+    def setUp(self):
+        import tempfile
+        from advene.model.package import Package
+        self.path = get_config().data.path
+        self.saved = self.path['settings']
+        self.dir = tempfile.mkdtemp()
+        # Export manifests are stored in the settings directory
+        self.path['settings'] = os.path.join(self.dir, 'settings')
+        self.package = Package(uri="new_pkg", source=None)
+        schema = self.package.createSchema(ident="s")
+        self.package.schemas.append(schema)
+        at = schema.createAnnotationType(ident="at")
+        at.mimetype = "text/plain"
+        schema.annotationTypes.append(at)
+        for i in range(2):
+            a = self.package.createAnnotation(type=at, ident="a%d" % i,
+                                              fragment=MillisecondFragment(begin=i, end=i + 1))
+            a.content.data = "text %d" % i
+            self.package.annotations.append(a)
+        for ident in ('v', 'w'):
+            v = self.package.createView(ident=ident, clazz="package")
+            v.content.mimetype = "text/html"
+            v.content.data = '<p tal:content="here/annotations/a0/content/data">x</p>'
+            self.package.views.append(v)
+
+    def tearDown(self):
+        import shutil
+        self.path['settings'] = self.saved
+        shutil.rmtree(self.dir)
+
+    def exporter(self):
+        from advene.util.website_export import WebsiteExporter, VideoPlayer
+        destination = os.path.join(self.dir, 'site')
+        e = WebsiteExporter(ExportController(self.package), destination, video_url='')
+        e.video_player = VideoPlayer(destination, '')
+        e.load_manifest()
+        return e
+
+    def test_iter_contents(self):
+        e = self.exporter()
+        self.assertEqual(list(e.iter_contents(self.urls)),
+                         [ ('v', u'<p>text 0</p>'),
+                           ('/packages/advene/view/v', u'<p>text 0</p>'),
+                           ('unknown', None),
+                           ('/packages/advene/view/w', u'<p>text 0</p>') ])
+        # Urls addressing the same view are rendered once
+        self.assertEqual(e.rendered_count, 2)
+        self.assertEqual(e.pages['view/v'][0], set([ u'a0' ]))
+
+    def test_incremental(self):
+        e = self.exporter()
+        list(e.iter_contents(self.urls))
+        e.save_manifest()
+        e = self.exporter()
+        list(e.iter_contents(self.urls))
+        self.assertEqual(e.rendered_count, 0)
+        # Only the pages depending on the modified annotation are rendered
+        self.package.get_element_by_id('a1').content.data = "modified"
+        e = self.exporter()
+        list(e.iter_contents(self.urls))
+        self.assertEqual(e.rendered_count, 0)
+        self.package.get_element_by_id('a0').content.data = "modified"
+        e = self.exporter()
+        self.assertEqual(dict(e.iter_contents(self.urls))['v'], u'<p>modified</p>')
+        self.assertEqual(e.rendered_count, 2)
+
+    def test_prune(self):
+        e = self.exporter()
+        list(e.iter_contents(self.urls))
+        e.save_manifest()
+        self.assertEqual(os.listdir(e.destination), [])
+        e = self.exporter()
+        list(e.iter_contents(self.urls[:1]))
+        e.save_manifest(prune=True)
+        self.assertEqual(e.pages.keys(), [ 'view/v' ])
+        self.assertEqual(sorted(os.listdir(e.manifest_dir)),
+                         sorted([ 'manifest', os.path.basename(e.page_filename('view/v')) ]))
+
+    def test_resources(self):
+        from advene.model.package import Package
+        fname = os.path.join(self.dir, 'test.azp')
+        self.package.save(name=fname)
+        self.package = Package(uri=fname)
+        self.package.resources['r.txt'] = 'data'
+        self.package.get_element_by_id('v').content.data = '<p tal:content="here/resources/r.txt/data">x</p>'
+        e = self.exporter()
+        self.assertEqual(list(e.iter_contents(self.urls[:1])), [ ('v', u'<p>data</p>') ])
+        e.save_manifest()
+        self.package.resources['r.txt'].data = 'modified'
+        e = self.exporter()
+        self.assertEqual(list(e.iter_contents(self.urls[:1])), [ ('v', u'<p>modified</p>') ])
+        self.package.close()
+
+    def test_pool(self):
+        import multiprocessing
+        import advene.util.website_export as website_export
+        if not website_export.CAN_FORK:
+            return
+        e = self.exporter()
+        e.workers = 2
+        website_export._exporter = e
+        pool = multiprocessing.Pool(e.workers)
+        try:
+            contents = list(e.iter_contents(self.urls, pool))
+        finally:
+            pool.terminate()
+            website_export._exporter = None
+        self.assertEqual(contents, list(self.exporter().iter_contents(self.urls)))
+        self.assertEqual(e.pages['view/w'][0], set([ u'a0' ]))
+
+    def test_fix_links(self):
+        e = self.exporter()
+        e.url_translation.update({ '/packages/advene/annotations/a1': 'annotations_a1.html',
+                                   '/packages/advene/view/w': e.unconverted('w', 'test') })
+        self.assertEqual(e.fix_links('<a href="/packages/advene/annotations/a1">a</a>'
+                                     '<a href="/packages/advene/annotations/a1#f">b</a>'
+                                     '<a href="#top">c</a>'
+                                     "<a href='/packages/advene/view/w'>d</a>"
+                                     '<img src="/media/overlay/advene/a0"/>'),
+                         '<a href="annotations_a1.html">a</a>'
+                         '<a href="annotations_a1.html#f">b</a>'
+                         '<a href="#top">c</a>'
+                         '<a onClick="return false;" href=\'unconverted.html?url=w&reason=test\'>d</a>'
+                         '<img src="imagecache/overlay_a0.png"/>')
+
+#
+# Benchmarks. Run them with "python test.py benchmark [name...]"
+#
+
+def make_package_source(count):
+    """Return the XML source of a package with count annotations.
+    """
+    out = StringIO()
+    out.write('''<?xml version="1.0" encoding="utf-8"?>
+<package xml:base="bench" xmlns="http://experience.univ-lyon1.fr/advene/ns" xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:xlink="http://www.w3.org/1999/xlink"><imports/><annotations>''')
+    for i in xrange(count):
+        out.write('''<annotation id="a%d" type="#at%d"><millisecond-fragment begin="%d" end="%d"/><content encoding="utf-8">Annotation %d</content></annotation>'''
+                  % (i, i % 10, i * 100, i * 100 + 1500, i))
+    out.write('''</annotations><queries/><schemas><schema id="s"><annotation-types>''')
+    for i in xrange(10):
+        out.write('''<annotation-type id="at%d"><content-type mime-type="text/plain"/></annotation-type>''' % i)
+    out.write('''</annotation-types><relation-types/></schema></schemas><views/></package>''')
+    return out.getvalue()
+
+def make_package(count):
+    from advene.model.package import Package
+    return Package(uri="bench.xml", source=StringIO(make_package_source(count)))
+
+def timeit(label, count, function, *args):
+    t = time.time()
+    function(*args)
+    d = time.time() - t
+    print "%-40s %8.3fs %10.3f us/item" % (label, d, d * 1e6 / count)
+
+def get_config():
+    """Return the advene configuration, fixed when running from the source tree.
+    """
+    import os
+    import advene.core.config as config
+    if not os.path.exists(config.data.advenefile( ('pixmaps', 'notavailable.png') )):
+        # Running from the source tree
+        config.data.fix_paths(os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                           '..', '..', '..')))
+    return config
+
+def benchmark_fragment(count=50000):
+    """Per-access cost of fragment begin/end values.
+    """
+    package = make_package(count)
+    fragments = [ a.fragment for a in package.annotations ]
+    def dom_access():
+        for f in fragments:
+            long(f._getModel().getAttributeNS(None, 'begin'))
+            long(f._getModel().getAttributeNS(None, 'end'))
+    def property_access():
+        for f in fragments:
+            f.begin
+            f.end
+    timeit("DOM attribute access (before)", 2 * count, dom_access)
+    # The first access parses and caches the values
+    timeit("fragment access, first time", 2 * count, property_access)
+    timeit("fragment access, cached", 2 * count, property_access)
+
+def measure(function, *args):
+    """Run function in a child process.
+
+    Return the wall time and the peak RSS (in kB) of the child.
+    """
+    import os
+    import resource
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        t = time.time()
+        function(*args)
+        d = time.time() - t
+        os.write(w, "%f %d" % (d, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+        os._exit(0)
+    os.close(w)
+    data = os.read(r, 1024)
+    os.close(r)
+    os.waitpid(pid, 0)
+    d, rss = data.split()
+    return float(d), int(rss)
+
+def benchmark_serialize(count=200000):
+    """Save time and peak RSS of toxml and of the streaming serializer.
+    """
+    import os
+    import tempfile
+    p = make_package(count)
+    fd, name = tempfile.mkstemp(suffix='.xml')
+    os.close(fd)
+    def toxml():
+        f = open(name, 'wb')
+        f.write(p._getModel().toxml(encoding='utf8'))
+        f.close()
+    def serialize():
+        f = open(name, 'wb')
+        p.serialize(f)
+        f.close()
+    try:
+        # Baseline: memory used by the loaded package
+        d, base = measure(lambda: None)
+        for (label, function) in (('toxml', toxml), ('serialize', serialize)):
+            d, rss = measure(function)
+            print "%-10s %8.3fs %10d kB" % (label, d, rss - base)
+    finally:
+        os.unlink(name)
+
+def benchmark_loader(count=100000):
+    """Load time and peak RSS of the dom and streaming package loaders.
+    """
+    import os
+    import tempfile
+    from advene.model.package import Package
+    fd, name = tempfile.mkstemp(suffix='.xml')
+    os.write(fd, make_package_source(count))
+    os.close(fd)
+    def load(loader, access):
+        p = Package(uri=name, loader=loader)
+        if access == 'indexes':
+            p.getTimeIndex()
+            p._get_annotation_type_index()
+            p.annotations_at(0)
+        elif access == 'iteration':
+            for a in p.annotations:
+                a.fragment.begin
+    try:
+        # Baseline: memory used by the interpreter and the modules
+        d, base = measure(lambda: None)
+        for access in (None, 'indexes', 'iteration'):
+            for loader in ('dom', 'streaming'):
+                d, rss = measure(load, loader, access)
+                print "%-10s %-25s %8.3fs %10d kB" % (loader,
+                                                     access and "load + " + access or "load",
+                                                     d, rss - base)
+    finally:
+        os.unlink(name)
+
+def benchmark_tales(count=100000):
+    """Evaluation of TALES path expressions on every annotation.
+    """
+    from advene.model.tal.context import AdveneContext
+    package = make_package(count)
+    annotations = list(package.annotations)
+    # Do not measure the creation of the fragments
+    for a in annotations:
+        a.fragment
+    context = AdveneContext(here=package)
+    context.addGlobal('package', package)
+    def evaluate(expr):
+        for a in annotations:
+            context.addGlobal('here', a)
+            context.evaluateValue(expr)
+    for expr in ('here/fragment/begin', 'here/type/id', 'package/annotationTypes/at3'):
+        timeit(expr, count, evaluate, expr)
+
+def benchmark_snapshots(count=50000):
+    """Load time of an imagecache stored as a directory and as a pack.
+    """
+    import os
+    import shutil
+    import tempfile
+    config = get_config()
+    import advene.core.imagecache as imagecache
+    config.data.path['imagecache'] = tempfile.mkdtemp()
+    try:
+        d = os.path.join(config.data.path['imagecache'], 'bench')
+        os.mkdir(d)
+        for i in xrange(count):
+            f = open(os.path.join(d, "%010d.png" % (i * 40)), 'wb')
+            f.write(os.urandom(1024))
+            f.close()
+        def load():
+            c = imagecache.ImageCache()
+            c.load('bench')
+            return c
+        def read(c):
+            for k in c.valid_snapshots():
+                str(c.get(k))
+        timeit("directory: load", count, load)
+        timeit("directory: read all", count, read, load())
+        timeit("migration", count, imagecache.migrate, 'bench', True)
+        timeit("pack: load", count, load)
+        timeit("pack: read all", count, read, load())
+    finally:
+        shutil.rmtree(config.data.path['imagecache'])
+
+def benchmark_import(count=100000):
+    """Throughput of the SRT, PRAAT and sound envelope importers.
+    """
+    import os
+    import tempfile
+    get_config()
+    import advene.util.importer as importer
+    def srt(f):
+        for i in xrange(count):
+            t = i * 2000
+            f.write("%d\n00:%02d:%02d,%03d --> 00:%02d:%02d,%03d\nSubtitle %d\n\n"
+                    % (i + 1,
+                       t / 60000 % 60, t / 1000 % 60, t % 1000,
+                       (t + 1500) / 60000 % 60, (t + 1500) / 1000 % 60, (t + 1500) % 1000,
+                       i))
+    def praat(f):
+        f.write('File type = "ooTextFile"\nObject class = "TextGrid"\n\n'
+                'item []:\n    item [1]:\n        class = "IntervalTier"\n'
+                '        name = "words"\n        xmin = 0\n')
+        for i in xrange(count):
+            f.write('        intervals [%d]:\n            xmin = %.3f\n'
+                    '            xmax = %.3f\n            text = "word %d"\n'
+                    % (i + 1, i * .5, i * .5 + .4, i))
+    def envelope():
+        # Records as generated by the soundenveloppe plugin
+        values = " ".join("%.02f" % (i * 3.3) for i in xrange(10))
+        i = importer.GenericImporter()
+        i.convert( { 'begin': t * 100, 'end': t * 100 + 100, 'content': values }
+                   for t in xrange(count) )
+    for (name, generate, cls) in (('srt', srt, importer.SubtitleImporter),
+                                  ('textgrid', praat, importer.PraatImporter)):
+        fd, fname = tempfile.mkstemp(suffix='.' + name)
+        f = os.fdopen(fd, 'w')
+        generate(f)
+        f.close()
+        try:
+            timeit(name, count, cls().process_file, fname)
+        finally:
+            os.unlink(fname)
+    timeit('sound envelope', count, envelope)
+
+def benchmark_idgenerator(count=100000):
+    """Creation and deletion of elements with the id generator.
+    """
+    get_config()
+    from advene.core.idgenerator import Generator
+    from advene.model.annotation import Annotation
+    package = make_package(0)
+    at = package.annotationTypes[0]
+    generator = Generator(package)
+    def create():
+        # As done by the controller notify method
+        for i in xrange(count):
+            a = package.createAnnotation(type=at,
+                                         ident=generator.get_id(Annotation),
+                                         fragment=MillisecondFragment(begin=i, end=i + 1))
+            generator.add(a.id)
+    def create_many():
+        ids = generator.get_ids(Annotation, count)
+        package.createAnnotations( { 'type': at, 'ident': i, 'begin': 0, 'end': 1 }
+                                   for i in ids )
+    def titles():
+        for i in xrange(count / 10):
+            title, ident = generator.new_from_title("view")
+            generator.add(ident)
+    def delete():
+        for i in xrange(count):
+            generator.remove("a%d" % i)
+    timeit('get_id + add', count, create)
+    timeit('get_ids', count, create_many)
+    timeit('new_from_title', count / 10, titles)
+    timeit('remove', count, delete)
+
+def benchmark_parsed(count=100000):
+    """Evaluation of here/content/parsed/num on every annotation.
+    """
+    from advene.model.tal.context import AdveneContext
+    import advene.model.content as content
+    package = make_package(count)
+    for at in package.annotationTypes:
+        at.mimetype = 'application/x-advene-structured'
+    annotations = list(package.annotations)
+    for a in annotations:
+        a.content.data = "num=%s\ntitle=Annotation %s" % (a.id, a.id)
+    context = AdveneContext(here=package)
+    def evaluate():
+        for a in annotations:
+            context.addGlobal('here', a)
+            context.evaluateValue('here/content/parsed/num')
+    content.parsed_cache.clear()
+    timeit('first evaluation', count, evaluate)
+    timeit('second evaluation', count, evaluate)
+    print "Hit rate: %.2f" % content.parsed_cache.hit_rate()
+
+BENCHMARKS = {
+    'fragment': benchmark_fragment,
+    'idgenerator': benchmark_idgenerator,
+    'import': benchmark_import,
+    'loader': benchmark_loader,
+    'parsed': benchmark_parsed,
+    'serialize': benchmark_serialize,
+    'tales': benchmark_tales,
+    'snapshots': benchmark_snapshots,
+    }
 
 if __name__ == "__main__":
-    testsuite = unittest.defaultTestLoader.loadTestsFromTestCase(ModeledTestCase)
+    if sys.argv[1:2] == [ 'benchmark' ]:
+        for name in (sys.argv[2:] or sorted(BENCHMARKS)):
+            print "Benchmark %s: %s" % (name, BENCHMARKS[name].__doc__.strip())
+            BENCHMARKS[name]()
+        sys.exit(0)
+    testsuite = unittest.TestSuite((
+        unittest.defaultTestLoader.loadTestsFromTestCase(ModeledTestCase),
+        unittest.defaultTestLoader.loadTestsFromTestCase(TimeIndexTestCase),
+        unittest.defaultTestLoader.loadTestsFromTestCase(CreateAnnotationsTestCase),
+        unittest.defaultTestLoader.loadTestsFromTestCase(LazyBundleTestCase),
+        unittest.defaultTestLoader.loadTestsFromTestCase(StreamingLoaderTestCase),
+        unittest.defaultTestLoader.loadTestsFromTestCase(TitleCacheTestCase),
+        unittest.defaultTestLoader.loadTestsFromTestCase(RuleFilterTestCase),
+        unittest.defaultTestLoader.loadTestsFromTestCase(IdGeneratorTestCase),
+        unittest.defaultTestLoader.loadTestsFromTestCase(TemplateCacheTestCase),
+        unittest.defaultTestLoader.loadTestsFromTestCase(DependenciesTestCase),
+        unittest.defaultTestLoader.loadTestsFromTestCase(ParsedCacheTestCase),
+        unittest.defaultTestLoader.loadTestsFromTestCase(ValuesTestCase),
+        unittest.defaultTestLoader.loadTestsFromTestCase(EventHistoryTestCase),
+        unittest.defaultTestLoader.loadTestsFromTestCase(ImageCacheTestCase),
+        unittest.defaultTestLoader.loadTestsFromTestCase(SnapshotPackTestCase),
+        unittest.defaultTestLoader.loadTestsFromTestCase(SerializeTestCase),
+        unittest.defaultTestLoader.loadTestsFromTestCase(ZipPackageTestCase),
+        unittest.defaultTestLoader.loadTestsFromTestCase(WebsiteExportTestCase),
+        ))
     testrunner = unittest.TextTestRunner()
     testrunner.run(testsuite)
@@ -0,0 +1,311 @@
+#
+# Advene: Annotate Digital Videos, Exchange on the NEt
+# Copyright (C) 2008-2012 Olivier Aubert <olivier.aubert@liris.cnrs.fr>
+#
+# Advene is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Advene is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Advene; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+"""Temporal index of annotations.
+
+The index maintains the annotations of a package in two sorted arrays,
+ordered by begin and by end time, so that time-based queries (what is
+active at t, what overlaps [a, b], what starts next) are answered by
+binary search instead of a full scan of the package annotations.
+
+Stabbing and overlap queries use a third structure: the annotations
+are partitioned into duration classes (powers of 2), each holding its
+own array sorted by begin time. In a class, the annotations
+overlapping [start, stop] begin after start minus the maximum duration
+of the class, so that long annotations (a whole film, chapters) do not
+make the queries scan the short ones.
+
+Items are returned as (annotation, begin, end) triplets, sorted by
+begin (resp. end) time.
+
+The index of the package annotations is keyed by the annotation ids,
+and built from the fields of their elements (see
+bundle.LazyXmlBundle): the annotations are only created when they are
+returned by a query.
+
+The index is maintained by the package annotations bundle (insertion
+and deletion) and by MillisecondFragment (modification of begin/end).
+"""
+
+from bisect import bisect_left, bisect_right, insort
+from itertools import islice, chain
+
+from advene.model.fragment import MillisecondFragment
+
+# Sentinel greater than any time value, used as the second item of
+# bisect keys to get the position *after* all entries with a given
+# begin (resp. end) time.
+_INF = float('inf')
+
+def _duration_class(b, e):
+    """Return the duration class of an interval.
+
+    Class 0 holds the empty (or inverted) intervals, class c > 0 the
+    intervals whose duration is in [2**(c-1), 2**c).
+    """
+    d = e - b
+    if d <= 0:
+        return 0
+    return long(d).bit_length()
+
+def _class_bound(c):
+    """Return the maximum duration of the intervals of class c.
+    """
+    if c == 0:
+        return 0
+    return (1L << c) - 1
+
+class TimeIndex(object):
+    """Temporal index over a collection of annotations.
+
+    Only annotations with a MillisecondFragment are indexed.
+
+    If the collection is a LazyXmlBundle, the index is keyed by the
+    annotation ids, and the annotations are looked up in the bundle.
+    Else it is keyed by id(annotation) and holds the annotations.
+    """
+    def __init__(self, annotations=()):
+        # Sorted lists of (begin, end, key) and (end, begin, key)
+        # tuples
+        self._begins = []
+        self._ends = []
+        # duration class -> sorted list of (begin, end, key) tuples
+        # (see _duration_class), used by stabbing queries
+        self._classes = {}
+        # key -> (begin, end)
+        self._items = {}
+
+        if hasattr(annotations, '_iter_index_fields'):
+            self._bundle = annotations
+            self._objects = None
+            self._add_fields(annotations._iter_index_fields())
+        else:
+            self._bundle = None
+            # key -> annotation
+            self._objects = {}
+            self.add_many(annotations)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, annotation):
+        return self._key(annotation) in self._items
+
+    def _key(self, annotation):
+        if self._bundle is None:
+            return id(annotation)
+        return annotation.getId()
+
+    def _get(self, key):
+        if self._bundle is None:
+            return self._objects[key]
+        return self._bundle._get_by_key(key)
+
+    def _fields(self, annotation):
+        """Return the (key, type, begin, end, timed) fields of an annotation.
+        """
+        if self._bundle is not None:
+            return self._bundle._item_fields(annotation)
+        f = annotation.getFragment()
+        if isinstance(f, MillisecondFragment):
+            return (id(annotation), None, f.getBegin(), f.getEnd(), True)
+        return (id(annotation), None, None, None, False)
+
+    #
+    # Maintenance
+    #
+
+    def add(self, annotation):
+        """Add an annotation to the index.
+        """
+        k, t, b, e, timed = self._fields(annotation)
+        if not timed:
+            return
+        if k in self._items:
+            self.__remove(k)
+        if self._objects is not None:
+            self._objects[k] = annotation
+        self._items[k] = (b, e)
+        insort(self._begins, (b, e, k))
+        insort(self._ends, (e, b, k))
+        insort(self._classes.setdefault(_duration_class(b, e), []), (b, e, k))
+
+    def add_many(self, annotations):
+        """Add annotations to the index.
+
+        The sorted arrays are updated once, which is faster than
+        successive calls to add for large numbers of annotations.
+        """
+        fields = []
+        for a in annotations:
+            f = self._fields(a)
+            if f[4] and self._objects is not None:
+                self._objects[f[0]] = a
+            fields.append(f)
+        self._add_fields(fields)
+
+    def _add_fields(self, fields):
+        """Add the annotations with the given (key, type, begin, end, timed) fields.
+        """
+        begins = []
+        for (k, t, b, e, timed) in fields:
+            if not timed:
+                continue
+            if k in self._items:
+                self.__remove(k)
+            self._items[k] = (b, e)
+            begins.append( (b, e, k) )
+        self._begins.extend(begins)
+        self._begins.sort()
+        self._ends.extend( (e, b, k) for (b, e, k) in begins )
+        self._ends.sort()
+        modified = set()
+        for t in begins:
+            c = _duration_class(t[0], t[1])
+            self._classes.setdefault(c, []).append(t)
+            modified.add(c)
+        for c in modified:
+            self._classes[c].sort()
+
+    def remove(self, annotation):
+        """Remove an annotation from the index.
+
+        Annotations which are not indexed are silently ignored.
+        """
+        k = self._key(annotation)
+        if k in self._items:
+            self.__remove(k)
+            if self._objects is not None:
+                del self._objects[k]
+
+    def __remove(self, k):
+        b, e = self._items.pop(k)
+        del self._begins[bisect_left(self._begins, (b, e, k))]
+        del self._ends[bisect_left(self._ends, (e, b, k))]
+        c = _duration_class(b, e)
+        l = self._classes[c]
+        del l[bisect_left(l, (b, e, k))]
+        if not l:
+            del self._classes[c]
+
+    def update(self, annotation):
+        """Update the index after a modification of the annotation fragment.
+
+        Annotations which are not indexed are silently ignored.
+        """
+        if self._key(annotation) in self._items:
+            self.remove(annotation)
+            self.add(annotation)
+
+    #
+    # Queries
+    #
+
+    def _overlapping(self, start, stop):
+        """Return the triplets such that begin <= stop and end >= start.
+        """
+        found = []
+        for c, l in self._classes.iteritems():
+            lo = bisect_left(l, (start - _class_bound(c), ))
+            hi = bisect_right(l, (stop, _INF))
+            r = [ t for t in l[lo:hi] if t[1] >= start ]
+            if r:
+                found.append(r)
+        if len(found) > 1:
+            found = [ sorted(chain(*found)) ]
+        get = self._get
+        return [ (get(k), b, e) for (b, e, k) in chain(*found) ]
+
+    def annotations_at(self, t):
+        """Return the annotations active at time t (begin <= t <= end).
+        """
+        return self._overlapping(t, t)
+
+    def annotations_between(self, start, stop):
+        """Return the annotations overlapping the [start, stop] interval.
+        """
+        return self._overlapping(start, stop)
+
+    def iter_begins(self, t, strict=False):
+        """Iterate over the annotations beginning at or after t, in begin order.
+
+        If strict is True, only annotations beginning strictly after t
+        are considered.
+
+        The index must not be modified while iterating.
+        """
+        if strict:
+            i = bisect_right(self._begins, (t, _INF))
+        else:
+            i = bisect_left(self._begins, (t, ))
+        get = self._get
+        l = self._begins
+        # islice would skip the first i items one by one
+        return ( (get(l[j][2]), l[j][0], l[j][1]) for j in xrange(i, len(l)) )
+
+    def iter_ends(self, t, strict=False):
+        """Iterate over the annotations ending at or after t, in end order.
+
+        If strict is True, only annotations ending strictly after t
+        are considered.
+
+        The index must not be modified while iterating.
+        """
+        if strict:
+            i = bisect_right(self._ends, (t, _INF))
+        else:
+            i = bisect_left(self._ends, (t, ))
+        get = self._get
+        l = self._ends
+        # islice would skip the first i items one by one
+        return ( (get(l[j][2]), l[j][1], l[j][0]) for j in xrange(i, len(l)) )
+
+    def next_begins_after(self, t, n=1):
+        """Return the first n annotations beginning strictly after t.
+        """
+        return list(islice(self.iter_begins(t, strict=True), n))
+
+    def begins_from(self, t, count):
+        """Return a window of the annotations beginning at or after t.
+
+        At least count items are returned (if available). All the
+        annotations sharing the begin time of the last returned item
+        are included, so that the next window can be requested from
+        this begin time + 1.
+        """
+        return self.__window(self.iter_begins(t), count, 1)
+
+    def ends_from(self, t, count):
+        """Return a window of the annotations ending at or after t.
+
+        At least count items are returned (if available). All the
+        annotations sharing the end time of the last returned item
+        are included, so that the next window can be requested from
+        this end time + 1.
+        """
+        return self.__window(self.iter_ends(t), count, 2)
+
+    def __window(self, iterator, count, field):
+        res = list(islice(iterator, count))
+        if len(res) == count:
+            last = res[-1][field]
+            for t in iterator:
+                if t[field] != last:
+                    break
+                res.append(t)
+        return res
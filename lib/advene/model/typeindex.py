@@ -0,0 +1,186 @@
+#
+# Advene: Annotate Digital Videos, Exchange on the NEt
+# Copyright (C) 2008-2012 Olivier Aubert <olivier.aubert@liris.cnrs.fr>
+#
+# Advene is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Advene is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Advene; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+"""Index of annotations and relations by type.
+
+The index holds, for each type, the sorted list of its elements, so that
+AnnotationType.getAnnotations and RelationType.getRelations do not have
+to scan the whole package. Types are designated by their absolute URI.
+
+As the time index, the index of the package annotations is keyed by
+the annotation ids and built from the fields of their elements (see
+bundle.LazyXmlBundle).
+
+The index is maintained by the package bundles (insertion and deletion),
+by the setType methods of annotations and relations, and, for
+annotations, by MillisecondFragment (modification of begin/end).
+"""
+
+from bisect import bisect_left, insort
+from itertools import count
+
+class TypeIndex(object):
+    """Index of elements by type.
+
+    Elements are kept in insertion order. Subclasses can override the
+    _sort_key method to define another order.
+
+    If the collection is a LazyXmlBundle, the index is keyed by the
+    element ids, and the elements are looked up in the bundle. Else it
+    is keyed by id(element) and holds the elements.
+    """
+    def __init__(self, elements=()):
+        # type URI -> sorted list of (sort key, key)
+        self._lists = {}
+        # key -> (type URI, sort key)
+        self._items = {}
+        self._counter = count()
+        if hasattr(elements, '_iter_index_fields'):
+            self._bundle = elements
+            self._objects = None
+            self._add_fields(elements._iter_index_fields())
+        else:
+            self._bundle = None
+            # key -> element
+            self._objects = {}
+            self.add_many(elements)
+
+    def _sort_key(self, begin, end, rank):
+        """Return the sort key of an element.
+
+        begin and end are the bounds of its fragment, if any. rank is
+        the insertion rank of the element. Keys must be unique, so it
+        should be the last item of the key.
+        """
+        return (rank, )
+
+    def _key(self, element):
+        if self._bundle is None:
+            return id(element)
+        return element.getId()
+
+    def _get(self, key):
+        if self._bundle is None:
+            return self._objects[key]
+        return self._bundle._get_by_key(key)
+
+    def _fields(self, element):
+        """Return the (key, type URI, begin, end, timed) fields of an element.
+        """
+        if self._bundle is not None:
+            return self._bundle._item_fields(element)
+        return (id(element), element.getType().getUri(absolute=True),
+                None, None, False)
+
+    def get(self, type_):
+        """Return the list of elements of the given type.
+        """
+        get = self._get
+        return [ get(k) for (s, k) in
+                 self._lists.get(type_.getUri(absolute=True), ()) ]
+
+    def add(self, element):
+        """Add an element to the index.
+        """
+        k, t, b, e, timed = self._fields(element)
+        self.__remove(k)
+        if self._objects is not None:
+            self._objects[k] = element
+        self.__insert(k, t, self._sort_key(b, e, self._counter.next()))
+
+    def add_many(self, elements):
+        """Add elements to the index.
+
+        Each list is sorted once, which is faster than successive calls
+        to add for large numbers of elements.
+        """
+        fields = []
+        for e in elements:
+            f = self._fields(e)
+            if self._objects is not None:
+                self._objects[f[0]] = e
+            fields.append(f)
+        self._add_fields(fields)
+
+    def _add_fields(self, fields):
+        """Add the elements with the given (key, type URI, begin, end, timed) fields.
+        """
+        modified = set()
+        for (k, t, b, e, timed) in fields:
+            self.__remove(k)
+            s = self._sort_key(b, e, self._counter.next())
+            self._lists.setdefault(t, []).append( (s, k) )
+            self._items[k] = (t, s)
+            modified.add(t)
+        for t in modified:
+            self._lists[t].sort()
+
+    def remove(self, element):
+        """Remove an element from the index.
+
+        Elements which are not indexed are silently ignored.
+        """
+        k = self._key(element)
+        if self.__remove(k) and self._objects is not None:
+            del self._objects[k]
+
+    def __remove(self, k):
+        v = self._items.pop(k, None)
+        if v is None:
+            return False
+        t, s = v
+        l = self._lists[t]
+        del l[bisect_left(l, (s, ))]
+        if not l:
+            del self._lists[t]
+        return True
+
+    def update(self, element):
+        """Update the index after a modification of the element.
+
+        Elements which are not indexed are silently ignored.
+        """
+        v = self._items.get(self._key(element))
+        if v is None:
+            return
+        t, s = v
+        k, type_uri, b, e, timed = self._fields(element)
+        new = self._sort_key(b, e, s[-1])
+        if t != type_uri or s != new:
+            self.__remove(k)
+            self.__insert(k, type_uri, new)
+
+    def __insert(self, k, t, s):
+        insort(self._lists.setdefault(t, []), (s, k))
+        self._items[k] = (t, s)
+
+class AnnotationTypeIndex(TypeIndex):
+    """Index of annotations by type, sorted by begin time.
+
+    Annotations with the same begin and end times are kept in insertion
+    order.
+    """
+    def _sort_key(self, begin, end, rank):
+        return (begin, end, rank)
+
+    def _fields(self, element):
+        if self._bundle is not None:
+            return self._bundle._item_fields(element)
+        f = element.getFragment()
+        return (id(element), element.getType().getUri(absolute=True),
+                f.getBegin(), f.getEnd(), False)
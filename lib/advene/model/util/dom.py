@@ -35,3 +35,86 @@ def printElementText(element, stream):
     elif element.nodeType is ELEMENT_NODE:
         for e in element.childNodes:
             printElementText(e, stream)
+
+class EncodingWriter(object):
+    """Writer encoding the written data into a stream.
+
+    Data is buffered, so that the many small writes done by the DOM
+    serialization do not end up as many small writes to the stream.
+    """
+    def __init__(self, stream, encoding='utf-8', size=65536):
+        self.stream = stream
+        self.encoding = encoding
+        self.size = size
+        self._buffer = []
+        self._length = 0
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._length += len(data)
+        if self._length >= self.size:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            self.stream.write(u''.join(self._buffer).encode(self.encoding))
+            self._buffer = []
+            self._length = 0
+
+def _escape(data):
+    # Same escaping as xml.dom.minidom
+    return data.replace("&", "&amp;").replace("<", "&lt;").replace("\"", "&quot;").replace(">", "&gt;")
+
+def _write_element(element, writer, children=None):
+    """Write an element, as Element.writexml does without indentation.
+
+    children optionally maps elements to the nodes to write instead of
+    their child nodes (see writexml).
+    """
+    write = writer.write
+    write("<" + element.tagName)
+    for (name, value) in sorted(element.attributes.items()):
+        write(' %s="%s"' % (name, _escape(value)))
+    nodes = element.childNodes
+    if children is not None:
+        nodes = children.get(element, nodes)
+    empty = True
+    for node in nodes:
+        if empty:
+            write(">")
+            empty = False
+        if isinstance(node, unicode):
+            write(node)
+            continue
+        t = node.nodeType
+        if t == ELEMENT_NODE:
+            _write_element(node, writer, children)
+        elif t == TEXT_NODE:
+            if node.data:
+                write(_escape(node.data))
+        else:
+            node.writexml(writer, "", "", "")
+    if empty:
+        write("/>")
+    else:
+        write("</%s>" % element.tagName)
+
+def writexml(node, stream, encoding='utf-8', children=None):
+    """Serialize a DOM node into a stream.
+
+    The output is the same as node.toxml(encoding) (without XML
+    declaration for element nodes), but it is written as it is
+    generated instead of being built in memory.
+
+    children optionally maps elements to an iterable of the nodes to
+    write instead of their child nodes. unicode items are written as
+    is, as XML source.
+    """
+    writer = EncodingWriter(stream, encoding)
+    if node.nodeType == node.DOCUMENT_NODE:
+        node.writexml(writer, "", "", "", encoding)
+    elif node.nodeType == ELEMENT_NODE:
+        _write_element(node, writer, children)
+    else:
+        node.writexml(writer, "", "", "")
+    writer.flush()
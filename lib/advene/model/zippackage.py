@@ -45,6 +45,13 @@
                 available through the TALES expression /package/resources/...
     meta.xml: metadata (cf OpenDocument specification)
     META-INF/manifest.xml : Manifest (package contents)
+
+  Saving is incremental: the members which were not modified since
+  they were extracted (or saved) are copied as is from the previous
+  archive, without being decompressed and recompressed. Already
+  compressed files (images, audio, video...) are stored without
+  compression. With append=True, the modified members are appended to
+  the archive instead of rewriting it.
   """
 
 import zipfile
@@ -54,6 +61,8 @@ import tempfile
 import re
 import shutil
 import urllib
+import struct
+import advene.core.config as config
 from advene.model.exception import AdveneException
 from advene.model.resources import Resources
 import mimetypes
@@ -75,10 +84,83 @@ MIMETYPE='application/x-advene-zip-package'
 MANIFEST="urn:oasis:names:tc:opendocument:xmlns:manifest:1.0"
 ET._namespace_map[MANIFEST]='manifest'
 
+# Extensions of files which are already compressed, and are stored
+# as is in the zip file.
+STORED_EXTENSIONS=frozenset( ('.png', '.jpg', '.jpeg', '.gif',
+                              '.mp3', '.ogg', '.oga', '.ogv', '.m4a',
+                              '.mp4', '.m4v', '.avi', '.mkv', '.mov',
+                              '.webm', '.flv', '.zip', '.gz', '.bz2',
+                              '.azp', '.pack') )
+
+# Local file header of a zip member, from the zip specification. The
+# zipfile module does not expose it.
+_LOCAL_HEADER=struct.Struct('<4s2B4HL2L2H')
+_LOCAL_HEADER_MAGIC='PK\003\004'
+
+def _skip_local_header(fp):
+    """Skip the local header of the zip member at the current position of fp.
+    """
+    h=_LOCAL_HEADER.unpack(fp.read(_LOCAL_HEADER.size))
+    if h[0] != _LOCAL_HEADER_MAGIC:
+        raise AdveneException(_("Bad zip member header"))
+    # File name and extra field lengths
+    fp.seek(h[10] + h[11], 1)
+
+def _local_member_size(info):
+    """Return the size of a zip member in the file (header and data).
+    """
+    return _LOCAL_HEADER.size + len(info.filename) + len(info.extra) + info.compress_size
+
+def _directory_offset(z):
+    """Return the offset of the central directory of the ZipFile z.
+    """
+    try:
+        return z.start_dir
+    except AttributeError:
+        return max([ i.header_offset + _local_member_size(i) for i in z.filelist ] or [ 0 ])
+
+def _set_modified(z):
+    """Make the ZipFile z write its central directory when it is closed.
+
+    zipfile only writes it if its private _didModify attribute is set.
+    Versions without this attribute always write it.
+    """
+    z._didModify=True
+
+def stamp(fname):
+    """Return a (size, mtime) tuple used to detect file modifications.
+    """
+    st=os.stat(fname)
+    return (st.st_size, st.st_mtime)
+
+def member_name(info):
+    """Return the name of a zip member, as a utf-8 encoded string.
+    """
+    if isinstance(info.filename, unicode):
+        return info.filename.encode('utf-8')
+    return info.filename
+
 class ZipPackage:
+    """Expanded AZP package.
+
+    @ivar _archive: the zip file holding the unmodified members
+    @type _archive: string
+    @ivar _infos: the ZipInfo of the members of _archive, by name
+    @type _infos: dict
+    @ivar _stamps: the stamps of the expanded members, as stored in _archive
+    @type _stamps: dict
+    @ivar _modified: the names of the members explicitly marked as modified
+    @type _modified: set
+    """
     # Global method for cleaning up
     tempdir_list = []
 
+    # Appending to an archive leaves the replaced members in the
+    # file. When their size is greater than GARBAGE_RATIO * the size
+    # of the live data, or than GARBAGE_LIMIT, the archive is rewritten.
+    GARBAGE_RATIO = .5
+    GARBAGE_LIMIT = 32 * 1024 * 1024
+
     def cleanup():
         """Remove the temp. directories used during the session.
 
@@ -101,6 +183,12 @@ class ZipPackage:
         self._tempdir = None
         self.file_ = None
 
+        self._archive = None
+        self._archive_stamp = None
+        self._infos = {}
+        self._stamps = {}
+        self._modified = set()
+
         if uri:
             # os.stat seems to not grok unicode pathnames with
             # accents. Pass it an encoded string.
@@ -212,6 +300,7 @@ class ZipPackage:
                 outfile.write(z.read(name))
                 outfile.close()
 
+        self._set_archive(z.filename, z.infolist())
         z.close()
 
         # Create the resources directory if necessary
@@ -220,6 +309,140 @@ class ZipPackage:
             os.mkdir(resource_dir)
         return self._tempdir
 
+    def _set_archive(self, fname, infos):
+        """Record fname as the archive holding the current members.
+        """
+        self._archive = fname
+        self._archive_stamp = stamp(fname)
+        self._infos = {}
+        self._stamps = {}
+        for info in infos:
+            name = member_name(info)
+            if name.endswith('/'):
+                continue
+            n = self.tempfile(unicode(name, 'utf-8').replace('/', os.path.sep))
+            if os.path.exists(n):
+                self._infos[name] = info
+                self._stamps[name] = stamp(n)
+        self._modified.clear()
+
+    def set_modified(self, name):
+        """Mark a member as modified.
+
+        Modifications are also detected from the file size and
+        modification time, but this check cannot catch all changes.
+
+        @param name: the member name (/ separated)
+        @type name: unicode or string
+        """
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        self._modified.add(name)
+
+    def is_modified(self, name, fname):
+        """Check if a member was modified since it was stored in the archive.
+
+        @param name: the member name, as a utf-8 string
+        @param fname: the expanded file name
+        """
+        return (name in self._modified
+                or name not in self._infos
+                or self._stamps.get(name) != stamp(fname))
+
+    def _members(self):
+        """Return the list of (name, filename) of the expanded members.
+
+        The manifest is not included.
+        """
+        res = []
+        for (dirpath, dirnames, filenames) in os.walk(self._tempdir):
+            # Ignore RCS directory paths
+            for d in ('.svn', 'CVS', '_darcs', '.bzr'):
+                if d in dirnames:
+                    dirnames.remove(d)
+
+            # Remove tempdir prefix
+            zpath=dirpath.replace(self._tempdir, '')
+
+            # Normalize os.path.sep to UNIX pathsep (/)
+            zpath=zpath.replace(os.path.sep, '/', -1)
+            if zpath and zpath[0] == '/':
+                # We should have only a relative subdir here
+                zpath=zpath[1:]
+
+            for f in filenames:
+                if f == 'manifest.xml':
+                    # We will write it later on.
+                    continue
+                if zpath:
+                    name='/'.join( (zpath, f) )
+                else:
+                    name=f
+                if isinstance(name, str):
+                    name=unicode(name, _fs_encoding)
+                res.append( (name, os.path.join(dirpath, f)) )
+        return res
+
+    def _archive_valid(self):
+        """Check that the archive was not modified since it was recorded.
+        """
+        try:
+            return (self._archive is not None
+                    and stamp(self._archive) == self._archive_stamp)
+        except OSError:
+            return False
+
+    def _copy_member(self, z, source, info):
+        """Copy a member of the source archive without decompressing it.
+
+        @param z: the destination ZipFile
+        @param source: the source archive file object
+        @param info: the ZipInfo of the member in the source archive
+        @return: the ZipInfo of the copied member
+        """
+        source.seek(info.header_offset)
+        _skip_local_header(source)
+
+        i = zipfile.ZipInfo(info.filename, info.date_time)
+        for attr in ('compress_type', 'comment', 'create_system', 'create_version',
+                     'extract_version', 'internal_attr', 'external_attr',
+                     'CRC', 'compress_size', 'file_size'):
+            setattr(i, attr, getattr(info, attr))
+        # Sizes are written in the header, no data descriptor is needed
+        i.flag_bits = info.flag_bits & ~0x08
+        i.header_offset = z.fp.tell()
+        z.fp.write(i.FileHeader())
+        size = info.compress_size
+        while size > 0:
+            data = source.read(min(size, 1 << 20))
+            if not data:
+                raise AdveneException(_("Truncated zip file %s") % self._archive)
+            z.fp.write(data)
+            size -= len(data)
+        z.filelist.append(i)
+        z.NameToInfo[i.filename] = i
+        _set_modified(z)
+        return i
+
+    def _write_member(self, z, fname, name):
+        """Compress a file into the archive.
+        """
+        if os.path.splitext(name)[1].lower() in STORED_EXTENSIONS:
+            compress_type = zipfile.ZIP_STORED
+        else:
+            compress_type = zipfile.ZIP_DEFLATED
+        z.write(fname, name, compress_type)
+        return z.NameToInfo[name]
+
+    def _write_manifest(self, names):
+        d=self.tempfile(u'META-INF')
+        if not os.path.isdir(d):
+            os.mkdir(d)
+        fname=self.tempfile(u"META-INF", u"manifest.xml")
+        tree=ET.ElementTree(self.list_to_manifest(names))
+        tree.write(fname, encoding='utf-8')
+        return fname
+
     def open(self, fname=None):
         """Open the given AZP file.
 
@@ -255,8 +478,15 @@ class ZipPackage:
         # FIXME: Make some validity checks (resources/ dir, etc)
         self.file_ = fname
 
-    def save(self, fname=None):
+    def save(self, fname=None, append=False):
         """Save the package.
+
+        Unmodified members are copied from the previous archive.
+
+        If append is True and fname is the previous archive, the
+        modified members are appended to it and the replaced members
+        are dropped from its directory. The archive is rewritten when
+        the space used by dropped members becomes too large.
         """
         if fname is None:
             fname=self.file_
@@ -266,52 +496,126 @@ class ZipPackage:
             # it.
             os.mkdir(fname)
 
+        members=self._members()
         if os.path.isdir(fname):
-            z=None
-        else:
-            z=zipfile.ZipFile(fname, 'w', zipfile.ZIP_DEFLATED)
-
-        manifest=[]
-
-        for (dirpath, dirnames, filenames) in os.walk(self._tempdir):
-            # Ignore RCS directory paths
-            for d in ('.svn', 'CVS', '_darcs', '.bzr'):
-                if d in dirnames:
-                    dirnames.remove(d)
-
-            # Remove tempdir prefix
-            zpath=dirpath.replace(self._tempdir, '')
-
-            # Normalize os.path.sep to UNIX pathsep (/)
-            zpath=zpath.replace(os.path.sep, '/', -1)
-            if zpath and zpath[0] == '/':
-                # We should have only a relative subdir here
-                zpath=zpath[1:]
-
-            for f in filenames:
-                if f == 'manifest.xml':
-                    # We will write it later on.
-                    continue
-                if zpath:
-                    name='/'.join( (zpath, f) )
+            self._write_manifest([ name for (name, f) in members ])
+            return
+
+        archive_valid=self._archive_valid()
+        if (append and archive_valid
+            and os.path.abspath(fname) == os.path.abspath(self._archive)
+            and self._append(fname, members)):
+            return
+
+        # Write into a temporary file, since the previous archive can
+        # be the destination file.
+        fd, tmpname=tempfile.mkstemp('.azp', 'adv', os.path.dirname(os.path.abspath(fname)))
+        os.close(fd)
+        z=zipfile.ZipFile(tmpname, 'w', zipfile.ZIP_DEFLATED)
+        source=None
+        if archive_valid:
+            source=open(self._archive, 'rb')
+        stamps={}
+        try:
+            for (name, f) in members:
+                n=name.encode('utf-8')
+                stamps[n]=stamp(f)
+                if source is not None and not self.is_modified(n, f):
+                    self._copy_member(z, source, self._infos[n])
                 else:
-                    name=f
-                if isinstance(name, str):
-                    name=unicode(name, _fs_encoding)
-                manifest.append(name)
-                if z is not None:
-                    z.write( os.path.join(dirpath, f),
-                             name.encode('utf-8') )
+                    self._write_member(z, f, n)
 
-        # Generation of the manifest file
-        fname=self.tempfile(u"META-INF", u"manifest.xml")
-        tree=ET.ElementTree(self.list_to_manifest(manifest))
-        tree.write(fname, encoding='utf-8')
-        if z is not None:
             # Generation of the manifest file
-            z.write( fname,
-                     "META-INF/manifest.xml" )
+            z.write(self._write_manifest([ name for (name, f) in members ]),
+                    "META-INF/manifest.xml")
+            z.close()
+        except:
             z.close()
+            os.unlink(tmpname)
+            raise
+        finally:
+            if source is not None:
+                source.close()
+
+        # mkstemp creates files readable only by the user
+        if os.path.exists(fname):
+            mode=os.stat(fname).st_mode
+            if config.data.os == 'win32':
+                # os.rename does not replace existing files on win32.
+                # Elsewhere, it atomically replaces the previous file.
+                os.unlink(fname)
+        else:
+            umask=os.umask(0)
+            os.umask(umask)
+            mode=0666 & ~umask
+        os.chmod(tmpname, mode)
+        os.rename(tmpname, fname)
+        self._archive=fname
+        self._archive_stamp=stamp(fname)
+        self._infos=dict( (member_name(i), i) for i in z.infolist() )
+        self._stamps=stamps
+        self._modified.clear()
+
+    def _append(self, fname, members):
+        """Append the modified members to the archive.
+
+        @return: False if the archive should be rewritten instead
+        """
+        names=[ name.encode('utf-8') for (name, f) in members ]
+        modified=[ (n, f)
+                   for (n, (name, f)) in zip(names, members)
+                   if self.is_modified(n, f) ]
+        removed=set(self._infos).difference(names)
+        removed.discard('META-INF/manifest.xml')
+        # Is the manifest modified?
+        changed_list=bool(removed) or any(n not in self._infos for (n, f) in modified)
+
+        dropped=set(n for (n, f) in modified if n in self._infos)
+        dropped.update(removed)
+        if changed_list:
+            dropped.add('META-INF/manifest.xml')
+
+        fp=open(fname, 'r+b')
+        try:
+            # Check the space used by dropped members before modifying
+            # the file
+            z=zipfile.ZipFile(fp)
+            live=sum(_local_member_size(i)
+                     for i in z.filelist
+                     if i.filename not in dropped)
+            garbage=_directory_offset(z) - live
+            z.close()
+            if garbage > min(live * self.GARBAGE_RATIO, self.GARBAGE_LIMIT):
+                return False
+
+            fp.seek(0)
+            z=zipfile.ZipFile(fp, 'a')
+            for n in dropped:
+                info=z.NameToInfo.pop(n, None)
+                if info is not None:
+                    z.filelist.remove(info)
+
+            stamps=dict(self._stamps)
+            for n in removed:
+                stamps.pop(n, None)
+            for (n, f) in modified:
+                stamps[n]=stamp(f)
+                self._write_member(z, f, n)
+            if changed_list:
+                z.write(self._write_manifest([ name for (name, f) in members ]),
+                        "META-INF/manifest.xml")
+            _set_modified(z)
+            z.close()
+            # Remove the end of the previous directory
+            fp.truncate()
+        finally:
+            fp.close()
+
+        self._archive_stamp=stamp(fname)
+        self._infos=dict( (member_name(i), i) for i in z.infolist() )
+        self._stamps=stamps
+        self._modified.clear()
+        return True
 
     def update_statistics(self, p):
         """Update the META-INF/statistics.xml file
@@ -322,6 +626,7 @@ class ZipPackage:
         f=open(self.tempfile(u'META-INF', u'statistics.xml'), 'w')
         f.write(p.generate_statistics().encode('utf-8'))
         f.close()
+        self.set_modified('META-INF/statistics.xml')
         return True
 
     def list_to_manifest(self, manifest):
@@ -58,7 +58,7 @@ try:
     import pygst
     pygst.require('0.10')
     import gst
-    from advene.util.snapshotter import Snapshotter
+    from advene.util.snapshotter import Snapshotter, BatchSnapshotter
     svgelement = None
     # First try rsvgoverlay
     if gst.element_factory_find('rsvgoverlay'):
@@ -442,17 +442,26 @@ class Player:
                 self.fullres_snapshotter.start()
         self.fullres_snapshotter.enqueue(position)
 
-    def snapshot_taken(self, buffer):
+    def snapshot_taken(self, buffer, timestamps=None):
+        """Notify a snapshot.
+
+        timestamps is the list of the requested timestamps covered by
+        the buffer (see BatchSnapshotter). If None, the buffer timestamp
+        is used.
+        """
         if self.snapshot_notify:
-            s=Snapshot( { 'data': buffer.data,
-                          'type': 'PNG',
-                          'date': buffer.timestamp / gst.MSECOND,
-                          # Hardcoded size values. They are not used
-                          # by the application, since they are
-                          # encoded in the PNG file anyway.
-                          'width': 160,
-                          'height': 100 } )
-            self.snapshot_notify(s)
+            if timestamps is None:
+                timestamps=[ buffer.timestamp / gst.MSECOND ]
+            for t in timestamps:
+                s=Snapshot( { 'data': buffer.data,
+                              'type': 'PNG',
+                              'date': t,
+                              # Hardcoded size values. They are not used
+                              # by the application, since they are
+                              # encoded in the PNG file anyway.
+                              'width': 160,
+                              'height': 100 } )
+                self.snapshot_notify(s)
 
     def async_snapshot(self, position):
         t = long(self.position2value(position))
@@ -469,6 +478,24 @@ class Player:
                                t)):
                 self.snapshotter.enqueue(pos)
 
+    def batch_snapshot(self, positions, workers=2, epsilon=35):
+        """Capture snapshots for a list of positions (in ms).
+
+        Snapshots are delivered to snapshot_notify, as for
+        async_snapshot, from the BatchSnapshotter threads. This method
+        blocks until all snapshots are captured.
+
+        @return: the throughput of each worker (see BatchSnapshotter.stats)
+        """
+        if not self.check_uri():
+            return []
+        b=BatchSnapshotter(self.player.get_property('uri'),
+                           notify=self.snapshot_taken,
+                           width=config.data.player['snapshot-width'],
+                           workers=workers,
+                           epsilon=epsilon)
+        return b.extract(positions)
+
     def snapshot(self, position):
         if not self.check_uri():
             return None
@@ -155,9 +155,12 @@ class BrlEngine:
                 navigate_bookmark(+1)
             else:
                 # Navigate to the next annotation in the type
-                l=[an
-                   for an in self.controller.future_begins
-                   if an[0].type == self.currenttype ]
+                pos=self.controller.player.current_position_value
+                l=[]
+                for an in self.controller.package.getTimeIndex().iter_begins(pos, strict=True):
+                    if an[0].type == self.currenttype:
+                        l.append(an)
+                        break
                 if l:
                     self.controller.queue_action(self.controller.update_status, 'set', l[0][1])
         elif k == brlapi.KEY_SYM_LEFT or k == ALVA_LPAD_LEFT or k == ALVA_MPAD_BUTTON1:
@@ -117,13 +117,15 @@ class PocketSphinxImporter(GenericImporter):
     def generate_annotations(self):
         n = 1.0 * len(self.buffer_list)
         self.progress(0, _("Generating annotations"))
-        for i, tup in enumerate(self.buffer_list):
-            self.progress(i / n)
-            self.convert( [ {
-                        'begin': tup[0],
-                        'end': tup[1],
-                        'content': tup[2],
-                        } ])
+        def records():
+            for i, tup in enumerate(self.buffer_list):
+                self.progress(i / n)
+                yield {
+                    'begin': tup[0],
+                    'end': tup[1],
+                    'content': tup[2],
+                    }
+        self.convert(records())
 
     def on_bus_message(self, bus, message):
         def finalize():
@@ -88,13 +88,17 @@ class SoundEnveloppeImporter(GenericImporter):
         factor = 100.0 / (self.max - self.min)
         m = self.min
         self.progress(0, _("Generating annotations"))
-        for i, tup in enumerate(self.buffer_list):
-            self.progress(i / n)
-            self.convert( [ {
-                        'begin': tup[0],
-                        'end': tup[1],
-                        'content': " ".join("%.02f" % (factor * (f -m)) for f in tup[2]),
-                        } ])
+        def records():
+            for i, tup in enumerate(self.buffer_list):
+                self.progress(i / n)
+                yield {
+                    'begin': tup[0],
+                    'end': tup[1],
+                    'content': " ".join("%.02f" % (factor * (f -m)) for f in tup[2]),
+                    }
+        # Convert all records at once, so that annotations are
+        # created by batches
+        self.convert(records())
 
     def on_bus_message(self, bus, message):
         def finalize():
@@ -49,6 +49,7 @@ from advene.model.annotation import Annotation, Relation
 from advene.model.view import View
 from advene.model.package import Package
 from advene.rules.elements import ECACatalog
+from advene.rules.ecaengine import read_event_log
 
 def register(controller):
     tb = TraceBuilder(controller)
@@ -449,44 +450,7 @@ class TraceBuilder(Thread):
             self.traces[-1].add_to_trace('events', evt)
             if evt.name in self.modelmapping['operations']['actions']:
                 op = Operation(ev.name, float(ev.time), float(ev.ac_time), ev_content, ev.movie, float(ev.m_time), ev.o_name, ev.o_id, ot, ev.o_cid)
-                self.traces[-1].add_to_trace('operations', op)
-                if op is not None:
-                    if ev.name in self.modelmapping['operations']['actions']:
-                        ac_t = self.modelmapping['operations']['actions'][ev.name]
-                    else:
-                        continue
-                    typ = "Undefined"
-                    if ac_t >=0:
-                        typ = self.tracemodel['actions'][ac_t]
-                    if typ == "Undefined":
-                        if ot==advene.model.annotation.Annotation or ot==advene.model.annotation.Annotation:
-                            typ="Restructuration"
-                        elif ot==advene.model.schema.AnnotationType or ot==advene.model.schema.RelationType or ot==advene.model.schema.Schema:
-                            typ="Classification"
-                        elif ot==advene.model.view.View:
-                            typ="View building"
-                        else:
-                            print "undefined action type ! %s" % ev.o_type
-                            continue
-                    if tmp_opened_actions[typ]:
-                        # an action is already opened for this type of event
-                        ac = tmp_opened_actions[typ]
-                        #add operation to existing action
-                        ac.add_operation(op)
-                        if typ == "Navigation" and (op.name == "PlayerStop" or op.name == "PlayerPause"):
-                            # Navigation action end if PlayerStop or PlayerPause
-                            tmp_opened_actions[typ]=None
-                        continue
-                    #no corresponding action was already opened
-                    for t in tmp_opened_actions.keys():
-                        #we close every opened actions except Navigation
-                        if t != "Navigation":
-                            tmp_opened_actions[t]=None
-                    #we create the new action
-                    ac = Action(name=typ, begintime=op.time, endtime=None, acbegintime=op.activity_time, acendtime=None, content=None, movie=op.movie, movietime=op.movietime, operations=[op])
-                    self.traces[-1].add_to_trace('actions', ac)
-                    #we append the new action to the trace and flag it as opened (not yet ended)
-                    tmp_opened_actions[typ]=ac
+                self.add_imported_operation(self.traces[-1], op, tmp_opened_actions)
         # copy comments
         if hasattr(tr, 'actions'):
             for ac in tr.actions[0].action:
@@ -497,6 +461,80 @@ class TraceBuilder(Thread):
         self.log("%s events imported" % lid)
         return True
 
+    def add_imported_operation(self, trace, op, opened_actions):
+        """Add an operation to an imported trace, along with its action.
+
+        opened_actions holds the actions of the trace which are not
+        yet ended, indexed by action type.
+        """
+        trace.add_to_trace('operations', op)
+        ac_t = self.modelmapping['operations']['actions'][op.name]
+        typ = "Undefined"
+        if ac_t >=0:
+            typ = self.tracemodel['actions'][ac_t]
+        if typ == "Undefined":
+            ot = op.concerned_object['type']
+            if ot==advene.model.annotation.Annotation or ot==advene.model.annotation.Annotation:
+                typ="Restructuration"
+            elif ot==advene.model.schema.AnnotationType or ot==advene.model.schema.RelationType or ot==advene.model.schema.Schema:
+                typ="Classification"
+            elif ot==advene.model.view.View:
+                typ="View building"
+            else:
+                print "undefined action type ! %s" % ot
+                return
+        if opened_actions[typ]:
+            # an action is already opened for this type of event
+            ac = opened_actions[typ]
+            #add operation to existing action
+            ac.add_operation(op)
+            if typ == "Navigation" and (op.name == "PlayerStop" or op.name == "PlayerPause"):
+                # Navigation action end if PlayerStop or PlayerPause
+                opened_actions[typ]=None
+            return
+        #no corresponding action was already opened
+        for t in opened_actions.keys():
+            #we close every opened actions except Navigation
+            if t != "Navigation":
+                opened_actions[t]=None
+        #we create the new action
+        ac = Action(name=typ, begintime=op.time, endtime=None, acbegintime=op.activity_time, acendtime=None, content=None, movie=op.movie, movietime=op.movietime, operations=[op])
+        trace.add_to_trace('actions', ac)
+        #we append the new action to the trace and flag it as opened (not yet ended)
+        opened_actions[typ]=ac
+
+    def import_event_log(self, fname):
+        """Import an event log written by the ECAEngine as a new trace.
+
+        The log only holds the ids of the elements, so the events
+        have no content.
+        """
+        self.log('importing event log from %s' % fname)
+        if not os.path.exists(fname):
+            self.log("%s not found, giving up." % fname)
+            return False
+        types=dict( (t.__name__, t) for t in (Schema, AnnotationType, RelationType, Annotation, Relation, View, Package) )
+        trace=Trace()
+        trace.rename('%s (imported)' % os.path.basename(fname))
+        opened_actions=dict( (t, None) for t in self.tracemodel['actions'] )
+        movie=self.controller.package.getMetaData(config.data.namespace, "mediafile")
+        count=0
+        for r in read_event_log(fname):
+            if r.event_name in self.filtered_events:
+                continue
+            if not trace.start:
+                trace.start=r.timestamp
+            count += 1
+            params=(r.event_name, r.timestamp, (r.timestamp - trace.start) * 1000, u'',
+                    movie, r.media_time or 0, r.element_id, r.element_id, types.get(r.element_type), None)
+            trace.add_to_trace('events', Event(*params))
+            if r.event_name in self.modelmapping['operations']['actions']:
+                self.add_imported_operation(trace, Operation(*params), opened_actions)
+        self.traces.append(trace)
+        self.alert_registered(None, None, None)
+        self.log("%d events imported" % count)
+        return True
+
     def receive(self, obj):
         # obj : received event
         ev = op = ac = None
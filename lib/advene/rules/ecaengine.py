@@ -30,6 +30,8 @@ import threading
 import copy
 import StringIO
 import urllib
+import os
+from collections import deque
 
 import advene.rules.elements
 
@@ -47,6 +49,81 @@ class MyThread(threading.Thread):
         if self._target:
             self._target()
 
+class EventRecord(object):
+    """Compact record of a notified event.
+
+    It only holds the identifier and the class name of the concerned
+    element, so that the event history does not keep model elements
+    alive.
+    """
+    __slots__ = ('timestamp', 'event_name', 'element_id', 'element_type', 'media_time')
+
+    # Parameters holding the element concerned by an event, in
+    # priority order
+    element_keys = ('annotation', 'relation', 'annotationtype', 'relationtype',
+                    'schema', 'view', 'query', 'resource', 'element', 'package')
+
+    def __init__(self, timestamp, event_name, element_id=None, element_type=None, media_time=None):
+        self.timestamp=timestamp
+        self.event_name=event_name
+        self.element_id=element_id
+        self.element_type=element_type
+        self.media_time=media_time
+
+    def __repr__(self):
+        return "<EventRecord %s %s %s at %s>" % (self.event_name, self.element_type, self.element_id, self.media_time)
+
+    @staticmethod
+    def from_event(event_name, kw, media_time=None):
+        """Build a record from the parameters of a notification.
+        """
+        element_id=None
+        element_type=None
+        for k in EventRecord.element_keys:
+            el=kw.get(k)
+            if el is not None:
+                element_id=getattr(el, 'id', None)
+                element_type=el.__class__.__name__
+                break
+        else:
+            if kw.get('uri') is not None:
+                element_id=unicode(kw['uri'])
+        return EventRecord(time.time(), event_name, element_id, element_type, media_time)
+
+    def to_line(self):
+        """Return the record as a tab-separated line.
+        """
+        return u"\t".join( [ repr(self.timestamp) ]
+                           + [ u'' if v is None else unicode(v).replace(u'\t', u' ').replace(u'\n', u' ')
+                               for v in (self.event_name, self.element_id,
+                                         self.element_type, self.media_time) ] ).encode('utf-8') + "\n"
+
+    @staticmethod
+    def from_line(line):
+        """Build a record from a line generated by L{to_line}.
+        """
+        timestamp, event_name, element_id, element_type, media_time = line.rstrip("\n").decode('utf-8').split(u'\t')
+        return EventRecord(float(timestamp), event_name,
+                           element_id or None,
+                           element_type or None,
+                           long(media_time) if media_time else None)
+
+def read_event_log(fname):
+    """Iterate over the event records stored in an event log.
+
+    @param fname: the event log filename
+    @type fname: string
+    @return: an iterator over the records
+    @rtype: iterator of EventRecord
+    """
+    f=open(fname, 'rb')
+    try:
+        for l in f:
+            if l.strip():
+                yield EventRecord.from_line(l)
+    finally:
+        f.close()
+
 class ECAEngine:
     """ECAEngine class.
 
@@ -64,6 +141,18 @@ class ECAEngine:
 
     @ivar ruledict: the global rules dictionary, indexed by EventName
     @type ruledict: dict
+    @ivar dispatch: the (rule, filter) lists indexed by EventName, where
+    filter is the result of the condition filter method
+    @type dispatch: dict
+    @ivar dispatch_stats: the (count, total duration in s) of the
+    notifications, indexed by EventName
+    @type dispatch_stats: dict
+    @ivar event_history: the last recorded events, bounded by the
+    event-history-size preference
+    @type event_history: collections.deque of EventRecord
+    @ivar event_log: the append-only file where the recorded events
+    are also written, if the event-history-log preference is set
+    @type event_log: file
     @ivar rulesets: dictionary holding the rules indexed by classname
     @type rulesets: dict
     @ivar controller: the Advene controller
@@ -83,8 +172,11 @@ class ECAEngine:
         """
         self.clear_state()
         self.ruledict = {}
+        self.dispatch = {}
+        self.dispatch_stats = {}
         # History of events
-        self.event_history = []
+        self.event_history = deque(maxlen=config.data.preferences['event-history-size'] or None)
+        self.event_log = None
         self.controller=controller
         self.catalog=advene.rules.elements.ECACatalog()
         self.scheduler=sched.scheduler(time.time, time.sleep)
@@ -191,6 +283,10 @@ class ECAEngine:
         for type_ in ('internal', 'default', 'user'):
             for rule in self.rulesets[type_]:
                 self.ruledict.setdefault(rule.event, []).append(rule)
+        # Replace the dict in one step, since notify may be called
+        # from other threads
+        self.dispatch = dict( (event, [ (rule, rule.condition.filter()) for rule in rules ])
+                              for (event, rules) in self.ruledict.iteritems() )
 
     def schedule(self, action, context, delay=0, immediate=False):
         """Schedule an action for execution.
@@ -341,6 +437,14 @@ class ECAEngine:
             res.append("%s: %s" % (k, len(self.ruledict[k])))
         return res
 
+    def dump_dispatch_stats(self):
+        """Return the notification statistics, as a list of strings.
+        """
+        res=[]
+        for k, (count, duration) in sorted(self.dispatch_stats.iteritems()):
+            res.append("%s: %d notifications, %.1fus per notification" % (k, count, duration * 1e6 / count))
+        return res
+
     def notify (self, event_name, *param, **kw):
         """Invoked by the application on the occurence of an event.
 
@@ -362,15 +466,76 @@ class ECAEngine:
         #print "notify %s for %s" % (event_name, str(kw))
 
         if config.data.preferences['record-actions']:
-            # FIXME: we should not store the whole element, it is too costly
+            self.record_event(event_name, param, kw)
+        start=time.time()
+        try:
+            self.dispatch_rules(event_name, kw)
+        finally:
+            count, duration=self.dispatch_stats.get(event_name, (0, 0))
+            self.dispatch_stats[event_name]=(count + 1, duration + time.time() - start)
+
+    def record_event(self, event_name, param, kw):
+        """Record an event in the history and send it to the tracers.
+        """
+        try:
+            media_time=self.controller.player.current_position_value
+        except AttributeError:
+            media_time=None
+        record=EventRecord.from_event(event_name, kw, media_time)
+        self.event_history.append(record)
+        if config.data.preferences['event-history-log']:
+            self.log_event(record)
+        if self.views_to_notify:
+            # Tracers need the elements themselves to build their
+            # trace. The dict is dropped once they consumed it.
             d=dict(kw)
             d['event_name'] = event_name
             d['parameters'] = param
-            self.event_history.append(d)
             for v in self.views_to_notify:
                 # should only be TraceBuilder plugin or other trace building system
-                #v.receive(d)
                 v.equeue.put(d)
+
+    def log_event(self, record):
+        """Append a record to the event log.
+
+        The log is opened in the traces directory upon the first
+        record.
+        """
+        if self.event_log is None:
+            d=config.data.advenefile('traces', category='settings')
+            if not os.path.isdir(d):
+                os.makedirs(d)
+            fname=config.data.advenefile(['traces', time.strftime("events-%Y%m%d-%H%M%S.log")],
+                                         category='settings')
+            try:
+                self.event_log=open(fname, 'ab')
+            except (OSError, IOError), e:
+                print "Cannot open event log %s: %s" % (fname, unicode(e).encode('utf-8'))
+                config.data.preferences['event-history-log']=False
+                return
+        self.event_log.write(record.to_line())
+        self.event_log.flush()
+
+    def close_event_log(self):
+        """Close the event log.
+
+        @return: the event log filename, or None
+        @rtype: string
+        """
+        if self.event_log is None:
+            return None
+        fname=self.event_log.name
+        self.event_log.close()
+        self.event_log=None
+        return fname
+
+    def dispatch_rules(self, event_name, kw):
+        """Execute the actions of the rules matching the event.
+        """
+        rules=self.dispatch.get(event_name)
+        if not rules:
+            return
+
         immediate=False
         if 'immediate' in kw:
             immediate=True
@@ -382,15 +547,23 @@ class ECAEngine:
             del kw['delay']
             print "Delay specified: %f" % delay
 
-        context=self.build_context(event_name, **kw)
-        try:
-            a=self.ruledict[event_name]
-        except KeyError:
+        # Check the conditions which do not need a context, so that
+        # it is only built if some rules may match.
+        candidates=[]
+        for rule, filter_ in rules:
+            if filter_ is None:
+                candidates.append( (rule, None) )
+            else:
+                r=filter_(kw)
+                if r is not False:
+                    candidates.append( (rule, r) )
+        if not candidates:
             return
 
+        context=self.build_context(event_name, **kw)
         rules=sorted( (rule
-                       for rule in a
-                       if rule.condition.match(context) ),
+                       for (rule, r) in candidates
+                       if r or rule.condition.match(context) ),
                       key=lambda e: e.priority,
                       reverse=True)
 
@@ -28,7 +28,7 @@ import xml.etree.ElementTree as ET
 import itertools
 
 import advene.core.config as config
-from advene.model.annotation import Annotation
+from advene.model.annotation import Annotation, Relation
 from advene.model.fragment import MillisecondFragment
 
 from advene.util.odict import odict
@@ -126,6 +126,48 @@ class ConditionList(list):
                     return True
             return False
 
+    def filter(self):
+        """Return a function checking the ConditionList on event parameters.
+
+        See L{Condition.filter}. The function returns None if the
+        result depends on conditions which can only be checked by
+        L{match}. The ConditionList itself returns None if none of its
+        conditions can be checked.
+        """
+        filters=[ c.filter() for c in self ]
+        known=[ f for f in filters if f is not None ]
+        if not known:
+            return None
+        complete=(len(known) == len(filters))
+        if self.composition == "and":
+            decisive, default=False, True
+        else:
+            decisive, default=True, False
+        def check(kw):
+            res=default
+            for f in known:
+                r=f(kw)
+                if r is decisive:
+                    return decisive
+                elif r is None:
+                    res=None
+            if complete:
+                return res
+            return None
+        return check
+
+# Condition left-hand sides which can be checked on the event
+# parameters (see Condition.filter): lhs -> (parameter name, element
+# class, accessor)
+filter_accessors={
+    'annotation/id': ('annotation', Annotation, lambda a: a.id),
+    'annotation/type/id': ('annotation', Annotation, lambda a: a.type.id),
+    'annotation/content/data': ('annotation', Annotation, lambda a: a.content.data),
+    'relation/id': ('relation', Relation, lambda r: r.id),
+    'relation/type/id': ('relation', Relation, lambda r: r.type.id),
+    'relation/content/data': ('relation', Relation, lambda r: r.content.data),
+    }
+
 class Condition:
     """The Condition class.
 
@@ -268,6 +310,48 @@ class Condition:
         else:
             raise Exception("Unknown operator: %s" % self.operator)
 
+    def filter(self):
+        """Return a function checking the condition on event parameters.
+
+        Common conditions (comparison of the id, type id or data of
+        the annotation or relation with a string:, see
+        filter_accessors) can be checked without evaluating TALES
+        expressions, and thus without building a context. The
+        returned function takes the event parameters as a dict, and
+        returns the same value as L{match}, or None if the
+        parameters are not the expected ones.
+
+        @return: a function, or None if the condition is not supported
+        """
+        if self.is_true():
+            return lambda kw: True
+        # Expressions are stripped by TALES
+        lhs=(self.lhs or '').strip()
+        rhs=(self.rhs or '').strip()
+        if (self.operator not in ('equals', 'different', 'contains')
+            or lhs not in filter_accessors
+            or not rhs.startswith('string:')
+            or '$' in rhs):
+            return None
+        name, cls, accessor = filter_accessors[lhs]
+        value=rhs[len('string:'):].lstrip()
+        operator=self.operator
+        if operator == 'contains':
+            def check(kw):
+                element=kw.get(name)
+                if not isinstance(element, cls):
+                    return None
+                return value in accessor(element)
+        else:
+            value=self.convert_value(value)
+            convert_value=self.convert_value
+            def check(kw):
+                element=kw.get(name)
+                if not isinstance(element, cls):
+                    return None
+                return (convert_value(accessor(element)) == value) == (operator == 'equals')
+        return check
+
     def truematch(self, context):
         """Condition which always return True.
 
@@ -19,12 +19,19 @@
 
 from advene.util.importer import GenericImporter, register
 import advene.core.config as config
+from advene.rules.ecaengine import read_event_log
 import time
+import os
 
 from gettext import gettext as _
 
 class EventHistoryImporter(GenericImporter):
     """Event History importer.
+
+    It converts the event history of the ECAEngine (when the
+    'event_history' filename is given), or an event log written by
+    it, into annotations. The annotation dates are the times of the
+    events.
     """
     name=_("Event history importer")
 
@@ -32,16 +39,25 @@ class EventHistoryImporter(GenericImporter):
         super(EventHistoryImporter, self).__init__(**kw)
 
     def can_handle(fname):
-        return fname == 'event_history'
+        if fname == 'event_history':
+            return 100
+        n=os.path.basename(fname)
+        if n.startswith('events-') and n.endswith('.log'):
+            return 100
+        return 0
     can_handle=staticmethod(can_handle)
 
     def iterator(self, f):
-        start=f[0]['timestamp']
-        end=start
+        if isinstance(f, basestring):
+            f=read_event_log(f)
+        start=None
+        end=0
         id_="Traces"
         schema=self.package.get_element_by_id(id_)
         for e in f:
-            type_ = e['event_name']
+            if start is None:
+                start=e.timestamp
+            type_ = e.event_name
             type = self.package.get_element_by_id(type_)
             if (type is None):
                 #Annotation type creation
@@ -56,22 +72,22 @@ class EventHistoryImporter(GenericImporter):
                 type.setMetaData(config.data.namespace, 'item_color', 'here/tag_color')
                 schema.annotationTypes.append(type)
 
+            begin=long((e.timestamp - start) * 1000)
+            content='position=%s\n' % (e.media_time or 0)
+            if e.element_id is not None:
+                content='element=%s\ntype=%s\n' % (e.element_id, e.element_type) + content
             d={
                 'type': type,
-                'begin': e['timestamp'] - start,
+                'begin': begin,
                 'duration': 50,
-                'timestamp': e['timestamp'],
-                'content': '',
+                'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(e.timestamp)),
+                'content': content,
             }
-            if e.has_key('content'):
-                d['content']=e['content']+'\nposition='+str(e['movietime'])+'\n'
-            else:
-                d['content']='position='+str(e['movietime'])+'\n'
-            if end<e['timestamp']+50:
-                end=e['timestamp']+50
+            if end < begin + 50:
+                end=begin + 50
             yield d
         #fix package duration
-        self.package.cached_duration=end-start
+        self.package.cached_duration=end
 
     def process_file(self, filename):
         if self.package is None:
@@ -86,6 +102,12 @@ class EventHistoryImporter(GenericImporter):
             schema.date=time.strftime("%Y-%m-%d")
             schema.title=title_
             self.package.schemas.append(schema)
-        self.convert(self.iterator(filename))
+        if filename == 'event_history' and self.controller is not None:
+            # Copy the records, since the history is updated while
+            # the annotations are created
+            source=list(self.controller.event_handler.event_history)
+        else:
+            source=filename
+        self.convert(self.iterator(source))
         return self.package
 register(EventHistoryImporter)
@@ -31,6 +31,7 @@ import re
 import zipfile
 import urllib
 import unicodedata
+import weakref
 
 import advene.core.config as config
 from advene.core.imagecache import ImageCache
@@ -753,6 +754,54 @@ class CircularList(list):
         self._index = (self._index - 1) % len(self)
         return self.current()
 
+class TitleCache(object):
+    """Cache of the titles of annotations and relations.
+
+    It holds, for each element, the titles for the various
+    (representation, max_size) keys. Elements are weakly referenced,
+    so that the titles of unloaded packages are discarded.
+    """
+    def __init__(self):
+        self._titles=weakref.WeakKeyDictionary()
+
+    def __len__(self):
+        return len(self._titles)
+
+    def titles(self, element):
+        """Return the { (representation, max_size): title } dictionary of element.
+        """
+        return self._titles.setdefault(element, {})
+
+    def clear(self):
+        self._titles.clear()
+
+    def discard_package(self, package):
+        """Discard the titles of the elements of package.
+        """
+        for e in [ e for e in self._titles.keys() if e.ownerPackage is package ]:
+            self._titles.pop(e, None)
+
+    def invalidate(self, event_name, element):
+        """Discard the titles after the modification of element.
+
+        @param event_name: the modification event
+        @type event_name: string
+        """
+        if event_name in ('AnnotationEditEnd', 'AnnotationDelete'):
+            self._titles.pop(element, None)
+            # The relation titles may depend on their members
+            for r in element.relations:
+                self._titles.pop(r, None)
+        elif event_name in ('RelationCreate', 'RelationEditEnd', 'RelationDelete'):
+            self._titles.pop(element, None)
+            # The annotation titles may depend on their relations
+            for a in element.members:
+                self._titles.pop(a, None)
+        elif event_name != 'AnnotationCreate':
+            # Type modifications, and other modifications which may be
+            # used by the representations
+            self._titles.clear()
+
 # Element-tree indent function.
 # in-place prettyprint formatter
 def indent(elem, level=0):
@@ -798,6 +847,27 @@ def common_fieldnames(elements):
 parsed_representation = re.compile(r'^here/content/parsed/([\w\d_\.]+)$')
 empty_representation = re.compile(r'^\s*$')
 
+def pack_values(package, packed=True):
+    """Convert the storage of the application/x-advene-values annotations.
+
+    If packed is True, the values are stored packed (see
+    Content.setValues), else in the legacy text form.
+
+    @return: the number of converted annotations
+    """
+    count=0
+    for at in package.annotationTypes:
+        if at.mimetype != 'application/x-advene-values':
+            continue
+        for a in at.annotations:
+            c=a.content
+            if (c.mimetype == 'application/x-advene-values'
+                and c.isPacked() != packed
+                and c.uri is None):
+                c.setValues(c.getValues(), packed=packed)
+                count += 1
+    return count
+
 def title2content(new_title, original_content, representation):
     """Converts a title (short representation) to the appropriate content.
 
@@ -829,3 +899,44 @@ def title2content(new_title, original_content, representation):
                     r = "%s=%s" % (name, new_title)
         # else: too complex representation. Return None as default value.
     return r
+
+class EntityUnescapeWriter(object):
+    """File-like wrapper converting the &lt; &gt; and &amp; entities of the written data.
+
+    Data is converted by blocks of buffer_size bytes. Entities split
+    between two blocks are converted. The flush method must be called
+    at the end of the output.
+    """
+    entity_regexp=re.compile('&(lt|gt|amp);')
+    entities={ 'lt': '<', 'gt': '>', 'amp': '&' }
+    buffer_size=65536
+
+    def __init__(self, stream):
+        self.stream=stream
+        self.chunks=[]
+        self.size=0
+
+    def _replace(self, m):
+        return self.entities[m.group(1)]
+
+    def _convert(self, final=False):
+        data=''.join(self.chunks)
+        self.chunks=[]
+        if not final:
+            # Keep a possibly incomplete entity (at most '&amp') for the next block
+            i=data.rfind('&', max(0, len(data) - 4))
+            if i != -1 and not ';' in data[i:]:
+                self.chunks.append(data[i:])
+                data=data[:i]
+        self.size=sum(len(c) for c in self.chunks)
+        self.stream.write(self.entity_regexp.sub(self._replace, data))
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.size += len(data)
+        if self.size >= self.buffer_size:
+            self._convert()
+
+    def flush(self):
+        self._convert(final=True)
+        self.stream.flush()
@@ -144,6 +144,8 @@ class GenericImporter(object):
         self.callback=callback
         # Default offset in ms
         self.offset=0
+        # Number of annotations created at once by convert
+        self.batch_size=10000
         # Dictionary holding the number of created elements
         self.statistics={
             'annotation': 0,
@@ -319,6 +321,27 @@ class GenericImporter(object):
         self.update_statistics('annotation')
         return a
 
+    def create_annotations(self, records):
+        """Create annotations in the package, in one pass.
+
+        records is a list of dictionaries with the create_annotation
+        parameters as keys (except title).
+        """
+        if not records:
+            return
+        if self.controller is not None:
+            # Reserve the missing ids at once
+            missing = [ r for r in records if r['ident'] is None ]
+            ids = self.controller.package._idgenerator.get_ids(Annotation, len(missing))
+            for r, i in zip(missing, ids):
+                r['ident'] = i
+        for r in records:
+            r['begin'] += self.offset
+            r['end'] += self.offset
+            r['date'] = r.pop('timestamp')
+        self.package.createAnnotations(records)
+        self.statistics['annotation'] = self.statistics.get('annotation', 0) + len(records)
+
     def statistics_formatted(self):
         """Return a string representation of the statistics."""
         res=[]
@@ -378,77 +401,117 @@ class GenericImporter(object):
         """
         if self.package is None:
             self.package, self.defaulttype=self.init_package(annotationtypeid='imported', schemaid='imported-schema')
-        for d in source:
-            try:
-                begin=helper.parse_time(d['begin'])
-            except KeyError:
-                raise Exception("Begin is mandatory")
-            if 'end' in d:
-                end=helper.parse_time(d['end'])
-            elif 'duration' in d:
-                end=begin + helper.parse_time(d['duration'])
-            else:
-                raise Exception("end or duration is missing")
-            try:
-                content=d['content']
-            except KeyError:
-                content="Default content"
-            try:
-                ident=d['id']
-            except KeyError:
-                ident=None
-            try:
-                type_=d['type']
-                if isinstance(type_, basestring):
-                    # A type id was specified. Dereference it, and
-                    # create it if necessary.
-                    type_id = type_
-                    type_ = self.package.get_element_by_id(type_id)
+        # Annotations which do not have to be returned are created
+        # by batches.
+        batch=[]
+        try:
+            for d in source:
+                try:
+                    begin=d['begin']
+                except KeyError:
+                    raise Exception("Begin is mandatory")
+                if not isinstance(begin, (int, long)):
+                    begin=helper.parse_time(begin)
+                if 'end' in d:
+                    end=d['end']
+                    if not isinstance(end, (int, long)):
+                        end=helper.parse_time(end)
+                elif 'duration' in d:
+                    end=d['duration']
+                    if not isinstance(end, (int, long)):
+                        end=helper.parse_time(end)
+                    end=begin + end
+                else:
+                    raise Exception("end or duration is missing")
+                try:
+                    content=d['content']
+                except KeyError:
+                    content="Default content"
+                try:
+                    ident=d['id']
+                except KeyError:
+                    ident=None
+                try:
+                    type_=d['type']
+                    if isinstance(type_, basestring):
+                        # A type id was specified. Dereference it, and
+                        # create it if necessary.
+                        type_id = type_
+                        type_ = self.package.get_element_by_id(type_id)
+                        if type_ is None:
+                            # Not existing, create it.
+                            type_ = self.ensure_new_type(type_id)
+                        elif not isinstance(type_, AnnotationType):
+                            raise Exception("Error during import: the specified type id %s is not an annotation type" % type_id)
+                except KeyError:
+                    type_=self.defaulttype
                     if type_ is None:
-                        # Not existing, create it.
-                        type_ = self.ensure_new_type(type_id)
-                    elif not isinstance(type_, AnnotationType):
-                        raise Exception("Error during import: the specified type id %s is not an annotation type" % type_id)
-            except KeyError:
-                type_=self.defaulttype
-                if type_ is None:
-                    if len(self.package.annotationTypes) > 0:
-                        type_ = self.package.annotationTypes[0]
-                    else:
-                        raise Exception("No type")
-            try:
-                author=d['author']
-            except KeyError:
-                author=self.author
-            try:
-                title=d['title']
-            except KeyError:
-                title=(content or '')[:20]
-            try:
-                timestamp=d['timestamp']
-            except KeyError:
-                timestamp=self.timestamp
-
-            a=self.create_annotation (type_=type_,
-                                      begin=begin,
-                                      end=end,
-                                      data=content,
-                                      ident=ident,
-                                      author=author,
-                                      title=title,
-                                      timestamp=timestamp)
-            self.package._modified = True
-            if 'complete' in d:
-                a.complete=d['complete']
-            if 'notify' in d and d['notify'] and self.controller is not None:
-                print "Notifying", a
-                self.controller.notify('AnnotationCreate', annotation=a)
-            if 'send' in d:
-                # We are expected to return a value in the yield call
+                        if len(self.package.annotationTypes) > 0:
+                            type_ = self.package.annotationTypes[0]
+                        else:
+                            raise Exception("No type")
+                try:
+                    author=d['author']
+                except KeyError:
+                    author=self.author
+                try:
+                    timestamp=d['timestamp']
+                except KeyError:
+                    timestamp=self.timestamp
+                self.package._modified = True
+
+                notify='notify' in d and d['notify'] and self.controller is not None
+                if not (notify or 'complete' in d or 'send' in d):
+                    batch.append({ 'type': type_,
+                                   'begin': begin,
+                                   'end': end,
+                                   'data': content,
+                                   'ident': ident,
+                                   'author': author,
+                                   'timestamp': timestamp })
+                    if len(batch) >= self.batch_size:
+                        self.create_annotations(batch)
+                        batch=[]
+                    continue
+
+                # The annotation is needed: create it now, after the
+                # pending ones
+                self.create_annotations(batch)
+                batch=[]
                 try:
-                    source.send(a)
-                except StopIteration:
-                    pass
+                    title=d['title']
+                except KeyError:
+                    title=(content or '')[:20]
+                a=self.create_annotation (type_=type_,
+                                          begin=begin,
+                                          end=end,
+                                          data=content,
+                                          ident=ident,
+                                          author=author,
+                                          title=title,
+                                          timestamp=timestamp)
+                if 'complete' in d:
+                    a.complete=d['complete']
+                if notify:
+                    print "Notifying", a
+                    self.controller.notify('AnnotationCreate', annotation=a)
+                if 'send' in d:
+                    # We are expected to return a value in the yield call
+                    try:
+                        source.send(a)
+                    except StopIteration:
+                        pass
+        except:
+            # Keep the annotations converted before the failure, as
+            # when they were created one by one, but do not let an
+            # error while creating them hide the original one.
+            exc_info=sys.exc_info()
+            try:
+                self.create_annotations(batch)
+            except Exception, e:
+                self.log("cannot create the pending annotations: ", unicode(e))
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self.create_annotations(batch)
 
 class ExternalAppImporter(GenericImporter):
     """External application importer.
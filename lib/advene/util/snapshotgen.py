@@ -0,0 +1,167 @@
+#
+# Advene: Annotate Digital Videos, Exchange on the NEt
+# Copyright (C) 2008-2012 Olivier Aubert <olivier.aubert@liris.cnrs.fr>
+#
+# Advene is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Advene is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Advene; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+"""Offline generation of package snapshots.
+
+This module fills the imagecache of a package without the GUI, using
+a BatchSnapshotter. It is used by the advene-snapshots script.
+
+Snapshots are stored as soon as they are captured (autosync), so that
+an interrupted generation can be resumed: already available snapshots
+are not captured again.
+"""
+
+import os
+import sys
+import time
+import urllib
+
+import advene.core.config as config
+import advene.util.helper as helper
+from advene.core.imagecache import ImageCache
+from advene.model.fragment import MillisecondFragment
+
+def needed_timestamps(package, step=None, duration=None):
+    """Return the sorted timestamps which need a snapshot.
+
+    They are the begin and end times of all annotations and, if step
+    is given, the timestamps of the timeline scale (every step ms,
+    until duration or the end of the last annotation).
+    """
+    res=set()
+    for a in package.annotations:
+        f=a.fragment
+        if isinstance(f, MillisecondFragment):
+            res.add(f.begin)
+            res.add(f.end)
+    if step:
+        if not duration:
+            duration=max(res or [ 0 ])
+        res.update(xrange(0, duration + 1, step))
+    return sorted(res)
+
+def locate_media(package, mediafile=None):
+    """Return the media file of the package.
+
+    Existing files are made absolute, as in
+    AdveneController.locate_mediafile, so that the imagecache id is
+    the one used by the GUI. Missing files are looked up in the package
+    directory.
+    """
+    if mediafile is None:
+        mediafile=package.getMetaData(config.data.namespace, "mediafile")
+    if not mediafile or '://' in mediafile:
+        return mediafile
+    if os.path.exists(mediafile):
+        return os.path.abspath(mediafile)
+    d=package.getUri(absolute=True)
+    if d.startswith('file:'):
+        d=d.replace('file://', '')
+    n=os.path.join(os.path.dirname(urllib.url2pathname(d)), os.path.basename(mediafile))
+    if os.path.exists(n):
+        return n
+    return mediafile
+
+def media_uri(mediafile):
+    """Return the URI of a media file.
+    """
+    if '://' in mediafile:
+        return mediafile
+    return 'file://' + urllib.pathname2url(os.path.abspath(mediafile))
+
+class SnapshotGenerator(object):
+    """Fill the imagecache of a package.
+
+    @ivar imagecache: the imagecache of the package media
+    @type imagecache: ImageCache
+    @ivar count: the number of snapshots captured
+    @type count: integer
+    """
+    def __init__(self, package, mediafile=None, workers=2, step=None, output=sys.stdout):
+        self.package=package
+        self.mediafile=locate_media(package, mediafile)
+        self.workers=workers
+        self.step=step
+        self.output=output
+        self.count=0
+
+        if not self.mediafile:
+            raise Exception("No media file is defined for the package")
+        self.uri=media_uri(self.mediafile)
+        id_=helper.mediafile2id(self.mediafile)
+        self.imagecache=ImageCache(id_)
+        # Store snapshots as soon as they are captured
+        self.imagecache.name=id_
+        self.imagecache.autosync=True
+
+    def log(self, msg):
+        if self.output is not None:
+            self.output.write(msg + "\n")
+            self.output.flush()
+
+    def missing_timestamps(self):
+        """Return the needed timestamps without a valid snapshot.
+        """
+        duration=self.package.getMetaData(config.data.namespace, "duration")
+        try:
+            duration=long(float(duration))
+        except (TypeError, ValueError):
+            duration=None
+        ic=self.imagecache
+        return [ t
+                 for t in needed_timestamps(self.package, self.step, duration)
+                 if not ic.is_initialized(t) ]
+
+    def generate(self):
+        """Capture the missing snapshots.
+
+        @return: the throughput of each worker (see BatchSnapshotter.stats)
+        """
+        # Imported here, since it requires gstreamer
+        from advene.util.snapshotter import BatchSnapshotter
+
+        timestamps=self.missing_timestamps()
+        total=len(timestamps)
+        self.log("%d snapshots to capture from %s" % (total, self.uri))
+        if not total:
+            return []
+
+        start=time.time()
+        def notify(buffer, timestamps):
+            # Calls are serialized by the BatchSnapshotter. The
+            # snapshot is stored for the requested timestamps, so that
+            # is_initialized finds them when resuming.
+            for t in timestamps:
+                self.imagecache[t]=buffer.data
+                self.count += 1
+                if self.count % 100 == 0:
+                    d=time.time() - start
+                    self.log("%d/%d snapshots (%.1f snapshots/s)" % (self.count, total,
+                                                                     self.count / d))
+
+        b=BatchSnapshotter(self.uri, notify=notify,
+                           width=config.data.player['snapshot-width'],
+                           workers=self.workers,
+                           epsilon=self.imagecache.epsilon)
+        stats=b.extract(timestamps)
+        d=time.time() - start
+        for i, (count, duration, rate) in enumerate(stats):
+            self.log("Worker %d: %d snapshots in %.2fs (%.1f snapshots/s)" % (i, count, duration, rate))
+        if d:
+            self.log("Total: %d snapshots in %.2fs (%.1f snapshots/s)" % (self.count, d, self.count / d))
+        return stats
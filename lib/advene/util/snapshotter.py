@@ -28,16 +28,22 @@ Command-line usage:
 snapshotter.py file://uri/to/movie/file.avi 1200 2400 4600
 
 This will capture snapshots for the given timestamps (in ms) and save them into /tmp.
+
+snapshotter.py --batch=4 file://uri/to/movie/file.avi 1200 2400 4600
+
+This will do the same with a BatchSnapshotter using 4 pipelines.
 """
 import sys
 import os
+import time
 
 import gobject
 import gst
 import gtk
 gtk.gdk.threads_init ()
 
-from threading import Event, Thread
+from threading import Event, Thread, Lock
+from collections import deque
 import Queue
 from Queue import PriorityQueue
 import heapq
@@ -67,8 +73,11 @@ class NotifySink(gst.BaseSink):
         self.set_sync(False)
         self._notify=None
 
-    #def do_render(self, buffer):
-    #    return gst.FLOW_OK
+    def do_render(self, buffer):
+        # Only used by BatchWorker, which plays the pipeline
+        if self._notify is not None:
+            self._notify(buffer)
+        return gst.FLOW_OK
 
     def do_preroll(self, buffer):
         if self._notify is not None:
@@ -157,6 +166,8 @@ class Snapshotter(object):
         # Keep a reference on all pipeline elements, so that they are not garbage-collected
         self._elements = l
 
+        self._csp = csp
+        self._sink = sink
         self._ghostpad = gst.GhostPad('sink', csp.get_pad('sink'))
         self.videobin.add_pad(self._ghostpad)
 
@@ -267,7 +278,220 @@ class Snapshotter(object):
         t.setDaemon(True)
         t.start()
 
+def coalesce(timestamps, epsilon):
+    """Return the sorted timestamps, without near-duplicates.
+
+    Timestamps closer than epsilon to the previous kept one are
+    dropped, since the ImageCache approximates them anyway.
+    """
+    res = []
+    for t in sorted(timestamps):
+        if not res or t - res[-1] > epsilon:
+            res.append(t)
+    return res
+
+def partition(timestamps, count):
+    """Split sorted timestamps into at most count contiguous chunks.
+
+    The chunks have similar sizes, and cover disjoint time ranges.
+    """
+    size, extra = divmod(len(timestamps), count)
+    res = []
+    start = 0
+    for i in xrange(count):
+        end = start + size + (i < extra and 1 or 0)
+        if end > start:
+            res.append(timestamps[start:end])
+        start = end
+    return res
+
+def make_runs(timestamps, max_gap):
+    """Group sorted timestamps into runs.
+
+    Consecutive timestamps of a run are at most max_gap apart: it is
+    cheaper to decode forward from one to the next than to seek.
+    """
+    runs = []
+    for t in timestamps:
+        if runs and t - runs[-1][-1] <= max_gap:
+            runs[-1].append(t)
+        else:
+            runs.append([ t ])
+    return runs
+
+class BatchWorker(Snapshotter):
+    """Snapshotter processing runs of timestamps.
+
+    Isolated timestamps are captured with an accurate seek, like in
+    Snapshotter. For runs of close timestamps, the worker seeks to the
+    first one, then plays the pipeline (unsynchronized) and captures
+    the frames covering the next timestamps. Other frames are dropped
+    before PNG encoding.
+
+    A run is given up if no frame is captured during timeout seconds.
+    """
+    def __init__(self, notify=None, width=None, epsilon=35, timeout=10):
+        Snapshotter.__init__(self, notify=notify, width=width)
+        self.epsilon = epsilon
+        self.timeout = timeout
+        self.count = 0
+        self.duration = 0
+        self.targets = deque()
+        self.frame_done = Event()
+        self.run_done = Event()
+        self._csp.get_pad('sink').add_buffer_probe(self.buffer_probe)
+        bus = self.player.get_bus()
+        bus.connect('sync-message::eos', self.on_eos)
+        bus.connect('sync-message::error', self.on_eos)
+
+    def covers(self, buffer, t):
+        """Check if the buffer is the frame to use for timestamp t.
+        """
+        begin = buffer.timestamp / gst.MSECOND
+        if buffer.duration != gst.CLOCK_TIME_NONE:
+            return begin + buffer.duration / gst.MSECOND > t
+        else:
+            return begin >= t - self.epsilon
+
+    def buffer_probe(self, pad, buffer):
+        """Drop the frames which are not needed.
+        """
+        targets = self.targets
+        # Between runs, let the sink preroll so that decoding stops
+        return not targets or self.covers(buffer, targets[0])
+
+    def on_eos(self, bus, message):
+        if self.targets:
+            # No more frames: give up the current run
+            self.targets.clear()
+            self.run_done.set()
+
+    def queue_notify(self, buffer):
+        targets = self.targets
+        if not targets or not self.covers(buffer, targets[0]):
+            # Preroll buffer rendered again, or late frame
+            return True
+        # All the targets covered by this frame are done
+        duration = self.epsilon
+        if buffer.duration != gst.CLOCK_TIME_NONE:
+            duration = max(duration, buffer.duration / gst.MSECOND)
+        end = buffer.timestamp / gst.MSECOND + duration
+        covered = []
+        while targets and targets[0] < end:
+            covered.append(targets.popleft())
+        if self.notify is not None:
+            self.notify(buffer, covered)
+        self.count += 1
+        if not targets:
+            self.run_done.set()
+        self.frame_done.set()
+        return True
+
+    def process_run(self, run):
+        """Capture the snapshots for a run of timestamps.
+        """
+        self.frame_done.clear()
+        self.run_done.clear()
+        self.targets.extend(run)
+        self.snapshot(run[0])
+        if len(run) > 1 and self.frame_done.wait(self.timeout) and self.targets:
+            # Decode forward from the first frame
+            self.player.set_state(gst.STATE_PLAYING)
+        while not self.run_done.is_set():
+            self.frame_done.clear()
+            if self.run_done.is_set():
+                break
+            if not self.frame_done.wait(self.timeout):
+                break
+        self.player.set_state(gst.STATE_PAUSED)
+        self.targets.clear()
+
+    def process_runs(self, runs):
+        """Capture the snapshots for a list of runs.
+
+        This method blocks until all snapshots are captured.
+        """
+        t = time.time()
+        for run in runs:
+            self.process_run(run)
+        self.duration = time.time() - t
+        self.player.set_state(gst.STATE_NULL)
+
+class BatchSnapshotter(object):
+    """Batch extraction of snapshots.
+
+    The timestamps are sorted and coalesced (within epsilon), then
+    split into contiguous time ranges processed in parallel by
+    BatchWorkers, each one using its own pipeline.
+
+    The notify method is called (from the worker threads) with a
+    gst.Buffer and the list of the requested timestamps (in ms) that
+    it covers. The snapshots must be stored for these timestamps
+    rather than for the buffer timestamp, which may be further than
+    epsilon from them.
+    """
+    def __init__(self, uri, notify=None, width=None, workers=2, epsilon=35, max_gap=2000):
+        self.uri = uri
+        self.notify = notify
+        self.width = width
+        self.workers = workers
+        self.epsilon = epsilon
+        # Timestamps closer than max_gap are captured by forward decoding
+        self.max_gap = max_gap
+        self._workers = []
+        self._lock = Lock()
+
+    def _notify(self, buffer, timestamps):
+        # Serialize calls to the notify method
+        self._lock.acquire()
+        try:
+            if self.notify is not None:
+                self.notify(buffer, timestamps)
+        finally:
+            self._lock.release()
+
+    def extract(self, timestamps):
+        """Capture snapshots for the given timestamps (in ms).
+
+        This method blocks until all snapshots are captured.
+
+        @return: the statistics, see L{stats}
+        """
+        chunks = partition(coalesce(timestamps, self.epsilon), self.workers)
+        self._workers = []
+        threads = []
+        for chunk in chunks:
+            w = BatchWorker(notify=self._notify, width=self.width, epsilon=self.epsilon)
+            w.set_uri(self.uri)
+            self._workers.append(w)
+            t = Thread(target=w.process_runs, args=(make_runs(chunk, self.max_gap), ))
+            t.setDaemon(True)
+            threads.append(t)
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return self.stats()
+
+    def stats(self):
+        """Return the throughput of the workers.
+
+        @return: a list of (snapshot count, duration in s, snapshots/s) tuples
+        """
+        res = []
+        for w in self._workers:
+            if w.duration:
+                rate = w.count / w.duration
+            else:
+                rate = 0.0
+            res.append( (w.count, w.duration, rate) )
+        return res
+
 if __name__ == '__main__':
+    batch = [ a for a in sys.argv[1:] if a.startswith('--batch=') ]
+    if batch:
+        sys.argv.remove(batch[0])
+        batch = int(batch[0][len('--batch='):])
     try:
         uri=sys.argv[1]
         if uri.startswith('/'):
@@ -275,6 +499,17 @@ if __name__ == '__main__':
     except IndexError:
         uri='file:///media/video/Bataille.avi'
 
+    if batch and sys.argv[2:]:
+        def notify(buffer, timestamps):
+            for t in timestamps:
+                f=open('/tmp/%010d.png' % t, 'w')
+                f.write(buffer.data)
+                f.close()
+        b=BatchSnapshotter(uri, notify=notify, width=160, workers=batch)
+        for i, (count, duration, rate) in enumerate(b.extract([ long(t) for t in sys.argv[2:] ])):
+            print "Worker %d: %d snapshots in %.2fs (%.1f snapshots/s)" % (i, count, duration, rate)
+        sys.exit(0)
+
     s=Snapshotter(width=160)
     s.set_uri(uri)
     s.notify=s.simple_notify
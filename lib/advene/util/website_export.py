@@ -24,20 +24,105 @@ import time
 import re
 import urllib
 import mimetypes
+import multiprocessing
 import shutil
+import cPickle
+from cStringIO import StringIO
+from itertools import imap
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
 
 import advene.core.config as config
 import advene.util.helper as helper
+from advene.model.annotation import Annotation, Relation
+from advene.model.tal.context import record_dependencies
+from advene.model.util.dom import writexml
 
 fragment_re=re.compile('(.*)#(.+)')
 package_expression_re=re.compile('packages/(\w+)/(.*)')
 href_re=re.compile(r'''(xlink:href|href|src|about|resource)=['"](.+?)['"> ]''')
+# Same as href_re, with the delimiters
+link_re=re.compile(r'''(xlink:href|href|src|about|resource)=(['"])(.+?)(['"> ])''')
 snapshot_re=re.compile(r'/packages/[^/]+/imagecache/(\d+)')
 overlay_re=re.compile(r'/media/overlay/[^/]+/([\w\d]+)(/.+)?')
 tales_re=re.compile('(\w+)/(.+)')
 player_re=re.compile(r'/media/play(/|\?position=)(\d+)(/(\d+))?')
 overlay_replace_re=re.compile(r'/media/overlay/([^/]+)/([\w\d]+)(/.+)?')
 
+# Exporter used by the rendering processes (see
+# WebsiteExporter.iter_contents). The processes are forked, so that
+# they inherit it with its package. Without fork (win32),
+# multiprocessing starts new interpreters which would not have it, so
+# pages are then rendered in the current process.
+_exporter=None
+CAN_FORK=hasattr(os, 'fork')
+
+def _render(address):
+    return _exporter.render_page(address)
+
+# Name of the directory (in the settings directory) holding the
+# export manifests and the rendered pages, in a subdirectory per
+# destination.
+MANIFEST_DIR='export'
+MANIFEST_VERSION=1
+
+def package_fingerprints(package, settings=None):
+    """Return the fingerprints of a package, for incremental exports.
+
+    It returns a (fingerprint, annotations) tuple. fingerprint is the
+    digest of the whole package except the annotations data: metadata,
+    schemas, views, queries, relations, the ids and types of the
+    annotations, and the size and modification time of the
+    resources. annotations is a dictionary holding the digest of each
+    annotation, and of all annotations (with the '*' key).
+
+    @param settings: additional data included in the fingerprint
+    """
+    # Make sure that deferred annotations are parsed
+    package.getAnnotations()
+    package.getRelations()
+    model=package._getModel()
+
+    def xml(node):
+        s=StringIO()
+        writexml(node, s)
+        return s.getvalue()
+
+    res=md5(repr(settings))
+    res.update(repr(sorted(model.attributes.items())))
+    annotations={}
+    all_annotations=md5()
+    for node in model.childNodes:
+        if node.nodeType != node.ELEMENT_NODE:
+            continue
+        if node.localName != 'annotations':
+            res.update(xml(node))
+            continue
+        for e in node.childNodes:
+            if e.nodeType != e.ELEMENT_NODE:
+                continue
+            if e.localName == 'annotation':
+                i=e.getAttribute('id')
+                annotations[i]=md5(xml(e)).hexdigest()
+                all_annotations.update(annotations[i])
+                res.update(repr( (i, e.getAttribute('type')) ))
+            else:
+                res.update(xml(e))
+    annotations['*']=all_annotations.hexdigest()
+
+    # Resources are not stored in the model, and views can inline them
+    resources=package.resources
+    if resources is not None:
+        for dirpath, dirnames, filenames in os.walk(resources.dir_):
+            dirnames.sort()
+            for name in sorted(filenames):
+                path=os.path.join(dirpath, name)
+                st=os.stat(path)
+                res.update(repr( (os.path.relpath(path, resources.dir_), st.st_size, st.st_mtime) ))
+    return res.hexdigest(), annotations
+
 class WebsiteExporter(object):
     """Export a set of static views to a directory.
 
@@ -49,9 +134,27 @@ class WebsiteExporter(object):
     @param views: the list of views to export
     @param max_depth: maximum recursion depth
     @param progress_callback: if defined, the method will be called with a float in 0..1 and a message indicating progress
+    @param workers: the number of processes rendering the pages. If 1, or if fork is not available, pages are rendered in the current process.
+    @param incremental: if True, only re-render the pages whose dependencies were modified since the last export.
+
+    The manifest of the export (in the settings directory) records,
+    for each rendered page, the annotations it depends on, and the
+    digest of each written file. Pages are rendered again if the
+    package structure (schemas, views, queries, relations, annotation
+    ids and types, resources) or the annotations they depend on are
+    modified. Files are not written again if their data is
+    unchanged. Once an export is complete, the pages which were not
+    used are removed from the manifest.
+
+    The rendering processes are forked from the application
+    process. They only evaluate the views, and must not use the GUI or
+    the player (which are not fork-safe).
     """
-    def __init__(self, controller, destination='/tmp/n', views=None, max_depth=3, progress_callback=None, video_url=None):
+    def __init__(self, controller, destination='/tmp/n', views=None, max_depth=3, progress_callback=None, video_url=None, workers=1, incremental=True):
         self.controller=controller
+        self.workers=workers
+        self.incremental=incremental
+        self.view_ids=set(v.id for v in self.controller.package.views)
 
         # Directory creation/checks
         self.destination=destination
@@ -84,6 +187,18 @@ class WebsiteExporter(object):
 
         self.url_translation={}
 
+        self.manifest_dir=config.data.advenefile( (MANIFEST_DIR,
+                                                   md5(os.path.abspath(self.destination)).hexdigest()),
+                                                  'settings')
+        # address -> (dependencies, fingerprint) of the rendered pages
+        self.pages={}
+        # Addresses used by this export
+        self.addresses=set()
+        # filename (relative to the destination) -> digest of the written data
+        self.files={}
+        self.rendered_count=0
+        self.written_count=0
+
     def log(self, *p):
         self.controller.log(*p)
 
@@ -118,6 +233,16 @@ class WebsiteExporter(object):
     def get_contents(self, url):
         """Return the contents of the given view.
         """
+        address=self.get_address(url)
+        if address is None:
+            return None
+        return self.render(address)
+
+    def get_address(self, url):
+        """Return the TALES address (relative to the package) of the given view.
+
+        Return None if the url should not be retrieved.
+        """
         # Handle fragments
         m=fragment_re.search(url)
         if m:
@@ -130,14 +255,17 @@ class WebsiteExporter(object):
         if m:
             # Absolute url
             address=m.group(2)
-        elif url in (v.id for v in self.controller.package.views):
+        elif url in self.view_ids:
             # Relative url for a view
             address='view/'+url
         else:
             # No match. Do not try to retrieve
             return None
+        return address
 
-        # Generate the view
+    def render(self, address):
+        """Return the contents of the view with the given TALES address.
+        """
         ctx=self.controller.build_context()
         try:
             content=ctx.evaluateValue('here/%s' % address)
@@ -156,6 +284,169 @@ class WebsiteExporter(object):
                 content=unicode(content)
         return content
 
+    def render_page(self, address):
+        """Render a page, recording its dependencies.
+
+        @return: a (contents, dependencies) tuple
+        """
+        dependencies=set()
+        record_dependencies(dependencies)
+        try:
+            content=self.render(address)
+        finally:
+            record_dependencies(None)
+        if '*' in dependencies:
+            return content, set('*')
+        return content, set(e.getId()
+                            for e in dependencies
+                            if isinstance(e, (Annotation, Relation)))
+
+    def page_fingerprint(self, dependencies):
+        return md5(repr([ (d, self.fingerprints.get(d)) for d in sorted(dependencies) ])).hexdigest()
+
+    def page_filename(self, address):
+        return os.path.join(self.manifest_dir, md5(address).hexdigest())
+
+    def get_cached_page(self, address):
+        """Return the contents of the page from the previous export.
+
+        Return None if it is not available, or if its dependencies
+        were modified.
+        """
+        try:
+            dependencies, fingerprint = self.pages[address]
+        except KeyError:
+            return None
+        if self.page_fingerprint(dependencies) != fingerprint:
+            return None
+        try:
+            f=open(self.page_filename(address), 'rb')
+        except IOError:
+            return None
+        content=f.read().decode('utf-8')
+        f.close()
+        return content
+
+    def store_page(self, address, content, dependencies):
+        """Store the contents of a rendered page for the next export.
+        """
+        if isinstance(content, unicode):
+            data=content.encode('utf-8')
+        else:
+            data=content
+        f=open(self.page_filename(address), 'wb')
+        f.write(data)
+        f.close()
+        self.pages[address]=(dependencies, self.page_fingerprint(dependencies))
+
+    def load_manifest(self):
+        """Load the manifest of the previous export.
+
+        The pages of the previous export are only reused if the package
+        structure and the export settings are unchanged.
+        """
+        self.fingerprint, self.fingerprints = package_fingerprints(self.controller.package,
+                                                                   (sorted(v.id for v in self.views),
+                                                                    self.max_depth,
+                                                                    self.video_url))
+        if not os.path.isdir(self.manifest_dir):
+            helper.recursive_mkdir(self.manifest_dir)
+        if not self.incremental:
+            return
+        try:
+            f=open(os.path.join(self.manifest_dir, 'manifest'), 'rb')
+            manifest=cPickle.load(f)
+            f.close()
+        except (IOError, EOFError, cPickle.PickleError):
+            return
+        if manifest.get('version') != MANIFEST_VERSION:
+            return
+        self.files=manifest['files']
+        if manifest['fingerprint'] == self.fingerprint:
+            self.pages=manifest['pages']
+
+    def save_manifest(self, prune=False):
+        """Save the manifest of the export.
+
+        @param prune: if True, remove the pages which were not used by this export
+        """
+        if prune:
+            self.pages=dict( (a, self.pages[a])
+                             for a in self.addresses
+                             if a in self.pages )
+            used=set(os.path.basename(self.page_filename(a)) for a in self.pages)
+            for name in os.listdir(self.manifest_dir):
+                if name != 'manifest' and name not in used:
+                    os.unlink(os.path.join(self.manifest_dir, name))
+        f=open(os.path.join(self.manifest_dir, 'manifest'), 'wb')
+        cPickle.dump({ 'version': MANIFEST_VERSION,
+                       'fingerprint': self.fingerprint,
+                       'pages': self.pages,
+                       'files': self.files }, f, cPickle.HIGHEST_PROTOCOL)
+        f.close()
+
+    def iter_contents(self, urls, pool=None):
+        """Iterate over the (url, contents) of the given urls, in order.
+
+        Urls addressing the same element and view are rendered
+        once. Pages whose dependencies are unchanged since the last
+        export are not rendered. If pool is given, pages are rendered
+        by its processes.
+        """
+        addresses=[ self.get_address(url) for url in urls ]
+        contents={}
+        unique=[]
+        for a in addresses:
+            if a is None or a in contents:
+                continue
+            self.addresses.add(a)
+            contents[a]=self.get_cached_page(a)
+            if contents[a] is None:
+                unique.append(a)
+        if pool is None:
+            rendered=imap(self.render_page, unique)
+        else:
+            rendered=pool.imap(_render, unique,
+                               max(1, len(unique) / (self.workers * 4)))
+        # Rendered pages come in the order of the first occurrence of
+        # their address.
+        for url, a in zip(urls, addresses):
+            if a is not None and contents[a] is None:
+                content, dependencies = rendered.next()
+                self.store_page(a, content, dependencies)
+                self.rendered_count += 1
+                contents[a]=content
+            yield url, contents.get(a)
+
+    def unchanged(self, name, digest):
+        """Check if the file name was written with the data digest by the previous export.
+        """
+        return (self.files.get(name) == digest
+                and os.path.exists(os.path.join(self.destination, name)))
+
+    def write_file(self, name, data, digest=None):
+        """Write data into the file name (relative to the destination directory).
+
+        The file is not written if its data is unchanged since the
+        previous export. digest identifies the data. It is by default
+        the md5 digest of the data.
+        """
+        if isinstance(data, unicode):
+            data=data.encode('utf-8')
+        if digest is None:
+            digest=md5(data).hexdigest()
+        if self.unchanged(name, digest):
+            return
+        path=os.path.join(self.destination, name)
+        d=os.path.dirname(path)
+        if not os.path.isdir(d):
+            helper.recursive_mkdir(d)
+        f=open(path, 'wb')
+        f.write(data)
+        f.close()
+        self.files[name]=digest
+        self.written_count += 1
+
     def translate_links(self, content, baseurl=None, max_depth_exceeded=False):
         """Translate links from the given content.
 
@@ -227,7 +518,7 @@ class WebsiteExporter(object):
             if m:
                 # Absolute url
                 tales=m.group(2)
-            elif url in (v.id for v in self.controller.package.views):
+            elif url in self.view_ids:
                 # Relative url.
                 tales='view/'+url
             else:
@@ -323,41 +614,39 @@ class WebsiteExporter(object):
             return 'imagecache/overlay_%s.png' % name
         content=overlay_replace_re.sub(overlay_replacement, content)
 
-        # Convert all links
-        for (attname, link) in href_re.findall(content):
+        # Convert all links, in a single pass
+        def link_replacement(m):
+            attname, quote, link, end = m.groups()
             if link.startswith('imagecache/'):
                 # Already processed by the global regexp at the beginning
-                continue
+                return m.group(0)
             if link.startswith('#'):
-                continue
-            m=fragment_re.search(link)
-            if m:
-                fragment=m.group(2)
-                tr=self.url_translation.get(m.group(1))
+                return m.group(0)
+            f=fragment_re.search(link)
+            if f:
+                fragment=f.group(2)
+                tr=self.url_translation.get(f.group(1))
             else:
                 fragment=None
                 tr=self.url_translation.get(link)
             if tr is None:
                 print "website export bug: %s was not translated" % link
-                continue
-            if link != tr:
-                extra=[]
-                attr, l = self.video_player.fix_link(tr)
-                if attr is not None:
-                    extra.append(attr)
-                if l is not None:
-                    tr=l
-                if 'unconverted' in tr:
-                    extra.append('onClick="return false;"')
-                if fragment is not None:
-                    tr=tr+'#'+fragment
-
-                if extra:
-                    exp = '''(%s=['"])%s(['"> ])''' % (attname, re.escape(link))
-                    content=re.sub(exp, " ".join(extra) + r''' \1''' + tr + r'''\2''', content)
-                else:
-                    exp = '''(%s=['"])%s(['"> ])''' % (attname, re.escape(link))
-                    content=re.sub(exp, r'''\1''' + tr + r'''\2''', content)
+                return m.group(0)
+            if link == tr:
+                return m.group(0)
+            extra=[]
+            attr, l = self.video_player.fix_link(tr)
+            if attr is not None:
+                extra.append(attr)
+            if l is not None:
+                tr=l
+            if 'unconverted' in tr:
+                extra.append('onClick="return false;"')
+            if fragment is not None:
+                tr=tr+'#'+fragment
+            extra.append(attname + '=' + quote + tr + end)
+            return " ".join(extra)
+        content=link_re.sub(link_replacement, content)
 
         content=self.video_player.transform_document(content)
         return content
@@ -366,19 +655,13 @@ class WebsiteExporter(object):
         """Write the converted content as well as associated data.
         """
         # Write the content.
-        output=self.url_translation[url]
-        f=open(os.path.join(self.destination, output), 'w')
-        f.write(content)
-        f.close()
+        self.write_file(self.url_translation[url], content)
 
         # Copy snapshots
         for t in used_snapshots:
             # FIXME: not robust wrt. multiple packages/videos
-            if not os.path.isdir(self.imgdir):
-                helper.recursive_mkdir(self.imgdir)
-            f=open(os.path.join(self.imgdir, '%s.png' % t), 'wb')
-            f.write(str(self.controller.package.imagecache[t]))
-            f.close()
+            self.write_file(os.path.join('imagecache', '%s.png' % t),
+                            str(self.controller.package.imagecache[t]))
 
         # Copy overlays
         for (ident, tales) in used_overlays:
@@ -387,33 +670,27 @@ class WebsiteExporter(object):
             if not a:
                 print "Cannot find annotation %s for overlaying"
                 continue
-            name=ident+tales.replace('/', '_')
-            if not os.path.isdir(self.imgdir):
-                helper.recursive_mkdir(self.imgdir)
-            f=open(os.path.join(self.imgdir, 'overlay_%s.png' % name), 'wb')
+            name=os.path.join('imagecache', 'overlay_%s.png' % (ident+tales.replace('/', '_')))
             if tales:
                 # There is a TALES expression
                 ctx=self.controller.build_context(here=a)
                 data=ctx.evaluateValue('here' + tales)
             else:
                 data=a.content.data
-            f.write(str(self.controller.gui.overlay(self.controller.package.imagecache[a.fragment.begin], data)))
-            f.close()
+            image=self.controller.package.imagecache[a.fragment.begin]
+            # Identify the overlay by its sources, to avoid generating it
+            digest=md5(str(image))
+            digest.update(unicode(data).encode('utf-8'))
+            digest=digest.hexdigest()
+            if not self.unchanged(name, digest):
+                self.write_file(name, str(self.controller.gui.overlay(image, data)), digest)
 
         # Copy resources
         for path in used_resources:
-            dest=os.path.join(self.destination, 'resources', path)
-
-            d=os.path.dirname(dest)
-            if not os.path.isdir(d):
-                helper.recursive_mkdir(d)
-
             r=self.controller.package.resources
             for element in path.split('/'):
                 r=r[element]
-            output=open(dest, 'wb')
-            output.write(r.data)
-            output.close()
+            self.write_file(os.path.join('resources', path), r.data)
 
     def website_export(self):
         main_step=1.0/self.max_depth
@@ -422,6 +699,8 @@ class WebsiteExporter(object):
         if not self.progress_callback(progress, _("Starting export")):
             return
 
+        self.load_manifest()
+
         view_url={}
         ctx=self.controller.build_context()
         # Pre-seed url translations for base views
@@ -445,34 +724,60 @@ class WebsiteExporter(object):
 
         links_to_be_processed=view_url.values()
 
-        while depth <= self.max_depth:
-            max_depth_exceeded = (depth == self.max_depth)
-            step=main_step / (len(links_to_be_processed) or 1)
-            if not self.progress_callback(progress, _("Depth %d") % depth):
-                return
-            links=set()
-            for url in links_to_be_processed:
-                if not self.progress_callback(progress, _("Depth %(depth)d: processing %(url)s") % locals()):
+        global _exporter
+        if self.workers > 1 and not CAN_FORK:
+            self.log(_("Rendering processes are not available on this platform. Rendering pages in the current process."))
+        if self.workers > 1 and CAN_FORK:
+            _exporter=self
+            pool=multiprocessing.Pool(self.workers)
+        else:
+            pool=None
+        start=time.time()
+        count=0
+        complete=False
+        try:
+            while depth <= self.max_depth:
+                max_depth_exceeded = (depth == self.max_depth)
+                step=main_step / (len(links_to_be_processed) or 1)
+                if not self.progress_callback(progress, _("Depth %d") % depth):
                     return
-                progress += step
-                content=self.get_contents(url)
-
-                (new_links,
-                 used_snapshots,
-                 used_overlays,
-                 used_resources)=self.translate_links(content,
-                                                      url,
-                                                      max_depth_exceeded)
-                links.update(new_links)
-
-                # Write contents
-                self.write_data(url, self.fix_links(content),
-                                used_snapshots,
-                                used_overlays,
-                                used_resources)
-
-            links_to_be_processed=links
-            depth += 1
+                links=set()
+                for url, content in self.iter_contents(sorted(links_to_be_processed), pool):
+                    count += 1
+                    rate=count / (time.time() - start or 1)
+                    if not self.progress_callback(progress, _("Depth %(depth)d: processing %(url)s (%(rate).1f pages/s)") % locals()):
+                        return
+                    progress += step
+
+                    (new_links,
+                     used_snapshots,
+                     used_overlays,
+                     used_resources)=self.translate_links(content,
+                                                          url,
+                                                          max_depth_exceeded)
+                    links.update(new_links)
+
+                    # Write contents
+                    self.write_data(url, self.fix_links(content),
+                                    used_snapshots,
+                                    used_overlays,
+                                    used_resources)
+
+                links_to_be_processed=links
+                depth += 1
+            complete=True
+        finally:
+            if pool is not None:
+                pool.terminate()
+                _exporter=None
+            self.save_manifest(prune=complete)
+        duration=time.time() - start
+        self.log(_("Exported %(count)d pages in %(duration).1fs (%(rate).1f pages/s, %(rendered)d rendered, %(written)d files written)") % {
+                'count': count,
+                'duration': duration,
+                'rate': count / (duration or 1),
+                'rendered': self.rendered_count,
+                'written': self.written_count })
 
         if not self.progress_callback(0.95, _("Finalizing")):
             return
@@ -503,7 +808,6 @@ class WebsiteExporter(object):
         name="index.html"
         if name in self.url_translation.values():
             name="_index.html"
-        f=open(os.path.join(self.destination, name), 'w')
         defaultview=self.controller.package.getMetaData(config.data.namespace, 'default_utbv')
         v=self.controller.package.views.get_by_id(defaultview)
         if defaultview and v:
@@ -513,7 +817,7 @@ class WebsiteExporter(object):
             default_href=''
             default=''
 
-        f.write("""<html><head>%(title)s</head>
+        self.write_file(name, """<html><head>%(title)s</head>
 <body>
 <h1>%(title)s views</h1>
 %(default)s
@@ -524,13 +828,11 @@ class WebsiteExporter(object):
                            'data': "\n".join( '<li><a href="%s">%s</a>' % (self.url_translation[view_url[v]],
                                                                            v.title)
                                               for v in self.views ) })
-        f.close()
 
         frame="frame.html"
         if frame in self.url_translation.values():
             frame="_frame.html"
-        f=open(os.path.join(self.destination, frame), 'w')
-        f.write("""<html>
+        self.write_file(frame, """<html>
 <head><title>%(title)s</title></head>
 <frameset cols="70%%,30%%">
   <frame name="main" src="%(index)s" />
@@ -541,15 +843,13 @@ class WebsiteExporter(object):
                 'title': self.controller.get_title(self.controller.package),
                 'index': default_href or name,
                 })
-        f.close()
 
-        f=open(os.path.join(self.destination, "unconverted.html"), 'w')
-        f.write("""<html><head>%(title)s - not converted</head>
+        self.write_file("unconverted.html", """<html><head>%(title)s - not converted</head>
 <body>
 <h1>%(title)s - not converted resource</h1>
 <p>Advene was unable to export this resource.</p>
 </body></html>""" % { 'title': self.controller.get_title(self.controller.package) })
-        f.close()
+        self.save_manifest()
 
         self.progress_callback(1.0, _("Export complete"))
 